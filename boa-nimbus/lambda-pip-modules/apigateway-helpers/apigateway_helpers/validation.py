@@ -0,0 +1,40 @@
+from apigateway_helpers.exception import APIGatewayException
+
+# Checked directly rather than with the zbase32-python3 package, which the
+# python2.7 functions validating IDs can't import.
+zbase32_alphabet = "ybndrfg8ejkmcpqxot1uwisza345h769"
+
+# Room and session IDs are 16 random bytes, zbase32 encoded.
+zbase32_id_length = 26
+
+# The last character of an encoded ID holds 3 bits of the ID and 2 bits of
+# zero padding, so only every fourth character of the alphabet can be last.
+zbase32_id_last_characters = zbase32_alphabet[::4]
+
+def is_valid_zbase32_id(value):
+    """Returns whether value is a zbase32 encoded 16-byte ID, without decoding
+    it or calling anything that would."""
+
+    try:
+        if len(value) != zbase32_id_length:
+            return False
+
+        if value[-1] not in zbase32_id_last_characters:
+            return False
+
+        # Strips nothing but alphabet characters, so anything left means the
+        # ID has a character outside the alphabet.
+        return value.strip(zbase32_alphabet) == ""
+    except (TypeError, AttributeError):
+        return False
+
+def validate_zbase32_id_path_parameter(event, parameter_name):
+    """Returns the named path parameter, raising an APIGatewayException (400)
+    if it's not a zbase32 encoded 16-byte ID."""
+
+    value = (event.get("pathParameters") or {}).get(parameter_name)
+
+    if not is_valid_zbase32_id(value):
+        raise APIGatewayException("Parameter \"{}\" specified in path is not a valid ID.".format(parameter_name), 400)
+
+    return value
@@ -1,15 +1,50 @@
 import base64
 import hmac
 import hashlib
+import threading
 
-def generate_cognito_sign_up_secret_hash(username, client_id, client_secret):
-    return base64.b64encode(
-        hmac.new(
-            str(client_secret), 
-            msg = "{}{}".format(
-                username,
-                client_id
-            ).decode("utf-8"), 
+class SecretHasher(object):
+    """Generates Cognito secret hashes for one user pool client.
+
+    The HMAC is keyed with the client secret once, and each hash starts from
+    a copy of it, so the key's inner and outer padding are only hashed once.
+    Usernames may be given as bytes or text.
+
+    """
+
+    def __init__(self, client_id, client_secret):
+        self.client_id_bytes = to_utf8_bytes(client_id)
+        self.keyed_hmac = hmac.new(
+            to_utf8_bytes(client_secret),
             digestmod = hashlib.sha256
-        ).digest()
-    ).decode()
\ No newline at end of file
+        )
+
+    def get_secret_hash(self, username):
+        each_hmac = self.keyed_hmac.copy()
+        each_hmac.update(to_utf8_bytes(username) + self.client_id_bytes)
+
+        return base64.b64encode(each_hmac.digest()).decode()
+
+# Hashers are kept for the life of the container, keyed by client ID and
+# secret (there's normally just the one).
+secret_hashers = {}
+secret_hashers_lock = threading.Lock()
+
+def get_secret_hasher(client_id, client_secret):
+
+    hasher_key = (client_id, client_secret)
+
+    with secret_hashers_lock:
+        if hasher_key not in secret_hashers:
+            secret_hashers[hasher_key] = SecretHasher(client_id, client_secret)
+
+        return secret_hashers[hasher_key]
+
+def generate_cognito_sign_up_secret_hash(username, client_id, client_secret):
+    return get_secret_hasher(client_id, client_secret).get_secret_hash(username)
+
+def to_utf8_bytes(value):
+    if isinstance(value, bytes):
+        return value
+
+    return u"{}".format(value).encode("utf-8")
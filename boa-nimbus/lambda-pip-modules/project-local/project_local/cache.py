@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache(object):
+    """Bounded, least-recently-used cache whose entries expire after a fixed
+    number of seconds.
+
+    Intended to live at module level so it's shared by warm invocations of the
+    same Lambda container.
+
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, value = entry
+
+            if expires <= time.time():
+                self.misses += 1
+                self.evictions += 1
+                return None
+
+            # Re-insert to mark as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+class ByteBoundedLRUCache(object):
+    """Least-recently-used cache bounded by the total size of its entries
+    rather than their number. For values that never change once written, so
+    entries don't expire.
+
+    Sizes are given by the caller (e.g. the length of the serialized object).
+    Values are shared between callers and must not be modified.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Re-insert to mark as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key, value, size):
+
+        # Don't let one oversized value flush everything else.
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous_entry = self._entries.pop(key, None)
+
+            if previous_entry is not None:
+                self._current_bytes -= previous_entry[0]
+
+            self._entries[key] = (size, value)
+            self._current_bytes += size
+
+            while self._current_bytes > self.max_bytes:
+                evicted_size, _ = self._entries.popitem(last=False)[1]
+                self._current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,139 @@
+from __future__ import print_function
+
+import json
+import time
+import hashlib
+import threading
+import botocore
+from project_local.cache import TTLCache
+
+class InMemoryDedupeStore(object):
+    """Process-local store. Useful for local testing in place of a shared
+    store.
+
+    """
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] + self.window_seconds <= time.time():
+                return None
+
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+
+class S3DedupeStore(object):
+    """Stores each key as a small JSON object under a prefix in the shared
+    bucket.
+
+    S3 has no conditional put here, so two concurrent first attempts can both
+    miss. Retries after a response was lost (the case this exists for) are
+    sequential and will be caught.
+
+    """
+
+    def __init__(self, s3_client, s3_bucket_name, key_prefix, window_seconds):
+        self.s3_client = s3_client
+        self.s3_bucket_name = s3_bucket_name
+        self.key_prefix = key_prefix
+        self.window_seconds = window_seconds
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(
+                Bucket = self.s3_bucket_name,
+                Key = "{}{}".format(self.key_prefix, key)
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return None
+            else:
+                raise
+
+        stored_object = json.loads(response["Body"].read().decode("utf-8"))
+
+        if stored_object["timestamp"] + self.window_seconds <= time.time():
+            return None
+
+        return stored_object["value"]
+
+    def put(self, key, value):
+        self.s3_client.put_object(
+            Bucket = self.s3_bucket_name,
+            Key = "{}{}".format(self.key_prefix, key),
+            Body = json.dumps({
+                "timestamp": int(time.time()),
+                "value": value
+            }),
+            ContentType = "application/json"
+        )
+
+class MessageDedupeWindow(object):
+    """Remembers the message ID published for each (room ID, identity ID,
+    client message ID) so a retried post can be answered without publishing
+    again.
+
+    Lookups check an in-memory LRU first and fall back to the shared store,
+    unless told not to. Records can be written to the shared store on a
+    thread pool so the caller doesn't wait for them.
+
+    The shared store (an S3DedupeStore, or an InMemoryDedupeStore locally)
+    needs get(key) and put(key, value). get() returns the value put for at
+    least window_seconds, then None.
+
+    """
+
+    def __init__(self, shared_store, window_seconds, max_local_entries = 4096):
+        self.shared_store = shared_store
+        self.local_cache = TTLCache(max_local_entries, window_seconds)
+
+    def get_dedupe_key(self, room_id, identity_id, client_message_id):
+        # Client message IDs are client-specified, so hash them into something
+        # safe to use as part of an S3 key.
+        return "{}/{}".format(
+            room_id,
+            hashlib.sha256(u"{}\n{}".format(identity_id, client_message_id).encode("utf-8")).hexdigest()
+        )
+
+    def lookup(self, room_id, identity_id, client_message_id, check_shared_store = True):
+        dedupe_key = self.get_dedupe_key(room_id, identity_id, client_message_id)
+
+        message_id = self.local_cache.get(dedupe_key)
+
+        if message_id is None and check_shared_store and self.shared_store is not None:
+            message_id = self.shared_store.get(dedupe_key)
+
+            if message_id is not None:
+                self.local_cache.put(dedupe_key, message_id)
+
+        return message_id
+
+    def record(self, room_id, identity_id, client_message_id, message_id, pool = None):
+        dedupe_key = self.get_dedupe_key(room_id, identity_id, client_message_id)
+
+        self.local_cache.put(dedupe_key, message_id)
+
+        if self.shared_store is None:
+            return
+
+        if pool is None:
+            self.shared_store.put(dedupe_key, message_id)
+        else:
+            pool.apply_async(self.put_shared_record, (dedupe_key, message_id))
+
+    def put_shared_record(self, dedupe_key, message_id):
+        # Runs on a pool with no one waiting on the result, so failures are
+        # only logged. The local record is already in place either way.
+        try:
+            self.shared_store.put(dedupe_key, message_id)
+        except Exception as e:
+            print("Unable to store dedupe record {}: {}".format(dedupe_key, e))
@@ -0,0 +1,79 @@
+from __future__ import print_function
+
+import time
+import threading
+
+# Each profile change is recorded as an empty object in the shared bucket so
+# that other functions' containers can drop stale cache entries for the user.
+# Keys sort chronologically: {prefix}{milliseconds since epoch}-{user pool sub}
+profile_changes_prefix = "user-profile-changes/"
+
+def record_profile_change(s3_client, s3_bucket_name, user_sub):
+
+    change_key = "{}{}-{}".format(
+        profile_changes_prefix,
+        get_timestamp_millis_string(time.time()),
+        user_sub
+    )
+
+    print("Recording profile change: s3://{}/{}".format(s3_bucket_name, change_key))
+
+    s3_client.put_object(
+        Bucket = s3_bucket_name,
+        Key = change_key,
+        Body = b""
+    )
+
+def get_timestamp_millis_string(timestamp):
+    return str(int(timestamp * 1000)).zfill(13)
+
+class ProfileChangeWatcher(object):
+    """Polls the shared bucket for recorded profile changes at most once every
+    poll_interval_seconds and returns the user pool subs that changed since the
+    last poll.
+
+    Changes are looked up starting clock_skew_seconds before the last poll, so
+    a sub may be reported more than once. Invalidating a cache entry twice is
+    harmless.
+
+    """
+
+    def __init__(self, s3_client, s3_bucket_name, poll_interval_seconds = 10, clock_skew_seconds = 30):
+        self.s3_client = s3_client
+        self.s3_bucket_name = s3_bucket_name
+        self.poll_interval_seconds = poll_interval_seconds
+        self.clock_skew_seconds = clock_skew_seconds
+
+        # Anything recorded before this container started can't be cached yet.
+        self._last_poll_time = time.time()
+        self._lock = threading.Lock()
+
+    def poll(self):
+
+        with self._lock:
+            poll_time = time.time()
+
+            if poll_time - self._last_poll_time < self.poll_interval_seconds:
+                return []
+
+            start_after_key = "{}{}".format(
+                profile_changes_prefix,
+                get_timestamp_millis_string(self._last_poll_time - self.clock_skew_seconds)
+            )
+
+            self._last_poll_time = poll_time
+
+        response_iterator = self.s3_client.get_paginator("list_objects_v2").paginate(
+            Bucket = self.s3_bucket_name,
+            Prefix = profile_changes_prefix,
+            StartAfter = start_after_key
+        )
+
+        changed_subs = set()
+
+        for each_response in response_iterator:
+            for each_object_dict in each_response.get("Contents", []):
+                each_filename = each_object_dict["Key"][len(profile_changes_prefix):]
+                changed_subs.add("-".join(each_filename.split("-")[1:]))
+
+        return list(changed_subs)
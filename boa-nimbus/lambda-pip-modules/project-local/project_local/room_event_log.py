@@ -0,0 +1,800 @@
+"""Room event log storage layout and compaction.
+
+Room events are stored under room-event-logs/{room-id}/ in the shared bucket:
+ * reverse/          One JSON object per event, keyed newest first.
+ * forward/          Empty pointers to reverse/ objects, keyed oldest first.
+                     No longer written, but removed by compaction.
+ * segments/         NDJSON objects grouping events per time bucket, keyed
+                     newest bucket first.
+ * segments-forward/ An empty pointer to each segment, keyed oldest bucket
+                     first.
+ * compacted/        Gzip-compressed NDJSON chunks written by compaction, plus
+                     an index.json describing them.
+
+S3 only lists keys in ascending order, so the segment pointers are what allow
+reading an open room's segments from the start. reverse/ objects have no
+pointers, which would double the PUTs per event. Forward reads list the
+reverse/ keys newer than the cursor instead, at one LIST per 1000 keys.
+
+Compaction merges all of a room's events into sorted (newest first) chunks.
+Each chunk is a series of independently decompressible gzip members of up to
+events_per_block events. The index lists every block with its reverse
+timestamp range, chunk key, byte offset, and length, so any page of history
+can be read with a single ranged GET.
+
+RoomEventLogReader reads pages of history from any mix of these layouts.
+
+Can also be run locally:
+
+    python -m project_local.room_event_log --bucket my-shared-bucket ROOM_ID
+
+"""
+
+from __future__ import print_function
+
+import io
+import gzip
+import heapq
+import json
+import uuid
+import argparse
+import itertools
+import botocore
+
+room_event_logs_prefix = "room-event-logs/"
+
+compacted_index_filename = "index.json"
+
+default_events_per_block = 50
+default_blocks_per_chunk = 200
+
+def get_reverse_lexi_string_for_timestamp(timestamp):
+    timestamp_string = str(timestamp).zfill(10)
+
+    character_list = []
+
+    for each_character in timestamp_string:
+        new_character = 9 - int(each_character)
+        character_list.append(str(new_character))
+
+    return "".join(character_list)
+
+def get_event_sort_key(event_object):
+    """Events sort newest first, then by message ID, matching the order of
+    their keys under reverse/.
+
+    """
+    return (get_reverse_lexi_string_for_timestamp(event_object["timestamp"]), event_object["message-id"])
+
+def get_forward_event_sort_key(event_object):
+    """Events sort oldest first, then by message ID.
+
+    """
+    return (str(event_object["timestamp"]).zfill(10), event_object["message-id"])
+
+def get_room_prefix(room_id):
+    return "{}{}/".format(room_event_logs_prefix, room_id)
+
+def get_compacted_index_key(room_id):
+    return "{}compacted/{}".format(get_room_prefix(room_id), compacted_index_filename)
+
+def get_reverse_key(room_id, timestamp, message_id):
+    return "{}reverse/{}-{}-{}.json".format(
+        get_room_prefix(room_id),
+        get_reverse_lexi_string_for_timestamp(timestamp),
+        timestamp,
+        message_id
+    )
+
+def get_segment_forward_pointer_key(room_id, bucket_end, segment_key):
+    # Every event in the segment is no later than the end of its bucket.
+    return "{}segments-forward/{}-{}".format(
+        get_room_prefix(room_id),
+        str(bucket_end).zfill(10),
+        segment_key.split("/")[-1]
+    )
+
+def get_segment_key_for_forward_pointer(room_id, segment_forward_pointer_key):
+    return "{}segments/{}".format(
+        get_room_prefix(room_id),
+        segment_forward_pointer_key.split("/")[-1].split("-", 1)[1]
+    )
+
+def get_message_id_from_reverse_key(key):
+    each_filename = key.split("/")[-1]
+    filename_parts = each_filename.split("-")
+
+    return "-".join(filename_parts[2:]).split(".")[0]
+
+def list_keys(s3_client, s3_bucket_name, prefix):
+
+    response_iterator = s3_client.get_paginator("list_objects_v2").paginate(
+        Bucket = s3_bucket_name,
+        Prefix = prefix
+    )
+
+    key_list = []
+
+    for each_response in response_iterator:
+        for each_object_dict in each_response.get("Contents", []):
+            key_list.append(each_object_dict["Key"])
+
+    return key_list
+
+def decompress_block(block_bytes):
+    """Returns the contents of one or more consecutive gzip members."""
+
+    # Python 2's GzipFile reads through concatenated members as well.
+    with gzip.GzipFile(fileobj=io.BytesIO(block_bytes), mode="rb") as f:
+        return f.read()
+
+def parse_ndjson(body_bytes):
+    return list(json.loads(x) for x in body_bytes.decode("utf-8").split("\n") if x != "")
+
+def decode_block(block_bytes):
+    return parse_ndjson(decompress_block(block_bytes))
+
+def encode_block(event_list):
+
+    block_buffer = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=block_buffer, mode="wb", mtime=0) as f:
+        for each_event in event_list:
+            f.write("{}\n".format(json.dumps(each_event, sort_keys=True)).encode("utf-8"))
+
+    return block_buffer.getvalue()
+
+def load_compacted_index(fetch_executor, s3_bucket_name, room_id):
+
+    try:
+        return json.loads(fetch_executor.get_object_body(s3_bucket_name, get_compacted_index_key(room_id)).decode("utf-8"))
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        else:
+            raise
+
+def iter_in_batches(fetch_executor, function, items, batch_size):
+    """Yields function(x) for each item, in order, running a batch of calls
+    at a time on the executor.
+
+    """
+
+    for i in range(0, len(items), batch_size):
+        for each_result in fetch_executor.map(function, items[i:i + batch_size]):
+            yield each_result
+
+def iter_reverse_object_events(fetch_executor, s3_bucket_name, reverse_keys):
+    # Keys are listed in the same order as get_event_sort_key.
+
+    def read_reverse_object(key):
+        event_object = json.loads(fetch_executor.get_object_body(s3_bucket_name, key).decode("utf-8"))
+        event_object["message-id"] = get_message_id_from_reverse_key(key)
+        return event_object
+
+    return iter_in_batches(fetch_executor, read_reverse_object, reverse_keys, fetch_executor.max_workers * 10)
+
+def iter_segment_events(fetch_executor, s3_bucket_name, segment_keys):
+    # Segments of the same time bucket can overlap (and repeat events that
+    # were delivered more than once), but buckets don't overlap each other. So
+    # only one bucket's events need to be sorted at a time.
+    bucket_key_lists = list(list(x[1]) for x in itertools.groupby(
+        segment_keys,
+        key = lambda x: x.split("/")[-1].split("-")[0]
+    ))
+
+    def read_bucket(key_list):
+        event_map = {}
+
+        for each_key in key_list:
+            for each_event in parse_ndjson(fetch_executor.get_object_body(s3_bucket_name, each_key)):
+                event_map[each_event["message-id"]] = each_event
+
+        return sorted(event_map.values(), key=get_event_sort_key)
+
+    for each_event_list in iter_in_batches(fetch_executor, read_bucket, bucket_key_lists, fetch_executor.max_workers):
+        for each_event in each_event_list:
+            yield each_event
+
+def iter_compacted_events(fetch_executor, s3_bucket_name, compacted_keys):
+    # Chunks hold consecutive runs of blocks, so reading them in index order
+    # yields events in order.
+    for each_key in compacted_keys:
+        for each_event in decode_block(fetch_executor.get_object_body(s3_bucket_name, each_key)):
+            yield each_event
+
+def iter_merged_room_events(event_iterators):
+    """Merges sorted event iterators into a single sorted iterator, skipping
+    repeats of the same message ID.
+
+    """
+
+    def iter_decorated(event_iterator, iterator_index):
+        # The iterator index breaks ties between copies of the same event so
+        # the events themselves are never compared.
+        for each_event in event_iterator:
+            yield (get_event_sort_key(each_event), iterator_index, each_event)
+
+    last_message_id = None
+
+    for _, _, each_event in heapq.merge(*list(iter_decorated(x, i) for i, x in enumerate(event_iterators))):
+
+        # Copies of an event sort next to each other. Events can be present in
+        # more than one layout if an earlier compaction was interrupted.
+        if each_event["message-id"] == last_message_id:
+            continue
+
+        last_message_id = each_event["message-id"]
+
+        yield each_event
+
+def delete_keys(s3_client, s3_bucket_name, key_list):
+
+    for i in range(0, len(key_list), 1000):
+        s3_client.delete_objects(
+            Bucket = s3_bucket_name,
+            Delete = {
+                "Objects": list({"Key": x} for x in key_list[i:i + 1000]),
+                "Quiet": True
+            }
+        )
+
+def compact_room_event_log(fetch_executor, s3_bucket_name, room_id, events_per_block = default_events_per_block, blocks_per_chunk = default_blocks_per_chunk):
+    """Rewrites all of a room's events into compacted chunks and an index, then
+    deletes the objects they were read from.
+
+    Events are streamed from each layout in sorted order and written out a
+    chunk at a time, so only the keys and the chunk being built (plus the one
+    being uploaded) are held in memory.
+
+    Safe to run again (e.g. if late events arrive after the first run). Each
+    run writes a new generation of chunks and replaces the index before
+    deleting the previous generation.
+
+    """
+
+    s3_client = fetch_executor.s3_client
+    room_prefix = get_room_prefix(room_id)
+
+    reverse_keys = list_keys(s3_client, s3_bucket_name, "{}reverse/".format(room_prefix))
+    segment_keys = list_keys(s3_client, s3_bucket_name, "{}segments/".format(room_prefix))
+
+    # Pointers carry no events, but are replaced by compaction too.
+    pointer_keys = list_keys(s3_client, s3_bucket_name, "{}forward/".format(room_prefix))
+    pointer_keys.extend(list_keys(s3_client, s3_bucket_name, "{}segments-forward/".format(room_prefix)))
+
+    old_index = load_compacted_index(fetch_executor, s3_bucket_name, room_id)
+    old_chunk_keys = []
+
+    if old_index is not None:
+        for each_block in old_index["blocks"]:
+            if each_block["key"] not in old_chunk_keys[-1:]:
+                old_chunk_keys.append(each_block["key"])
+
+    loose_keys = reverse_keys + segment_keys + pointer_keys
+
+    print("Found {} loose object(s) and {} compacted chunk(s).".format(len(loose_keys), len(old_chunk_keys)))
+
+    event_iterator = iter_merged_room_events([
+        iter_reverse_object_events(fetch_executor, s3_bucket_name, reverse_keys),
+        iter_segment_events(fetch_executor, s3_bucket_name, segment_keys),
+        iter_compacted_events(fetch_executor, s3_bucket_name, old_chunk_keys)
+    ])
+
+    generation = uuid.uuid4().hex
+    block_index_list = []
+    chunk_count = 0
+    event_count = 0
+
+    def put_chunk(chunk_key, chunk_body):
+        s3_client.put_object(
+            Bucket = s3_bucket_name,
+            Key = chunk_key,
+            Body = chunk_body,
+            ContentType = "application/x-ndjson",
+            ContentEncoding = "gzip"
+        )
+
+    pending_put = None
+
+    while True:
+        chunk_key = "{}compacted/{}/chunk-{}.ndjson.gz".format(
+            room_prefix,
+            generation,
+            str(chunk_count).zfill(6)
+        )
+
+        chunk_buffer = io.BytesIO()
+
+        for _ in range(blocks_per_chunk):
+            block_events = list(itertools.islice(event_iterator, events_per_block))
+
+            if len(block_events) == 0:
+                break
+
+            block_bytes = encode_block(block_events)
+
+            block_index_list.append({
+                "start": get_reverse_lexi_string_for_timestamp(block_events[0]["timestamp"]),
+                "end": get_reverse_lexi_string_for_timestamp(block_events[-1]["timestamp"]),
+                "key": chunk_key,
+                "offset": chunk_buffer.tell(),
+                "length": len(block_bytes),
+                "count": len(block_events)
+            })
+
+            chunk_buffer.write(block_bytes)
+            event_count += len(block_events)
+
+        if chunk_buffer.tell() == 0:
+            break
+
+        # Upload each chunk while the next one is built, but no further ahead.
+        if pending_put is not None:
+            pending_put.get()
+
+        pending_put = fetch_executor.pool.apply_async(put_chunk, (chunk_key, chunk_buffer.getvalue()))
+        chunk_count += 1
+
+    if pending_put is not None:
+        pending_put.get()
+
+    if event_count == 0:
+        return None
+
+    compacted_index = {
+        "version": "1",
+        "event-count": event_count,
+        "blocks": block_index_list
+    }
+
+    s3_client.put_object(
+        Bucket = s3_bucket_name,
+        Key = get_compacted_index_key(room_id),
+        Body = json.dumps(compacted_index),
+        ContentType = "application/json"
+    )
+
+    delete_keys(s3_client, s3_bucket_name, loose_keys + old_chunk_keys)
+
+    print("Compacted {} event(s) into {} chunk(s) of {} block(s).".format(
+        event_count,
+        chunk_count,
+        len(block_index_list)
+    ))
+
+    return compacted_index
+
+def get_constant_reader(event_list):
+    return lambda: event_list
+
+class CompactedBlockSource(object):
+    """Selects blocks from a compacted index, starting at the cursor, and
+    reads consecutive blocks of the same chunk with a single ranged GET.
+
+    """
+
+    def __init__(self, reader, compacted_index, cursor, direction):
+        self.reader = reader
+        self.blocks = compacted_index["blocks"] if compacted_index is not None else []
+        self.next_position = len(self.blocks)
+
+        reverse_cursor_string = get_reverse_lexi_string_for_timestamp(cursor[0])
+
+        if direction == "forward":
+            self.blocks = self.blocks[::-1]
+
+        for i, each_block in enumerate(self.blocks):
+            if direction == "forward":
+                # Has events no older than the cursor.
+                is_start_block = each_block["start"] <= reverse_cursor_string
+            else:
+                # Has events no newer than the cursor.
+                is_start_block = each_block["end"] >= reverse_cursor_string
+
+            if is_start_block:
+                self.next_position = i
+                break
+
+    def is_exhausted(self):
+        return self.next_position >= len(self.blocks)
+
+    def take(self, needed_count):
+        selected_blocks = []
+        selected_count = 0
+
+        while not self.is_exhausted() and selected_count < needed_count:
+            each_block = self.blocks[self.next_position]
+            selected_blocks.append(each_block)
+            selected_count += each_block["count"]
+            self.next_position += 1
+
+        return self.reader.get_block_readers(selected_blocks)
+
+class SegmentSource(object):
+    """Selects segments from a listing of the room's segments in the order to
+    be read. Events within a time bucket can be split across segments in any
+    order, so whole buckets are always taken at once.
+
+    Event counts in segment keys include events redelivered into more than
+    one segment, so they can overstate what a bucket holds. The reader counts
+    what each source actually contributed and takes more if that falls short.
+
+    """
+
+    def __init__(self, reader, key_iterator):
+        self.reader = reader
+        self.key_iterator = key_iterator
+        self.pending_key = next(self.key_iterator, None)
+
+    def is_exhausted(self):
+        return self.pending_key is None
+
+    def take(self, needed_count):
+        selected_keys = []
+        selected_count = 0
+        last_bucket_string = None
+
+        while not self.is_exhausted():
+            filename_parts = self.pending_key.split("/")[-1].split("-")
+
+            if selected_count >= needed_count and filename_parts[0] != last_bucket_string:
+                break
+
+            selected_keys.append(self.pending_key)
+            selected_count += int(filename_parts[3])
+            last_bucket_string = filename_parts[0]
+
+            self.pending_key = next(self.key_iterator, None)
+
+        return list(self.reader.get_segment_reader(x) for x in selected_keys)
+
+class RoomEventLogReader(object):
+    """Reads pages of a room's event log, either newest first ("reverse") or
+    oldest first ("forward").
+
+    A room's events may be in any mix of the reverse/, segments/, and
+    compacted/ layouts (e.g. while compaction is in progress), so all three are
+    consulted. Forward reads find segments through their pointers, and list
+    the reverse/ objects newer than the cursor. The compacted index is read in either order. Listings and the
+    compacted index are requested concurrently, then only the objects and
+    byte ranges needed for the page are fetched concurrently.
+
+    Requests are made with the given S3FetchExecutor, so a reader is meant to
+    live at module level. Compacted indexes are kept in index_cache if one is
+    given. Everything else it reads never changes once written, so parsed
+    events are kept in object_cache (a ByteBoundedLRUCache) if one is given,
+    keyed by S3 key (and offset, for compacted blocks).
+
+    """
+
+    def __init__(self, fetch_executor, s3_bucket_name, index_cache = None, object_cache = None):
+        self.fetch_executor = fetch_executor
+        self.s3_bucket_name = s3_bucket_name
+        self.index_cache = index_cache
+        self.object_cache = object_cache
+
+    def get_compacted_index(self, room_id):
+
+        cached_entry = None
+
+        get_object_kwargs = {
+            "Bucket": self.s3_bucket_name,
+            "Key": get_compacted_index_key(room_id)
+        }
+
+        # A room can be compacted again (e.g. after late events), replacing
+        # the chunks its index points to, so a cached index is revalidated on
+        # each read. This runs alongside the listings, so it costs no time.
+        if self.index_cache is not None:
+            cached_entry = self.index_cache.get(room_id)
+
+            if cached_entry is not None:
+                get_object_kwargs["IfNoneMatch"] = cached_entry[0]
+
+        try:
+            response = self.fetch_executor.s3_client.get_object(**get_object_kwargs)
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response["Error"]["Code"]
+
+            if error_code in ["304", "NotModified"] and cached_entry is not None:
+                return cached_entry[1]
+            elif error_code in ["NoSuchKey", "404"]:
+                return None
+            else:
+                raise
+
+        compacted_index = json.loads(response["Body"].read().decode("utf-8"))
+
+        if self.index_cache is not None:
+            self.index_cache.put(room_id, (response["ETag"], compacted_index))
+
+        return compacted_index
+
+    def iter_keys(self, prefix, start_after, max_keys = 1000):
+
+        list_objects_kwargs = {
+            "Bucket": self.s3_bucket_name,
+            "Prefix": prefix,
+            "StartAfter": start_after,
+            "MaxKeys": max_keys
+        }
+
+        while True:
+            response = self.fetch_executor.s3_client.list_objects_v2(**list_objects_kwargs)
+
+            for each_object_dict in response.get("Contents", []):
+                yield each_object_dict["Key"]
+
+            if not response.get("IsTruncated", False):
+                break
+
+            list_objects_kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def list_segment_keys(self, room_id, cursor, direction):
+
+        if direction == "forward":
+            pointer_prefix = "{}segments-forward/".format(get_room_prefix(room_id))
+
+            # Pointer keys start with their bucket's end, which is never less
+            # than the timestamps of the events in it.
+            key_iterator = (get_segment_key_for_forward_pointer(room_id, x) for x in self.iter_keys(
+                pointer_prefix,
+                "{}{}".format(pointer_prefix, str(cursor[0]).zfill(10))
+            ))
+        else:
+            segment_prefix = "{}segments/".format(get_room_prefix(room_id))
+
+            # Segment keys start with their bucket's reverse timestamp, which is
+            # never less than that of the events in it.
+            key_iterator = self.iter_keys(
+                segment_prefix,
+                "{}{}".format(segment_prefix, get_reverse_lexi_string_for_timestamp(cursor[0]))
+            )
+
+        # Make the first request now so it runs alongside the other listings.
+        first_key = next(key_iterator, None)
+
+        if first_key is None:
+            return iter([])
+
+        return itertools.chain([first_key], key_iterator)
+
+    def list_reverse_keys(self, room_id, cursor, max_keys, direction):
+
+        reverse_prefix = "{}reverse/".format(get_room_prefix(room_id))
+
+        if direction == "forward":
+            # Events newer than the cursor are listed first, so they're all
+            # listed and the oldest of them kept.
+            reverse_cursor_string = get_reverse_lexi_string_for_timestamp(cursor[0])
+
+            cursor_key = get_forward_event_sort_key({
+                "timestamp": cursor[0],
+                "message-id": cursor[1] or ""
+            })
+
+            sort_key_list = []
+
+            for each_key in self.iter_keys(reverse_prefix, reverse_prefix):
+                filename_parts = each_key.split("/")[-1].split("-")
+
+                if filename_parts[0] > reverse_cursor_string:
+                    break
+
+                each_sort_key = (filename_parts[1].zfill(10), get_message_id_from_reverse_key(each_key), each_key)
+
+                if each_sort_key[:2] > cursor_key:
+                    sort_key_list.append(each_sort_key)
+
+            return list(x[2] for x in sorted(sort_key_list)[:max_keys])
+
+        if cursor[1] is None:
+            start_after = "{}{}-".format(
+                reverse_prefix,
+                get_reverse_lexi_string_for_timestamp(cursor[0])
+            )
+        else:
+            start_after = "{}{}-{}-{}.json".format(
+                reverse_prefix,
+                get_reverse_lexi_string_for_timestamp(cursor[0]),
+                cursor[0],
+                cursor[1]
+            )
+
+        return list(itertools.islice(self.iter_keys(reverse_prefix, start_after, max_keys), max_keys))
+
+    def get_cached_events(self, cache_key):
+        if self.object_cache is None:
+            return None
+
+        return self.object_cache.get(cache_key)
+
+    def put_cached_events(self, cache_key, event_list, size):
+        if self.object_cache is not None:
+            self.object_cache.put(cache_key, event_list, size)
+
+    def get_block_readers(self, block_list):
+        """Returns readers for the given compacted blocks. Cached blocks are
+        read from memory, and each run of uncached blocks that are adjacent in
+        the same chunk is read with one ranged GET.
+
+        """
+
+        reader_list = []
+        uncached_runs = []
+
+        for each_block in sorted(block_list, key=lambda x: (x["key"], x["offset"])):
+            cache_key = "{}@{}".format(each_block["key"], each_block["offset"])
+            event_list = self.get_cached_events(cache_key)
+
+            if event_list is not None:
+                reader_list.append(get_constant_reader(event_list))
+            elif len(uncached_runs) > 0 and uncached_runs[-1][-1]["key"] == each_block["key"] and uncached_runs[-1][-1]["offset"] + uncached_runs[-1][-1]["length"] == each_block["offset"]:
+                uncached_runs[-1].append(each_block)
+            else:
+                uncached_runs.append([each_block])
+
+        reader_list.extend(self.get_block_range_reader(x) for x in uncached_runs)
+
+        return reader_list
+
+    def get_block_range_reader(self, block_list):
+        def read_block_range():
+            start_offset = block_list[0]["offset"]
+            end_offset = block_list[-1]["offset"] + block_list[-1]["length"]
+
+            range_bytes = self.fetch_executor.get_object_body(self.s3_bucket_name, block_list[0]["key"], (start_offset, end_offset))
+
+            event_list = []
+
+            for each_block in block_list:
+                block_position = each_block["offset"] - start_offset
+                block_body = decompress_block(range_bytes[block_position:block_position + each_block["length"]])
+                block_event_list = parse_ndjson(block_body)
+
+                self.put_cached_events("{}@{}".format(each_block["key"], each_block["offset"]), block_event_list, len(block_body))
+
+                event_list.extend(block_event_list)
+
+            return event_list
+        return read_block_range
+
+    def get_segment_reader(self, key):
+        def read_segment():
+            event_list = self.get_cached_events(key)
+
+            if event_list is None:
+                body = self.fetch_executor.get_object_body(self.s3_bucket_name, key)
+                event_list = parse_ndjson(body)
+                self.put_cached_events(key, event_list, len(body))
+
+            return event_list
+        return read_segment
+
+    def get_reverse_object_reader(self, key):
+        def read_reverse_object():
+            event_list = self.get_cached_events(key)
+
+            if event_list is None:
+                body = self.fetch_executor.get_object_body(self.s3_bucket_name, key)
+                event_object = json.loads(body.decode("utf-8"))
+                event_object["message-id"] = get_message_id_from_reverse_key(key)
+                event_list = [event_object]
+                self.put_cached_events(key, event_list, len(body))
+
+            return event_list
+        return read_reverse_object
+
+    def read_page(self, room_id, cursor, limit, direction = "reverse"):
+        """Returns up to limit events past the cursor in the given direction,
+        in that order, and whether more events exist beyond them.
+
+        The cursor is a (timestamp, message ID) tuple identifying the last event
+        already returned. With a message ID of None, events at the cursor's
+        timestamp are included.
+
+        """
+
+        try:
+            return self._read_page(room_id, cursor, limit, direction)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ["NoSuchKey", "404"] or self.index_cache is None:
+                raise
+
+            # The room was compacted again while this page was being read.
+            print("Compacted chunk not found. Retrying with a fresh index.")
+            self.index_cache.invalidate(room_id)
+
+            return self._read_page(room_id, cursor, limit, direction)
+
+    def _read_page(self, room_id, cursor, limit, direction):
+
+        if direction == "forward":
+            sort_key_function = get_forward_event_sort_key
+        else:
+            sort_key_function = get_event_sort_key
+
+        cursor_key = sort_key_function({
+            "timestamp": cursor[0],
+            "message-id": cursor[1] or ""
+        })
+
+        # One extra event tells whether the page is truncated.
+        wanted_count = limit + 1
+
+        compacted_index, segment_key_iterator, reverse_keys = self.fetch_executor.map(lambda f: f(), [
+            lambda: self.get_compacted_index(room_id),
+            lambda: self.list_segment_keys(room_id, cursor, direction),
+            lambda: self.list_reverse_keys(room_id, cursor, wanted_count, direction)
+        ])
+
+        sources = [
+            CompactedBlockSource(self, compacted_index, cursor, direction),
+            SegmentSource(self, segment_key_iterator)
+        ]
+
+        # Message IDs each source has contributed. Counted by ID, since the same
+        # event can be read from more than one segment.
+        source_message_id_sets = list(set() for x in sources)
+        event_map = {}
+
+        tagged_readers = list((None, self.get_reverse_object_reader(x)) for x in reverse_keys)
+
+        for i, each_source in enumerate(sources):
+            tagged_readers.extend((i, x) for x in each_source.take(wanted_count))
+
+        fetch_count = 0
+
+        # Each source must contribute its first wanted_count eligible events (or
+        # all of them). Events near the cursor may be ineligible, so a source
+        # occasionally needs a second round.
+        while len(tagged_readers) > 0:
+            fetch_count += len(tagged_readers)
+
+            event_lists = self.fetch_executor.map(lambda x: x[1](), tagged_readers)
+
+            for (source_index, _), each_event_list in zip(tagged_readers, event_lists):
+                for each_event in each_event_list:
+                    if sort_key_function(each_event) <= cursor_key:
+                        continue
+
+                    if source_index is not None:
+                        source_message_id_sets[source_index].add(each_event["message-id"])
+
+                    event_map[each_event["message-id"]] = each_event
+
+            tagged_readers = []
+
+            for i, each_source in enumerate(sources):
+                source_event_count = len(source_message_id_sets[i])
+
+                if not each_source.is_exhausted() and source_event_count < wanted_count:
+                    tagged_readers.extend((i, x) for x in each_source.take(wanted_count - source_event_count))
+
+        print("Read {} object(s), range(s), or cached item(s) for {} event(s).".format(fetch_count, len(event_map)))
+
+        event_list = sorted(event_map.values(), key=sort_key_function)
+
+        return event_list[:limit], len(event_list) > limit
+
+def main():
+    from project_local.s3_fetch import S3FetchExecutor
+
+    parser = argparse.ArgumentParser(
+        description="Compacts a room's event log in the shared bucket."
+    )
+    parser.add_argument("--bucket", required=True, help="Name of the shared S3 bucket.")
+    parser.add_argument("--events-per-block", type=int, default=default_events_per_block)
+    parser.add_argument("--blocks-per-chunk", type=int, default=default_blocks_per_chunk)
+    parser.add_argument("room_id", nargs="+", help="ID(s) of the room(s) to compact.")
+    args = parser.parse_args()
+
+    fetch_executor = S3FetchExecutor()
+
+    for each_room_id in args.room_id:
+        print("Compacting room: {}".format(each_room_id))
+        compact_room_event_log(fetch_executor, args.bucket, each_room_id, args.events_per_block, args.blocks_per_chunk)
+
+if __name__ == "__main__":
+    main()
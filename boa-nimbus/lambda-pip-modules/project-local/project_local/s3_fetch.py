@@ -0,0 +1,49 @@
+from __future__ import print_function
+
+from multiprocessing.pool import ThreadPool
+import boto3
+import botocore.config
+
+class S3FetchExecutor(object):
+    """An S3 client and worker pool for fetching many objects in parallel.
+
+    Meant to be created once per container at module level. Creating a session
+    and client per object costs credential and endpoint resolution plus a new
+    connection each time. Here, the client is shared by all workers (boto3
+    clients are thread-safe) and its connection pool is sized to match them so
+    no worker waits on or discards a connection.
+
+    Results are returned in the order requested rather than collected in
+    shared state, so concurrent callers can't see each other's results.
+
+    """
+
+    def __init__(self, max_workers = 10, **client_kwargs):
+        self.max_workers = max_workers
+
+        self.s3_client = boto3.client(
+            "s3",
+            config = botocore.config.Config(max_pool_connections=max_workers),
+            **client_kwargs
+        )
+
+        self.pool = ThreadPool(processes=max_workers)
+
+    def map(self, function, items):
+        return self.pool.map(function, items)
+
+    def get_object_body(self, s3_bucket_name, key, byte_range = None):
+
+        get_object_kwargs = {
+            "Bucket": s3_bucket_name,
+            "Key": key
+        }
+
+        # Ranges are given as (start, end) with an exclusive end.
+        if byte_range is not None:
+            get_object_kwargs["Range"] = "bytes={}-{}".format(byte_range[0], byte_range[1] - 1)
+
+        return self.s3_client.get_object(**get_object_kwargs)["Body"].read()
+
+    def get_object_bodies(self, s3_bucket_name, key_list):
+        return self.map(lambda x: self.get_object_body(s3_bucket_name, x), key_list)
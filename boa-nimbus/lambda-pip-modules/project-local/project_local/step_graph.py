@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+import time
+import threading
+from collections import OrderedDict
+
+class StepGraphError(Exception):
+    """Raised by StepGraph.run when a step fails.
+
+    Created resources have already been rolled back by the time it's raised.
+    The failing step's name and exception are kept so callers can report them.
+
+    """
+
+    def __init__(self, step_name, exception):
+        super(StepGraphError, self).__init__("Step \"{}\" failed: {}".format(step_name, exception))
+        self.step_name = step_name
+        self.exception = exception
+
+class StepGraph(object):
+    """A small set of named steps with dependencies between them.
+
+    Each step is a function that takes a dict of the results of the steps it
+    depends on (keyed by step name) and returns its own result. Running the
+    graph starts every step as soon as its dependencies have finished, so
+    independent steps run concurrently on the given thread pool.
+
+    A step may also have a rollback function, which is called with the step's
+    result if any step in the graph fails. Rollbacks run in the reverse of the
+    order the steps finished in, after steps already running have finished.
+
+    Timings (in seconds) for each finished step are kept in step_timings.
+
+    """
+
+    def __init__(self):
+        self.steps = OrderedDict()
+        self.step_timings = OrderedDict()
+
+    def add_step(self, name, function, depends_on = (), rollback = None):
+
+        for each_dependency in depends_on:
+            if each_dependency not in self.steps:
+                raise ValueError("Step \"{}\" depends on unknown step \"{}\".".format(name, each_dependency))
+
+        self.steps[name] = {
+            "function": function,
+            "depends-on": tuple(depends_on),
+            "rollback": rollback
+        }
+
+    def run(self, pool):
+
+        results = {}
+        finished_step_names = []
+        running_step_names = set()
+        failure = None
+
+        condition = threading.Condition()
+        completions = []
+
+        def run_step(step_name, step_inputs):
+            start_time = time.time()
+
+            try:
+                result = self.steps[step_name]["function"](step_inputs)
+                exception = None
+            except Exception as e:
+                result = None
+                exception = e
+
+            with condition:
+                completions.append((step_name, result, exception, time.time() - start_time))
+                condition.notify()
+
+        def start_ready_steps():
+            for each_step_name, each_step in self.steps.items():
+                if each_step_name in results or each_step_name in running_step_names:
+                    continue
+
+                if not all(x in results for x in each_step["depends-on"]):
+                    continue
+
+                step_inputs = dict((x, results[x]) for x in each_step["depends-on"])
+
+                running_step_names.add(each_step_name)
+                pool.apply_async(run_step, (each_step_name, step_inputs))
+
+        with condition:
+            start_ready_steps()
+
+            while len(running_step_names) > 0:
+                while len(completions) == 0:
+                    condition.wait()
+
+                step_name, result, exception, elapsed_seconds = completions.pop(0)
+
+                running_step_names.discard(step_name)
+                self.step_timings[step_name] = elapsed_seconds
+
+                if exception is not None:
+                    if failure is None:
+                        failure = (step_name, exception)
+                    continue
+
+                results[step_name] = result
+                finished_step_names.append(step_name)
+
+                # Once a step has failed, only wait for those already running.
+                if failure is None:
+                    start_ready_steps()
+
+        if failure is not None:
+            self.roll_back(finished_step_names, results)
+            raise StepGraphError(*failure)
+
+        return results
+
+    def roll_back(self, finished_step_names, results):
+        for each_step_name in reversed(finished_step_names):
+            rollback = self.steps[each_step_name]["rollback"]
+
+            if rollback is None:
+                continue
+
+            try:
+                rollback(results[each_step_name])
+            except Exception as e:
+                # Keep rolling back the rest rather than leaving more behind.
+                print("Unable to roll back step \"{}\": {}".format(each_step_name, e))
+
+    def get_timings_summary(self):
+        return ", ".join("{}: {:.0f} ms".format(x, 1000 * y) for x, y in self.step_timings.items())
@@ -0,0 +1,180 @@
+from __future__ import print_function
+
+import hashlib
+import threading
+import botocore
+from project_local.cache import TTLCache
+
+class UserDirectory(object):
+    """Per-container cache of Cognito user lookups.
+
+    Users are looked up by Cognito identity ID (get_user) or by user pool sub
+    (get_user_by_sub). Either returns a dict with the user's "username",
+    "sub", "email-address", "email-verified" and "avatar-hash", or None if
+    there's no such user.
+
+    An identity always belongs to the same user pool user, so identity to sub
+    mappings are kept for longer than profiles. Profiles are keyed by sub and
+    dropped whenever the given ProfileChangeWatcher reports the sub changed
+    (e.g. after an e-mail address change).
+
+    Cognito calls made and avoided are counted for get_stats.
+
+    """
+
+    def __init__(self, cognito_idp_client, user_pool_id, cognito_sync_client = None, identity_pool_id = None, user_profile_dataset_name = None, profile_change_watcher = None, max_entries = 1024, profile_ttl_seconds = 300, identity_ttl_seconds = 3600):
+        self.cognito_idp_client = cognito_idp_client
+        self.user_pool_id = user_pool_id
+        self.cognito_sync_client = cognito_sync_client
+        self.identity_pool_id = identity_pool_id
+        self.user_profile_dataset_name = user_profile_dataset_name
+        self.profile_change_watcher = profile_change_watcher
+
+        self.cognito_calls_made = 0
+        self.cognito_calls_avoided = 0
+
+        self._identity_cache = TTLCache(max_entries, identity_ttl_seconds)
+        self._profile_cache = TTLCache(max_entries, profile_ttl_seconds)
+        self._lock = threading.Lock()
+
+    def get_user(self, identity_id):
+        self.poll_profile_changes()
+
+        user_sub = self._identity_cache.get(identity_id)
+
+        if user_sub is None:
+            user = self.fetch_user_by_identity(identity_id)
+
+            if user is None:
+                return None
+
+            self._identity_cache.put(identity_id, user["sub"])
+            self._profile_cache.put(user["sub"], user)
+
+            return user
+
+        self.count_cognito_calls(avoided = 1)
+
+        return self.get_user_by_sub(user_sub)
+
+    def get_user_by_sub(self, user_sub):
+        self.poll_profile_changes()
+
+        user = self._profile_cache.get(user_sub)
+
+        if user is None:
+            user = self.fetch_user_by_sub(user_sub)
+
+            if user is None:
+                return None
+
+            self._profile_cache.put(user_sub, user)
+        else:
+            self.count_cognito_calls(avoided = 1)
+
+        return user
+
+    def invalidate_sub(self, user_sub):
+        """Drops the cached profile for the given sub. Returns whether there
+        was one."""
+
+        return self._profile_cache.invalidate(user_sub)
+
+    def poll_profile_changes(self):
+        if self.profile_change_watcher is None:
+            return
+
+        for each_changed_sub in self.profile_change_watcher.poll():
+            if self.invalidate_sub(each_changed_sub):
+                print("Invalidated cached profile for changed user: {}".format(each_changed_sub))
+
+    def fetch_user_by_identity(self, identity_id):
+
+        self.count_cognito_calls(made = 1)
+
+        try:
+            response = self.cognito_sync_client.list_records(
+                IdentityPoolId = self.identity_pool_id,
+                IdentityId = identity_id,
+                DatasetName = self.user_profile_dataset_name
+            )
+        except botocore.exceptions.ClientError as e:
+            # Raised for identity IDs that aren't valid.
+            if e.response["Error"]["Code"] == "ValidationException":
+                return None
+            raise
+
+        for each_record in response.get("Records", []):
+            if each_record["Key"] == "user-id":
+                return self.fetch_user(each_record["Value"])
+
+        return None
+
+    def fetch_user(self, username):
+
+        self.count_cognito_calls(made = 1)
+
+        try:
+            response = self.cognito_idp_client.admin_get_user(
+                UserPoolId = self.user_pool_id,
+                Username = username
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "UserNotFoundException":
+                return None
+            raise
+
+        return get_user_from_attributes(response["Username"], response.get("UserAttributes", []))
+
+    def fetch_user_by_sub(self, user_sub):
+
+        self.count_cognito_calls(made = 1)
+
+        response = self.cognito_idp_client.list_users(
+            UserPoolId = self.user_pool_id,
+            AttributesToGet = ["email", "email_verified", "sub"],
+            Filter = "sub = \"{}\"".format(user_sub),
+            Limit = 1
+        )
+
+        if len(response.get("Users", [])) == 0:
+            return None
+
+        each_user = response["Users"][0]
+
+        return get_user_from_attributes(each_user["Username"], each_user.get("Attributes", []))
+
+    def count_cognito_calls(self, made = 0, avoided = 0):
+        with self._lock:
+            self.cognito_calls_made += made
+            self.cognito_calls_avoided += avoided
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "cognito-calls-made": self.cognito_calls_made,
+                "cognito-calls-avoided": self.cognito_calls_avoided,
+                "identities": self._identity_cache.get_stats(),
+                "profiles": self._profile_cache.get_stats()
+            }
+
+def get_user_from_attributes(username, attributes_list):
+
+    attributes = dict((x["Name"], x["Value"]) for x in attributes_list)
+
+    user_sub = attributes.get("sub")
+    email_address = attributes.get("email")
+
+    return {
+        "username": username,
+        "sub": user_sub,
+        "email-address": email_address,
+        "email-verified": attributes.get("email_verified", "false").lower() == "true",
+        "avatar-hash": get_avatar_hash(user_sub, email_address)
+    }
+
+def get_avatar_hash(user_sub, email_address):
+    """Returns a value that changes when the user's Gravatar URL should change
+    but isn't a plain MD5 hash of their e-mail address."""
+
+    return hashlib.md5(u"{}{}".format(user_sub, email_address).encode("utf-8")).hexdigest()
@@ -5,18 +5,31 @@ See http://philzimmermann.com/docs/human-oriented-base-32-encoding.txt
  
 Please note that scrip loads the data in memory.
  
+Encoding and decoding work on whole 5-byte (8-character) groups through
+precomputed tables of every pair of characters. 16-byte values (like UUIDs)
+have their own fixed-width encoder, since every room ID is one.
+ 
 Copyright: Tocho Tochev <tocho AT tochev DOT net>
 Licence: MIT
 """
  
 import argparse
-import functools
-import itertools
 import sys
  
  
 ALPTHABET = b"ybndrfg8ejkmcpqxot1uwisza345h769"
  
+# Every pair of characters, indexed by the 10 bits they encode.
+ENCODE_PAIRS = [bytes((x, y)) for x in ALPTHABET for y in ALPTHABET]
+ 
+# The 10 bits encoded by every valid pair of characters.
+DECODE_PAIRS = dict((x, i) for i, x in enumerate(ENCODE_PAIRS))
+ 
+# Number of bytes decoded from a final group of 0 to 7 characters.
+PARTIAL_GROUP_BYTE_COUNTS = (0, 0, 1, 1, 2, 3, 3, 4)
+ 
+UUID_BYTE_LENGTH = 16
+ 
  
 def encode(bs):
     """Encode bytes bs using zbase32 encoding.
@@ -27,12 +40,24 @@ def encode(bs):
     >>> encode(b'\\xd4z\\x04') == b'4t7ye'
     True
     """
+    bs = bytes(bs)
+    encoded_length = (len(bs) * 8 + 4) // 5
+ 
+    # Pad to whole groups, then trim the characters encoding only padding.
+    bs += bytes(-len(bs) % 5)
+ 
+    pairs = ENCODE_PAIRS
+    from_bytes = int.from_bytes
     result = bytearray()
-    for word in itertools.zip_longest(*([iter(bs)] * 5)):
-        padding_count = word.count(None)
-        n = functools.reduce(lambda x,y: (x<<8) + (y or 0), word, 0)
-        for i in range(0, (40 - 8 * padding_count), 5):
-            result.append(ALPTHABET[(n >> (35 - i)) & 0x1F])
+ 
+    for i in range(0, len(bs), 5):
+        n = from_bytes(bs[i:i + 5], "big")
+        result += pairs[n >> 30]
+        result += pairs[(n >> 20) & 0x3FF]
+        result += pairs[(n >> 10) & 0x3FF]
+        result += pairs[n & 0x3FF]
+ 
+    del result[encoded_length:]
     return result
  
  
@@ -44,23 +69,77 @@ def decode(bs):
     >>> decode(b'4t7ye') == b'\\xd4z\\x04'
     True
     """
+    bs = to_encoded_bytes(bs).translate(None, b"\r\n")
+    decoded_length = len(bs) // 8 * 5 + PARTIAL_GROUP_BYTE_COUNTS[len(bs) % 8]
+ 
+    # "y" encodes zero bits, so padding with it is the same as padding with
+    # nothing. The bytes decoded only from padding are trimmed.
+    bs += b"y" * (-len(bs) % 8)
+ 
+    pairs = DECODE_PAIRS
     result = bytearray()
-    reversed_alphabet = dict(map(reversed, enumerate(ALPTHABET)))
-    reversed_alphabet[None] = 0
-    bs = filter(lambda c: c not in b'\r\n', bs)
+ 
     try:
-        for word in itertools.zip_longest(*([iter(bs)] * 8)):
-            padding_count = word.count(None)
-            n = functools.reduce(lambda x,y: (x<<5) + reversed_alphabet[y],
-                       word,
-                       0)
-            for i in range(32, 5 * padding_count - 1, -8):
-                result.append((n >> i) & 0xFF)
+        for i in range(0, len(bs), 8):
+            n = (pairs[bs[i:i + 2]] << 30 | pairs[bs[i + 2:i + 4]] << 20 |
+                 pairs[bs[i + 4:i + 6]] << 10 | pairs[bs[i + 6:i + 8]])
+            result += n.to_bytes(5, "big")
     except KeyError:
         raise ValueError("The input does not seem to be valid zbase32.")
+ 
+    del result[decoded_length:]
     return result
  
  
+def b2a(bs):
+    """Encode bytes bs using zbase32 encoding.
+ 
+    Returns: str
+ 
+    >>> b2a(b'\\xd4z\\x04')
+    '4t7ye'
+    """
+    return encode(bs).decode("ascii")
+ 
+ 
+def a2b(s):
+    """Decode a zbase32 encoded str (or bytes).
+ 
+    Returns: bytes
+ 
+    >>> a2b('4t7ye')
+    b'\\xd4z\\x04'
+    """
+    return bytes(decode(s))
+ 
+ 
+def encode_uuid_bytes(bs):
+    """Encode exactly 16 bytes (e.g. uuid.UUID.bytes).
+ 
+    Returns: str of 26 characters, the same as b2a(bs)
+ 
+    >>> encode_uuid_bytes(bytes(16))
+    'yyyyyyyyyyyyyyyyyyyyyyyyyy'
+    """
+    if len(bs) != UUID_BYTE_LENGTH:
+        raise ValueError("Expected {} bytes.".format(UUID_BYTE_LENGTH))
+ 
+    # 128 bits and 2 bits of padding make 13 pairs of characters.
+    n = int.from_bytes(bs, "big") << 2
+    pairs = ENCODE_PAIRS
+ 
+    return b"".join([pairs[(n >> i) & 0x3FF] for i in range(120, -1, -10)]).decode("ascii")
+ 
+ 
+def to_encoded_bytes(s):
+    if isinstance(s, str):
+        try:
+            return s.encode("ascii")
+        except UnicodeEncodeError:
+            raise ValueError("The input does not seem to be valid zbase32.")
+    return bytes(s)
+ 
+ 
 def main():
     parser = argparse.ArgumentParser(
         description="zbase32 encoder and decoder"
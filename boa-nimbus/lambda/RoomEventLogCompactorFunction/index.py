@@ -0,0 +1,42 @@
+"""RoomEventLogCompactorFunction
+
+Compacts a closed room's event log into gzip-compressed NDJSON chunks with an 
+index of byte ranges, then removes the per-event objects and segments it 
+replaced. Invoked asynchronously by the room lifecycle handler once the room 
+has been cleaned up.
+
+"""
+
+from __future__ import print_function
+
+import os
+import json
+from project_local.room_event_log import compact_room_event_log
+from project_local.s3_fetch import S3FetchExecutor
+
+s3_fetch_executor = S3FetchExecutor(max_workers = 10)
+
+def lambda_handler(event, context):
+    print("Event: {}".format(json.dumps(event)))
+    
+    if "warming" in event and "{}".format(event["warming"]).lower() == "true":
+        return {
+            "message": "Warmed!"
+        }
+    
+    room_id = event["room-id"]
+    
+    compacted_index = compact_room_event_log(
+        s3_fetch_executor,
+        os.environ["SHARED_BUCKET"],
+        room_id
+    )
+    
+    if compacted_index is None:
+        print("No events found for room {}.".format(room_id))
+        return {}
+    
+    return {
+        "event-count": compacted_index["event-count"],
+        "block-count": len(compacted_index["blocks"])
+    }
@@ -9,6 +9,20 @@ When doing this, it also:
  * Sets the SNS topic to log success and failure content.
  * Creates a CloudWatch metric filter for the SNS message dwell time.
 
+Steps that don't depend on each other run concurrently, and anything already 
+created is removed again if a step fails. The room isn't announced as open 
+until every step has finished.
+
+If a room pool is configured, a room already set up this way is claimed from 
+the pool instead, so only its lifecycle needs to be started. The pool is kept 
+filled by room_pool_filler_handler, which runs on a schedule.
+
+A pooled room's lifecycle is started before its message is deleted from the 
+pool queue. If claiming fails in between, the message returns to the pool 
+after the queue's visibility timeout. The lifecycle execution is named after 
+the room, so the next claim finds it already started and just deletes the 
+message.
+
 """
 
 from __future__ import print_function
@@ -17,17 +31,29 @@ import os
 import json
 import uuid
 import time
+from multiprocessing.pool import ThreadPool
 import boto3
+import botocore
 import zbase32
 from apigateway_helpers.exception import APIGatewayException
 from apigateway_helpers.headers import get_response_headers
+from project_local.step_graph import StepGraph
 
 room_duration_seconds = 7200 # 7200 seconds == Two hours
 
+# Pooled rooms older than this are cleaned up instead of being claimed. Must be
+# less than the pool queue's message retention period.
+max_pooled_room_age_seconds = 604800 # 604800 seconds == One week
+
 sns_client = boto3.client("sns")
 sts_client = boto3.client("sts")
 logs_client = boto3.client("logs")
 sfn_client = boto3.client("stepfunctions")
+sqs_client = boto3.client("sqs")
+
+# Shared by all rooms being provisioned in this container, including those 
+# provisioned concurrently by the room pool filler.
+provisioning_pool = ThreadPool(processes=8)
 
 
 def lambda_handler(event, context):
@@ -38,36 +64,253 @@ def lambda_handler(event, context):
             "message": "Warmed!"
         }
     
-    room_log_event_processor_function_arn = os.environ["ROOM_LOG_EVENT_PROCESSOR_FUNCTION_ARN"]
+    pooled_room = claim_pooled_room()
+    
+    if pooled_room is not None:
+        new_room_id, room_config_object = pooled_room
+        print("Claimed pooled room: {}".format(new_room_id))
+        
+        # Its lifecycle was started when it was claimed.
+        publish_room_open_message(room_config_object)
+    else:
+        new_room_id = generate_new_room_id()
+        room_config_object = provision_room(new_room_id, event["requestContext"]["apiId"])
+        
+        open_room(new_room_id, room_config_object)
+    
+    return {
+        "id": new_room_id
+    }
+
+def room_pool_filler_handler(event, context):
+    print("Event: {}".format(json.dumps(event)))
+    
+    if "warming" in event and "{}".format(event["warming"]).lower() == "true":
+        return {
+            "message": "Warmed!"
+        }
+    
+    room_pool_size = int(os.environ.get("ROOM_POOL_SIZE", "0") or "0")
+    room_pool_queue_url = os.environ["ROOM_POOL_QUEUE_URL"]
+    
+    response = sqs_client.get_queue_attributes(
+        QueueUrl = room_pool_queue_url,
+        AttributeNames = [
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible"
+        ]
+    )
+    
+    # Rooms being claimed right now are counted as pooled, so this errs 
+    # toward filling slightly too few rather than too many.
+    pooled_room_count = sum(int(x) for x in response["Attributes"].values())
     
+    rooms_needed = room_pool_size - pooled_room_count
+    
+    print("Room pool has {} of {} room(s).".format(pooled_room_count, room_pool_size))
+    
+    if rooms_needed <= 0:
+        return {
+            "provisioned": 0
+        }
+    
+    pool = ThreadPool(processes=min(rooms_needed, 10))
+    
+    try:
+        pool.map(lambda x: add_room_to_pool(room_pool_queue_url), range(rooms_needed))
+    finally:
+        pool.close()
+        pool.join()
+    
+    print("Added {} room(s) to the pool.".format(rooms_needed))
+    
+    return {
+        "provisioned": rooms_needed
+    }
+
+def add_room_to_pool(room_pool_queue_url):
     new_room_id = generate_new_room_id()
+    room_config_object = provision_room(new_room_id, os.environ["WEB_CHAT_API_ID"])
+    
+    sqs_client.send_message(
+        QueueUrl = room_pool_queue_url,
+        MessageBody = json.dumps({
+            "id": new_room_id,
+            "config": room_config_object,
+            "provisioned": int(time.time())
+        }),
+        # A group per room lets rooms be claimed concurrently while each one 
+        # can only be received by a single claimer.
+        MessageGroupId = new_room_id,
+        MessageDeduplicationId = new_room_id
+    )
+
+def claim_pooled_room():
+    room_pool_queue_url = os.environ.get("ROOM_POOL_QUEUE_URL", "")
+    
+    if room_pool_queue_url == "":
+        return None
+    
+    while True:
+        response = sqs_client.receive_message(
+            QueueUrl = room_pool_queue_url,
+            MaxNumberOfMessages = 1,
+            WaitTimeSeconds = 0
+        )
+        
+        message_list = response.get("Messages", [])
+        
+        if len(message_list) == 0:
+            print("Room pool is empty.")
+            return None
+        
+        pooled_room = json.loads(message_list[0]["Body"])
+        
+        is_pooled_room_current = pooled_room["provisioned"] + max_pooled_room_age_seconds > time.time()
+        
+        if is_pooled_room_current:
+            lifecycle_duration_seconds = room_duration_seconds
+        else:
+            # Hand rooms that have waited too long to the lifecycle state 
+            # machine to be cleaned up right away, well before the pool queue 
+            # would drop them and leave their resources behind.
+            print("Retiring stale pooled room: {}".format(pooled_room["id"]))
+            lifecycle_duration_seconds = 0
+        
+        try:
+            start_room_lifecycle(pooled_room["id"], dict(pooled_room["config"], **{
+                "created": int(time.time()),
+                "duration": lifecycle_duration_seconds
+            }))
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "ExecutionAlreadyExists":
+                raise
+            
+            # An earlier claim got this far but its message was never deleted.
+            print("Pooled room {} was already claimed.".format(pooled_room["id"]))
+            is_pooled_room_current = False
+        
+        sqs_client.delete_message(
+            QueueUrl = room_pool_queue_url,
+            ReceiptHandle = message_list[0]["ReceiptHandle"]
+        )
+        
+        if is_pooled_room_current:
+            return pooled_room["id"], pooled_room["config"]
+
+def provision_room(new_room_id, api_id):
+    
+    room_log_event_processor_function_arn = os.environ["ROOM_LOG_EVENT_PROCESSOR_FUNCTION_ARN"]
     
     new_topic_name = generate_room_sns_topic_name(new_room_id)
+    sns_log_group_name = get_sns_cloudwatch_log_group_name(new_room_id)
     
-    sns_response = sns_client.create_topic(
-        Name = new_topic_name
-    )
+    step_graph = StepGraph()
     
-    topic_arn = sns_response["TopicArn"]
+    step_graph.add_step(
+        "create-topic",
+        lambda x: sns_client.create_topic(
+            Name = new_topic_name
+        )["TopicArn"],
+        rollback = lambda topic_arn: sns_client.delete_topic(
+            TopicArn = topic_arn
+        )
+    )
     
     topic_attributes_to_set = [
-        ("Policy", get_default_topic_policy(topic_arn)),
-        ("SQSFailureFeedbackRoleArn", os.environ["SNS_FAILURE_FEEDBACK_ROLE"]),
-        ("SQSSuccessFeedbackRoleArn", os.environ["SNS_SUCCESS_FEEDBACK_ROLE"])
+        ("Policy", lambda topic_arn: get_default_topic_policy(topic_arn)),
+        ("SQSFailureFeedbackRoleArn", lambda topic_arn: os.environ["SNS_FAILURE_FEEDBACK_ROLE"]),
+        ("SQSSuccessFeedbackRoleArn", lambda topic_arn: os.environ["SNS_SUCCESS_FEEDBACK_ROLE"])
     ]
     
-    for each_topic_attribute_tuple in topic_attributes_to_set:
+    for each_attribute_name, each_attribute_value_function in topic_attributes_to_set:
+        step_graph.add_step(
+            "set-topic-attribute-{}".format(each_attribute_name),
+            get_set_topic_attribute_function(each_attribute_name, each_attribute_value_function),
+            depends_on = ["create-topic"]
+        )
+    
+    if int(os.environ.get("ROOM_EVENT_LOG_SEGMENT_SECONDS", "0") or "0") > 0:
+        # Room events are delivered in batches through a queue so they can be 
+        # written to S3 as segments.
+        subscription_protocol = "sqs"
+        subscription_endpoint = os.environ["ROOM_LOG_EVENT_QUEUE_ARN"]
+    else:
+        subscription_protocol = "lambda"
+        subscription_endpoint = room_log_event_processor_function_arn
+    
+    # Subscriptions are removed along with the topic, so there's nothing 
+    # separate to roll back.
+    step_graph.add_step(
+        "subscribe",
+        lambda x: sns_client.subscribe(
+            TopicArn = x["create-topic"],
+            Protocol = subscription_protocol,
+            Endpoint = subscription_endpoint
+        ),
+        depends_on = ["create-topic"]
+    )
+    
+    step_graph.add_step(
+        "create-log-group",
+        lambda x: logs_client.create_log_group(
+            logGroupName = sns_log_group_name
+        ),
+        rollback = lambda x: logs_client.delete_log_group(
+            logGroupName = sns_log_group_name
+        )
+    )
+    
+    step_graph.add_step(
+        "put-metric-filter",
+        lambda x: logs_client.put_metric_filter(
+            logGroupName = sns_log_group_name,
+            filterName = "SNSRoomTopicDwellTime",
+            filterPattern = "{ $.delivery.dwellTimeMs > 0 }",
+            metricTransformations = [
+                {
+                    "metricName": "DwellTimeMs",
+                    "metricNamespace": "WebChat-{}".format(api_id),
+                    "metricValue": "$.delivery.dwellTimeMs"
+                }
+            ]
+        ),
+        depends_on = ["create-log-group"]
+    )
+    
+    try:
+        step_results = step_graph.run(provisioning_pool)
+    finally:
+        print("Room {} provisioning step timings: {}".format(new_room_id, step_graph.get_timings_summary()))
+    
+    return {
+        "sns-topic-arn": step_results["create-topic"],
+        "sns-log-group": sns_log_group_name
+    }
+
+def get_set_topic_attribute_function(attribute_name, attribute_value_function):
+    
+    def set_topic_attribute(step_inputs):
+        topic_arn = step_inputs["create-topic"]
+        
         sns_client.set_topic_attributes(
             TopicArn = topic_arn,
-            AttributeName = each_topic_attribute_tuple[0],
-            AttributeValue = each_topic_attribute_tuple[1]
+            AttributeName = attribute_name,
+            AttributeValue = attribute_value_function(topic_arn)
         )
     
-    sns_client.subscribe(
-        TopicArn = topic_arn,
-        Protocol = "lambda",
-        Endpoint = room_log_event_processor_function_arn
-    )
+    return set_topic_attribute
+
+def open_room(room_id, room_config_object):
+    
+    publish_room_open_message(room_config_object)
+    
+    start_room_lifecycle(room_id, dict(room_config_object, **{
+        "created": int(time.time()),
+        "duration": room_duration_seconds
+    }))
+
+def publish_room_open_message(room_config_object):
     
     message_object = {
         "identity-id": "SYSTEM",
@@ -78,54 +321,24 @@ def lambda_handler(event, context):
     }
     
     sns_client.publish(
-        TopicArn = topic_arn,
+        TopicArn = room_config_object["sns-topic-arn"],
         Message = json.dumps(message_object)
     )
-    
-    sns_log_group_name = get_sns_cloudwatch_log_group_name(event, new_room_id)
-    
-    logs_client.create_log_group(
-        logGroupName = sns_log_group_name
-    )
-    
-    logs_client.put_metric_filter(
-        logGroupName = sns_log_group_name,
-        filterName = "SNSRoomTopicDwellTime",
-        filterPattern = "{ $.delivery.dwellTimeMs > 0 }",
-        metricTransformations = [
-            {
-                "metricName": "DwellTimeMs",
-                "metricNamespace": "WebChat-{}".format(event["requestContext"]["apiId"]),
-                "metricValue": "$.delivery.dwellTimeMs"
-            }
-        ]
-    )
-    
-    created_timestamp_seconds = int(time.time())
-    
-    room_config_object = {
-        "created": created_timestamp_seconds,
-        "duration": room_duration_seconds,
-        "sns-topic-arn": topic_arn,
-        "sns-log-group": sns_log_group_name
-    }
+
+def start_room_lifecycle(room_id, room_config_object):
     
     room_lifecycle_state_machine_arn = os.environ["ROOM_LIFECYCLE_STATE_MACHINE_ARN"]
     
     response = sfn_client.start_execution(
         stateMachineArn = room_lifecycle_state_machine_arn,
-        name = new_room_id,
+        name = room_id,
         input = json.dumps({
-            "id": new_room_id,
+            "id": room_id,
             "config": room_config_object
         })
     )
     
     print("Room lifecycle state machine execution ARN: {}".format(response["executionArn"]))
-    
-    return {
-        "id": new_room_id
-    }
 
 def generate_room_sns_topic_name(room_id):
     return "{}-{}".format(
@@ -134,7 +347,7 @@ def generate_room_sns_topic_name(room_id):
     )
 
 def generate_new_room_id():
-    return zbase32.encode(uuid.uuid4().bytes).decode('utf-8') #zbase32.b2a(uuid.uuid4().bytes)
+    return zbase32.encode_uuid_bytes(uuid.uuid4().bytes)
 
 account_id = None
 def get_own_account_id():
@@ -145,7 +358,7 @@ def get_own_account_id():
     
     return account_id
 
-def get_sns_cloudwatch_log_group_name(event, room_id):
+def get_sns_cloudwatch_log_group_name(room_id):
     return "sns/{region}/{account_id}/{app_prefix}-{room_id}".format(
         region = os.environ["AWS_DEFAULT_REGION"],
         account_id = get_own_account_id(),
@@ -9,6 +9,8 @@ from __future__ import print_function
 import os
 import json
 import time
+import random
+from multiprocessing.pool import ThreadPool
 import boto3
 import botocore
 
@@ -16,10 +18,34 @@ import botocore
 # deleting its resources.
 inflight_wait_delay_seconds = 15
 
+# When room events are batched through the room log event queue, they can sit
+# in the queue for up to its batching window (MaximumBatchingWindowInSeconds 
+# of RoomLogEventQueueEventSourceMapping) before being stored.
+room_log_event_batching_window_seconds = 5
+segmented_inflight_wait_delay_seconds = inflight_wait_delay_seconds + room_log_event_batching_window_seconds
+
 sns_client = boto3.client("sns")
 sqs_client = boto3.client("sqs")
 logs_client = boto3.client("logs")
 s3_client = boto3.client("s3")
+lambda_client = boto3.client("lambda")
+
+# Room teardown deletes this many queues at a time.
+queue_deletion_pool = ThreadPool(processes=10)
+
+# Throttled calls are retried with exponential backoff.
+throttling_error_codes = [
+    "AWS.SimpleQueueService.RequestThrottled",
+    "RequestThrottled",
+    "Throttling",
+    "ThrottlingException"
+]
+max_throttled_attempts = 8
+throttled_backoff_base_seconds = 0.1
+
+# Room teardown stops starting new work when this much time is left, and 
+# resumes in another invocation.
+teardown_reserved_time_millis = 60000
 
 def lambda_handler(event, context):
     print('Event: {}'.format(json.dumps(event)))
@@ -43,76 +69,218 @@ def lambda_handler(event, context):
         
         return dict(event, **{
             "new-posts-disabled": True,
-            "inflight-wait-duration": inflight_wait_delay_seconds
+            "inflight-wait-duration": get_inflight_wait_delay_seconds()
         })
     
     else:
-        print("Deleting room topic ({}).".format(sns_topic_arn))
+        teardown_state = dict(event.get("teardown", {}))
+        teardown_state.setdefault("queues-deleted", 0)
+        
+        teardown_complete = continue_room_teardown(event, context, teardown_state)
+        
+        print("Room teardown {}. {} queue(s) deleted so far.".format(
+            "complete" if teardown_complete else "paused to be resumed",
+            teardown_state["queues-deleted"]
+        ))
+        
+        if teardown_complete:
+            start_room_event_log_compaction(room_id)
+        
+        return dict(event, **{
+            "teardown": teardown_state,
+            "teardown-complete": teardown_complete
+        })
+
+def continue_room_teardown(event, context, teardown_state):
+    """Deletes the room's resources, picking up from teardown_state.
+    
+    Returns True once everything's deleted. Returns False if this invocation 
+    is running out of time, in which case teardown_state records where to 
+    resume and the state machine invokes this function again.
+    
+    """
+    
+    room_id = event["id"]
+    sns_topic_arn = event["config"]["sns-topic-arn"]
+    
+    # The topic's subscriptions are the only record of which session queues 
+    # belong to the room, so delete those before the topic. Each page of 
+    # subscriptions is checkpointed once its queues are deleted.
+    while not teardown_state.get("subscribed-queues-deleted", False):
+        
+        if is_out_of_time(context):
+            return False
+        
+        queue_urls, next_token = get_subscribed_session_queue_urls(
+            sns_topic_arn,
+            teardown_state.get("subscriptions-next-token")
+        )
+        
+        teardown_state["queues-deleted"] += delete_queues(queue_urls)
+        
+        if next_token is None:
+            teardown_state.pop("subscriptions-next-token", None)
+            teardown_state["subscribed-queues-deleted"] = True
+        else:
+            teardown_state["subscriptions-next-token"] = next_token
+    
+    print("Deleting room topic ({}).".format(sns_topic_arn))
+    try:
+        sns_client.delete_topic(TopicArn = sns_topic_arn)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'AuthorizationError':
+            print("Unauthorized to delete room topic. Presumed already deleted.")
+        else:
+            raise
+    
+    for each_log_group_name_key in ["sns-log-group"]:
+        each_log_group_name = event["config"][each_log_group_name_key]
+        
+        print("Deleting log group ({}).".format(each_log_group_name))
         try:
-            sns_client.delete_topic(TopicArn = sns_topic_arn)
+            logs_client.delete_log_group(logGroupName=each_log_group_name)
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'AuthorizationError':
-                print("Unauthorized to delete room topic. Presumed already deleted.")
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                print("Log group already deleted.")
             else:
                 raise
+    
+    # Queues named after the room, from before session queues were named 
+    # after the session alone. Deleted queues can keep showing up in listings 
+    # for a while, so keep listing until only those remain.
+    deleted_queue_url_map = {}
+    
+    while True:
         
-        for each_log_group_name_key in ["sns-log-group"]:
-            each_log_group_name = event["config"][each_log_group_name_key]
-            
-            print("Deleting log group ({}).".format(each_log_group_name))
-            try:
-                logs_client.delete_log_group(logGroupName=each_log_group_name)
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                    print("Log group already deleted.")
-                else:
-                    raise
-        
-        deleted_queue_url_map = {}
-        
-        while True:
-        
-            response = sqs_client.list_queues(
-                QueueNamePrefix = "{}-{}-".format(
-                    os.environ["PROJECT_GLOBAL_PREFIX"],
-                    room_id.replace("-", "")
-                )
+        if is_out_of_time(context):
+            return False
+        
+        response = sqs_client.list_queues(
+            QueueNamePrefix = "{}-{}-".format(
+                os.environ["PROJECT_GLOBAL_PREFIX"],
+                room_id.replace("-", "")
             )
+        )
+        
+        queue_urls = list(x for x in response.get("QueueUrls", []) if x not in deleted_queue_url_map)
+        
+        if len(queue_urls) == 0:
+            print("Request for room's queues returned no undeleted queues.")
+            break
+        
+        teardown_state["queues-deleted"] += delete_queues(queue_urls)
+        
+        for each_queue_url in queue_urls:
+            deleted_queue_url_map[each_queue_url] = True
+    
+    return True
+
+def is_out_of_time(context):
+    return context.get_remaining_time_in_millis() < teardown_reserved_time_millis
+
+def get_subscribed_session_queue_urls(sns_topic_arn, next_token = None):
+    """Returns one page of the room's session queue URLs and the token for 
+    the next page (or None if it's the last)."""
+    
+    session_queue_name_prefix = "{}-".format(os.environ["PROJECT_GLOBAL_PREFIX"])
+    
+    list_kwargs = {
+        "TopicArn": sns_topic_arn
+    }
+    
+    if next_token is not None:
+        list_kwargs["NextToken"] = next_token
+    
+    try:
+        response = call_with_backoff(sns_client.list_subscriptions_by_topic, **list_kwargs)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["AuthorizationError", "NotFound"]:
+            print("Unable to list room topic subscriptions. Presumed already deleted.")
+            return [], None
+        else:
+            raise
+    
+    queue_urls = []
+    
+    for each_subscription in response.get("Subscriptions", []):
+        if each_subscription["Protocol"] != "sqs":
+            continue
+        
+        # arn:aws:sqs:{region}:{account_id}:{queue_name}
+        arn_parts = each_subscription["Endpoint"].split(":")
+        
+        # Skips the room log event queue, which isn't the stack's to delete.
+        if not arn_parts[5].startswith(session_queue_name_prefix):
+            continue
+        
+        queue_urls.append("https://sqs.{}.amazonaws.com/{}/{}".format(
+            arn_parts[3],
+            arn_parts[4],
+            arn_parts[5]
+        ))
+    
+    print("Found {} session queue(s) subscribed to the room.".format(len(queue_urls)))
+    
+    return queue_urls, response.get("NextToken")
+
+def delete_queues(queue_urls):
+    """Deletes the given queues concurrently and returns how many there were."""
+    
+    queue_deletion_pool.map(delete_queue, queue_urls)
+    
+    return len(queue_urls)
+
+def delete_queue(queue_url):
+    print("Deleting queue: {}".format(queue_url))
+    
+    try:
+        call_with_backoff(
+            sqs_client.delete_queue,
+            QueueUrl = queue_url
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "AWS.SimpleQueueService.NonExistentQueue":
+            print("Queue already deleted.")
+        else:
+            raise
+
+def call_with_backoff(function, **kwargs):
+    attempt = 0
+    
+    while True:
+        try:
+            return function(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            attempt += 1
             
-            queue_urls = response.get("QueueUrls", [])
-            
-            if len(queue_urls) == 0:
-                print("Request for room's queues returned no results.")
-                break
-            
-            deletions_attempted = 0
+            if e.response["Error"]["Code"] not in throttling_error_codes or attempt >= max_throttled_attempts:
+                raise
             
-            for each_queue_url in queue_urls:
-                if each_queue_url in deleted_queue_url_map:
-                    continue
-                
-                print("Deleting queue: {}".format(each_queue_url))
-                
-                deletions_attempted += 1
-                
-                try:
-                    sqs_client.delete_queue(
-                        QueueUrl = each_queue_url
-                    )
-                    
-                    deleted_queue_url_map[each_queue_url] = True
-                except botocore.exceptions.ClientError as e:
-                    if e.response["Error"]["Code"] == "AWS.SimpleQueueService.NonExistentQueue":
-                        print("Queue already deleted.")
-                    else:
-                        raise
-                        
-            if deletions_attempted == 0:
-                print("Last request for queues returned only queues we've already deleted.")
-                break
-    
-    
-    return dict(event, **{})
+            # Exponential backoff with full jitter.
+            time.sleep(random.uniform(0, throttled_backoff_base_seconds * (2 ** attempt)))
+
+def get_inflight_wait_delay_seconds():
+    if int(os.environ.get("ROOM_EVENT_LOG_SEGMENT_SECONDS", "0") or "0") > 0:
+        return segmented_inflight_wait_delay_seconds
+    
+    return inflight_wait_delay_seconds
+
+def start_room_event_log_compaction(room_id):
+    compactor_function_name = os.environ.get("ROOM_EVENT_LOG_COMPACTOR_FUNCTION", "")
+    
+    if compactor_function_name == "":
+        return
+    
+    print("Starting room event log compaction.")
+    
+    # Compaction can take longer than this function should, so don't wait on it.
+    lambda_client.invoke(
+        FunctionName = compactor_function_name,
+        InvocationType = "Event",
+        Payload = json.dumps({
+            "room-id": room_id
+        })
+    )
 
 def close_room_to_new_posts(sns_topic_arn, room_id):
     print("Setting room topic to disallow new subscriptions and user posts.")
@@ -3,15 +3,35 @@
 Used as a subscription filter to room event logs to send events to S3 for 
 durable long-term storage.
 
+By default, each event is stored as its own object under the room's
+"reverse" prefix. There's no pointer to it under the "forward" prefix, since
+that would double the PUTs per event. Readers list the "reverse" prefix to
+read it oldest first.
+
+If ROOM_EVENT_LOG_SEGMENT_SECONDS is set, events are instead delivered in
+batches through an SQS queue and each batch is written as one NDJSON segment
+object per room and time bucket under the room's "segments" prefix. Segment
+keys sort newest bucket first and carry the bucket start, newest event
+timestamp, and event count, so a single listing of the prefix serves as the
+room's manifest of segments. Each segment also gets an empty pointer under the
+"segments-forward" prefix, keyed by the end of its bucket.
+
+SQS can deliver an event more than once, in a different batch, so the same
+event can end up in more than one segment. Readers and compaction merge
+events by message ID.
+
+See project_local.room_event_log for the full layout.
+
 """
 
 from __future__ import print_function
 
 import os
 import json
-import datetime
+import hashlib
 import boto3
 import botocore
+from project_local.room_event_log import get_reverse_lexi_string_for_timestamp, get_reverse_key, get_segment_forward_pointer_key
 
 s3_client = boto3.client("s3")
 
@@ -24,9 +44,18 @@ def lambda_handler(event, context):
         }
     
     s3_bucket_name = os.environ["SHARED_BUCKET"]
+    segment_seconds = int(os.environ.get("ROOM_EVENT_LOG_SEGMENT_SECONDS", "0") or "0")
+    
+    room_event_list = []
     
     for each_record in event["Records"]:
-        sns_message = each_record["Sns"]
+        
+        if each_record.get("eventSource") == "aws:sqs":
+            # SNS notification delivered to the room log event queue.
+            sns_message = json.loads(each_record["body"])
+        else:
+            sns_message = each_record["Sns"]
+        
         sns_topic_arn = sns_message["TopicArn"]
         
         room_id = "-".join(sns_topic_arn.split(":")[5].split("-")[1:])
@@ -37,35 +66,74 @@ def lambda_handler(event, context):
         print("Message ID: {}".format(message_id))
         print("Event: {}".format(json.dumps(event_object)))
         
+        room_event_list.append((room_id, message_id, event_object))
+    
+    if segment_seconds > 0:
+        write_room_event_segments(s3_bucket_name, segment_seconds, room_event_list)
+        return {}
+    
+    for room_id, message_id, event_object in room_event_list:
         s3_client.put_object(
             Bucket = s3_bucket_name,
-            Key = get_s3_key_for_room_event(room_id, message_id, event_object),
+            Key = get_reverse_key(room_id, event_object["timestamp"], message_id),
             Body = json.dumps(event_object),
             ContentType = "application/json"
         )
-
+    
     return {}
 
-def get_s3_key_for_room_event(room_id, message_id, event_object):
+def write_room_event_segments(s3_bucket_name, segment_seconds, room_event_list):
     
-    event_timestamp = event_object["timestamp"]
-    event_datetime = datetime.datetime.utcfromtimestamp(event_timestamp)
+    segment_event_map = {}
     
-    return "room-event-logs/{}/reverse/{}-{}-{}.json".format(
-        room_id,
-        get_reverse_lexi_string_for_timestamp(event_timestamp),
-        event_timestamp,
-        message_id
-    )
-
-def get_reverse_lexi_string_for_timestamp(timestamp):
-    timestamp_string = str(timestamp).zfill(10)
+    for room_id, message_id, event_object in room_event_list:
+        bucket_start = get_segment_bucket_start(event_object["timestamp"], segment_seconds)
+        
+        segment_event_map.setdefault((room_id, bucket_start), []).append(
+            dict(event_object, **{"message-id": message_id})
+        )
     
-    character_list = []
+    for (room_id, bucket_start), segment_events in segment_event_map.items():
+        
+        # Newest first, matching the order of the keys themselves.
+        segment_events.sort(key=lambda x: (x["timestamp"], x["message-id"]), reverse=True)
+        
+        segment_key = get_s3_key_for_room_event_segment(room_id, bucket_start, segment_events)
+        
+        print("Writing {} event(s) to segment: {}".format(len(segment_events), segment_key))
+        
+        s3_client.put_object(
+            Bucket = s3_bucket_name,
+            Key = segment_key,
+            Body = "".join("{}\n".format(json.dumps(x)) for x in segment_events),
+            ContentType = "application/x-ndjson"
+        )
+        
+        s3_client.put_object(
+            Bucket = s3_bucket_name,
+            Key = get_segment_forward_pointer_key(room_id, bucket_start + segment_seconds - 1, segment_key),
+            Body = b""
+        )
+    
+    print("Wrote {} event(s) to {} segment(s).".format(len(room_event_list), len(segment_event_map)))
+
+def get_segment_bucket_start(timestamp, segment_seconds):
+    return timestamp - (timestamp % segment_seconds)
+
+def get_s3_key_for_room_event_segment(room_id, bucket_start, segment_events):
     
-    for each_character in timestamp_string:
-        new_character = 9 - int(each_character)
-        character_list.append(str(new_character))
+    # More than one segment can exist per bucket (one per delivered batch). A
+    # digest of every event's message ID gives the same events the same key
+    # however they're redelivered, and different events different keys.
+    message_id_digest = hashlib.sha1(
+        "\n".join(sorted(x["message-id"] for x in segment_events)).encode("utf-8")
+    ).hexdigest()
     
-    return "".join(character_list)
-    
\ No newline at end of file
+    return "room-event-logs/{}/segments/{}-{}-{}-{}-{}.ndjson".format(
+        room_id,
+        get_reverse_lexi_string_for_timestamp(bucket_start),
+        bucket_start,
+        segment_events[0]["timestamp"],
+        len(segment_events),
+        message_id_digest
+    )
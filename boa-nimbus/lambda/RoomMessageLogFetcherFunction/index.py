@@ -2,6 +2,10 @@
 
 Fetches recent room messages.
 
+Pages are read from whichever room event log layouts hold the room's history
+(see project_local.room_event_log). The next-token identifies the last message
+returned, so it stays valid if the room is compacted between requests.
+
 """
 
 from __future__ import print_function
@@ -9,20 +13,39 @@ from __future__ import print_function
 import os
 import json
 import time
-import operator
-from multiprocessing.pool import ThreadPool
-import boto3
 import botocore
 from apigateway_helpers.exception import APIGatewayException
+from apigateway_helpers.validation import validate_zbase32_id_path_parameter
 from apigateway_helpers.headers import get_response_headers
+from project_local.cache import TTLCache, ByteBoundedLRUCache
+from project_local.room_event_log import RoomEventLogReader
+from project_local.s3_fetch import S3FetchExecutor
 
 s3_bucket_name = os.environ["SHARED_BUCKET"]
 
-s3_client = boto3.client("s3")
-
 max_records_per_request = 10
 
-s3_key_get_results = {}
+# Room history objects never change once written, so parsed copies are kept
+# for as long as there's room for them.
+history_object_cache_max_bytes = 64 * 1024 * 1024
+
+# The container is frozen as soon as a response is returned, so the next page 
+# can't be prefetched after it. Requests that pass prefetch=true instead read 
+# this many pages in the same concurrent fetches, and only the first is 
+# returned. The rest stay cached for the next request.
+prefetch_page_count = 2
+
+# Enough workers to fetch every prefetched page of per-message objects at once.
+s3_fetch_executor = S3FetchExecutor(max_workers = prefetch_page_count * max_records_per_request + 1)
+
+history_object_cache = ByteBoundedLRUCache(history_object_cache_max_bytes)
+
+room_event_log_reader = RoomEventLogReader(
+    s3_fetch_executor,
+    s3_bucket_name,
+    index_cache = TTLCache(256, 3600),
+    object_cache = history_object_cache
+)
 
 def lambda_handler(event, context):
     print("Event: {}".format(json.dumps(event)))
@@ -32,16 +55,14 @@ def lambda_handler(event, context):
             "message": "Warmed!"
         }
     
-    s3_key_get_results.clear()
-    
-    room_id = event["pathParameters"]["room-id"]
+    room_id = validate_zbase32_id_path_parameter(event, "room-id")
     
     if event.get("queryStringParameters") is None:
         event["queryStringParameters"] = {}
     
     list_direction = event["queryStringParameters"].get("direction", "forward")
     
-    valid_directions = ["reverse"]
+    valid_directions = ["forward", "reverse"]
     
     if list_direction not in valid_directions:
         raise APIGatewayException("URL parameter \"direction\" should be one of: {}".format(", ".join(valid_directions)), 400)
@@ -59,97 +80,71 @@ def lambda_handler(event, context):
     except:
         raise APIGatewayException("URL parameter \"from\" should be a unix timestamp.", 400)
     
-    list_objects_kwargs = {
-        "Bucket": s3_bucket_name,
-        "Prefix": "room-event-logs/{}/reverse/".format(
-            room_id
-        ),
-        "StartAfter": "room-event-logs/{}/reverse/{}-".format(
-            room_id,
-            get_reverse_lexi_string_for_timestamp(from_timestamp)
-        )
-    }
-    
-    list_objects_kwargs["MaxKeys"] = max_records_per_request
-    
     if next_token is not None:
-        list_objects_kwargs["ContinuationToken"] = next_token
-    
-    response = s3_client.list_objects_v2(**list_objects_kwargs)
+        cursor = parse_next_token(next_token)
+    else:
+        cursor = (from_timestamp, None)
     
-    is_truncated = response["IsTruncated"]
-    
-    print("List operation returned {} key(s). Is truncated? {}".format(
-        response["KeyCount"],
-        is_truncated
-    ))
+    read_limit = max_records_per_request
     
-    pool_map_args = []
+    if "{}".format(event["queryStringParameters"].get("prefetch", "false")).lower() == "true":
+        read_limit = prefetch_page_count * max_records_per_request
     
-    for each_object_dict in response.get("Contents", []):
-        each_key = each_object_dict["Key"]
-        
-        pool_map_args.append(each_key)
-        
-    pool = ThreadPool(processes=10)
+    cache_stats_before = history_object_cache.get_stats()
     
     s3_fetch_start_time = time.time()
-    pool.map(get_s3_bucket_object, pool_map_args)
-    pool.close()
-    pool.join()
+    message_list, is_truncated = room_event_log_reader.read_page(room_id, cursor, read_limit, list_direction)
     s3_fetch_end_time = time.time()
     
-    print("Fetched {} S3 objects in {} seconds.".format(
-        len(pool_map_args),
-        s3_fetch_end_time - s3_fetch_start_time
-    ))
+    if len(message_list) > max_records_per_request:
+        message_list = message_list[:max_records_per_request]
+        is_truncated = True
     
-    message_list = []
-    
-    for each_key in s3_key_get_results:
-        
-        each_filename = each_key.split("/")[-1]
-        filename_parts = each_filename.split("-")
-        
-        each_message_id = "-".join(filename_parts[2:]).split(".")[0]
-        each_message_object = s3_key_get_results[each_key]
-        
-        each_message_object["message-id"] = each_message_id
-        
-        message_list.append(each_message_object)
-    
-    message_list.sort(key=operator.itemgetter("timestamp"))
+    print("Read {} message(s) in {} seconds. Is truncated? {}".format(
+        len(message_list),
+        s3_fetch_end_time - s3_fetch_start_time,
+        is_truncated
+    ))
     
-    if list_direction == "reverse":
-        message_list.reverse()
+    print_cache_stats(cache_stats_before, history_object_cache.get_stats())
     
     response_object = {
         "messages": message_list,
         "truncated": is_truncated
     }
     
-    if "NextContinuationToken" in response:
-        response_object["next-token"] = response["NextContinuationToken"]
+    if is_truncated:
+        response_object["next-token"] = get_next_token(message_list[-1])
     
     return response_object
 
-def get_s3_bucket_object(key):
-    session = boto3.session.Session()
-    
-    s3_client = session.client("s3")
-    
-    s3_key_get_results[key] = json.loads(s3_client.get_object(Bucket = s3_bucket_name, Key = key)["Body"].read())
+def print_cache_stats(stats_before, stats_after):
+    request_hits = stats_after["hits"] - stats_before["hits"]
+    request_misses = stats_after["misses"] - stats_before["misses"]
+    request_lookups = request_hits + request_misses
+    
+    print("History object cache: {} hit(s), {} miss(es) ({}% hit rate) this request. {} entries, {} bytes, {} evictions in container.".format(
+        request_hits,
+        request_misses,
+        int(round(100.0 * request_hits / request_lookups)) if request_lookups > 0 else 0,
+        stats_after["entries"],
+        stats_after["bytes"],
+        stats_after["evictions"]
+    ))
 
-def get_reverse_lexi_string_for_timestamp(timestamp):
-    timestamp_string = str(timestamp).zfill(10)
-    
-    character_list = []
-    
-    for each_character in timestamp_string:
-        new_character = 9 - int(each_character)
-        character_list.append(str(new_character))
+def get_next_token(last_message_object):
+    return "{}-{}".format(last_message_object["timestamp"], last_message_object["message-id"])
+
+def parse_next_token(next_token):
+    token_parts = next_token.split("-", 1)
     
-    return "".join(character_list)
+    try:
+        if len(token_parts) != 2 or token_parts[1] == "":
+            raise ValueError()
+        
+        return (int(token_parts[0]), token_parts[1])
+    except ValueError:
+        raise APIGatewayException("URL parameter \"next-token\" is invalid.", 400)
 
 def proxy_lambda_handler(event, context):
     
@@ -10,17 +10,49 @@ from __future__ import print_function
 import os
 import json
 import time
-import hashlib
+from multiprocessing.pool import ThreadPool
 import boto3
 import botocore
+from project_local.dedupe import MessageDedupeWindow, S3DedupeStore
+from project_local.profile_changes import ProfileChangeWatcher
+from project_local.user_directory import UserDirectory
 from apigateway_helpers.exception import APIGatewayException
+from apigateway_helpers.validation import validate_zbase32_id_path_parameter
 from apigateway_helpers.headers import get_response_headers
 
 client_message_id_max_length = 36
+max_messages_per_batch_request = 100
+
+# Maximum number of entries SNS accepts in a single PublishBatch call.
+sns_publish_batch_max_entries = 10
 
 sns_client = boto3.client("sns")
 cognito_idp_client = boto3.client("cognito-idp")
 logs_client = boto3.client("logs")
+s3_client = boto3.client("s3")
+
+# Caches of author profiles (e-mail address and avatar hash) keyed by user 
+# pool ID. The user pool is only known from requests, so each is created on 
+# first use.
+user_directories = {}
+
+# A retried post with the same client message ID inside this window returns 
+# the original message ID instead of being published again. This container's 
+# window is checked first, and the shared (S3) record only if that misses.
+message_dedupe_window_seconds = 300
+message_dedupe_s3_prefix = "message-dedupe/"
+
+message_dedupe_window = MessageDedupeWindow(
+    S3DedupeStore(s3_client, os.environ["SHARED_BUCKET"], message_dedupe_s3_prefix, message_dedupe_window_seconds),
+    message_dedupe_window_seconds
+)
+
+# Shared dedupe lookups and writes run on this pool, which lives as long as 
+# the container. Single posts' writes are left running after the response is 
+# returned. A write still pending when the container is frozen finishes when 
+# it's next thawed (or is lost with the container), which only matters to a 
+# retry reaching a different container in the meantime.
+message_dedupe_pool = ThreadPool(processes=10)
 
 room_streams_created_map = {}
 
@@ -32,87 +64,319 @@ def lambda_handler(event, context):
             "message": "Warmed!"
         }
     
+    # Checked before anything else so bad IDs never cost an AWS call.
+    room_id = validate_zbase32_id_path_parameter(event, "room-id")
+    
     event["request-body"] = json.loads(event["body"])
     
     cognito_identity_id = event["requestContext"]["identity"]["cognitoIdentityId"]
     
-    if event["request-body"].get("version", "1") != "1":
-        raise APIGatewayException("Unsupported message version: {}".format(event["request-body"]["version"]), 400)
-    
-    client_message_id = event["request-body"].get("client-message-id")
+    is_batch_request = event.get("resource") == "/room/{room-id}/message/batch"
     
-    if client_message_id is not None and len(client_message_id) > client_message_id_max_length:
-        raise APIGatewayException("Parameter \"client-message-id\" must be {} bytes or fewer.".format(client_message_id_max_length), 400)
-    
-    room_id = event["pathParameters"]["room-id"]
+    if is_batch_request:
+        request_items = event["request-body"].get("messages")
+        
+        if not isinstance(request_items, list) or len(request_items) == 0:
+            raise APIGatewayException("Value for \"messages\" must be a non-empty list.", 400)
+        
+        if len(request_items) > max_messages_per_batch_request:
+            raise APIGatewayException("Value for \"messages\" must contain {} messages or fewer.".format(max_messages_per_batch_request), 400)
+    else:
+        request_items = [event["request-body"]]
+        
+        validation_error = validate_message_request_item(request_items[0])
+        
+        if validation_error is not None:
+            raise APIGatewayException(validation_error, 400)
     
     sns_topic_arn = get_room_topic_arn(event, context, room_id)
     
-    user_profile_dataset_name = os.environ["COGNITO_USER_PROFILE_DATASET_NAME"]
-    identity_pool_id = event["requestContext"]["identity"]["cognitoIdentityPoolId"]
-    
     cognito_auth_provider_string = event["requestContext"]["identity"]["cognitoAuthenticationProvider"]
     cognito_idp_name = cognito_auth_provider_string.split(",")[0]
     user_pool_id = "/".join(cognito_idp_name.split("/")[1:])
     cognito_user_pool_sub_value = cognito_auth_provider_string.split(",")[1].split(":")[2]
     
+    if is_batch_request:
+        return publish_message_batch(sns_topic_arn, room_id, cognito_identity_id, user_pool_id, cognito_user_pool_sub_value, request_items)
     
-    author_name = cognito_identity_id
+    client_message_id = request_items[0].get("client-message-id")
+    author_profile = None
     
-    response = cognito_idp_client.list_users(
-        UserPoolId = user_pool_id,
-        AttributesToGet = ["email"],
-        Filter = "sub = \"{}\"".format(cognito_user_pool_sub_value),
-        Limit = 1
-    )
+    if client_message_id is not None:
+        existing_message_id = message_dedupe_window.lookup(room_id, cognito_identity_id, client_message_id, check_shared_store = False)
+        
+        if existing_message_id is None:
+            # The author is needed unless this turns out to be a retry, so the 
+            # shared record is checked while it's resolved.
+            shared_lookup_result = message_dedupe_pool.apply_async(
+                message_dedupe_window.lookup,
+                (room_id, cognito_identity_id, client_message_id)
+            )
+            
+            author_profile = get_author_profile(user_pool_id, cognito_user_pool_sub_value)
+            
+            existing_message_id = shared_lookup_result.get()
+        
+        if existing_message_id is not None:
+            print("Message with client message ID {} already posted as {}.".format(client_message_id, existing_message_id))
+            
+            return {
+                "message-id": existing_message_id
+            }
+    
+    if author_profile is None:
+        author_profile = get_author_profile(user_pool_id, cognito_user_pool_sub_value)
+    
+    message_object = generate_message_object(cognito_identity_id, author_profile, request_items[0])
+    
+    try:
+        response = sns_client.publish(
+            TopicArn = sns_topic_arn,
+            Message = json.dumps(message_object)
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ['InvalidParameter', 'AuthorizationError']:
+            raise APIGatewayException("Room \"{}\" either doesn't exist or you don't have access to it.".format(room_id), 400)
+        else:
+            raise
+    
+    if client_message_id is not None:
+        message_dedupe_window.record(
+            room_id,
+            cognito_identity_id,
+            client_message_id,
+            response["MessageId"],
+            pool = message_dedupe_pool
+        )
+    
+    return {
+        "message-id": response["MessageId"]
+    }
+
+def validate_message_request_item(request_item):
     
-    author_attributes_list = response["Users"][0]["Attributes"]
+    if not isinstance(request_item, dict):
+        return "Each message must be an object."
     
-    author_email_address = None
+    if request_item.get("version", "1") != "1":
+        return "Unsupported message version: {}".format(request_item["version"])
     
-    author_name = None
-    author_avatar_hash = None
+    client_message_id = request_item.get("client-message-id")
     
-    for each_attribute_set in author_attributes_list:
-        if each_attribute_set["Name"] == "email":
-            author_email_address = each_attribute_set["Value"]
-            break
+    if client_message_id is not None and not isinstance(client_message_id, str):
+        return "Parameter \"client-message-id\" must be a string."
     
-    if author_email_address is not None:
-        author_name = author_email_address
+    if client_message_id is not None and len(client_message_id) > client_message_id_max_length:
+        return "Parameter \"client-message-id\" must be {} bytes or fewer.".format(client_message_id_max_length)
     
-    # Need a value that will change when the user's Gravatar URL should change
-    # but also should not be a plain MD5 hash of the e-mail address.
-    # The Gravatar is based on the e-mail address, so this should work.
-    author_avatar_hash = hashlib.md5("{}{}".format(cognito_user_pool_sub_value, author_email_address)).hexdigest()
+    return None
+
+def generate_message_object(cognito_identity_id, author_profile, request_item):
     
     message_object = {
         "identity-id": cognito_identity_id,
-        "author-name": author_name,
-        "author-avatar-hash": author_avatar_hash,
-        "message": event["request-body"].get("message", ""),
+        "author-name": author_profile["email-address"],
+        "author-avatar-hash": author_profile["avatar-hash"],
+        "message": request_item.get("message", ""),
         "timestamp": int(time.time())
     }
     
+    client_message_id = request_item.get("client-message-id")
+    
     if client_message_id is not None:
         message_object["client-message-id"] = client_message_id
     
-    try:
-        response = sns_client.publish(
-            TopicArn = sns_topic_arn,
-            Message = json.dumps(message_object)
-        )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] in ['InvalidParameter', 'AuthorizationError']:
-            raise APIGatewayException("Room \"{}\" either doesn't exist or you don't have access to it.".format(room_id), 400)
+    return message_object
+
+def publish_message_batch(sns_topic_arn, room_id, cognito_identity_id, user_pool_id, user_sub, request_items):
+    
+    # One result per requested message, in request order.
+    result_list = []
+    
+    # Indexes of valid messages, and the first index seen for each client message ID.
+    valid_item_indexes = []
+    client_message_id_index_map = {}
+    
+    for i, each_request_item in enumerate(request_items):
+        each_result = {}
+        
+        validation_error = validate_message_request_item(each_request_item)
+        
+        if validation_error is not None:
+            each_result["error"] = validation_error
         else:
-            raise
+            valid_item_indexes.append(i)
+            
+            each_client_message_id = each_request_item.get("client-message-id")
+            
+            if each_client_message_id is not None:
+                each_result["client-message-id"] = each_client_message_id
+                client_message_id_index_map.setdefault(each_client_message_id, i)
+        
+        result_list.append(each_result)
+    
+    existing_message_id_map = lookup_existing_message_ids(room_id, cognito_identity_id, list(client_message_id_index_map.keys()))
     
+    publish_entries = []
+    author_profile = None
+    
+    for i in valid_item_indexes:
+        each_client_message_id = request_items[i].get("client-message-id")
+        
+        if each_client_message_id is not None:
+            if each_client_message_id in existing_message_id_map:
+                result_list[i]["message-id"] = existing_message_id_map[each_client_message_id]
+                continue
+            
+            if client_message_id_index_map[each_client_message_id] != i:
+                # Repeated within this batch. Filled in from the first occurrence below.
+                continue
+        
+        # Resolved once, and only if there's something new to publish.
+        if author_profile is None:
+            author_profile = get_author_profile(user_pool_id, user_sub)
+        
+        publish_entries.append({
+            "Id": str(i),
+            "Message": json.dumps(generate_message_object(cognito_identity_id, author_profile, request_items[i]))
+        })
+    
+    for chunk_start in range(0, len(publish_entries), sns_publish_batch_max_entries):
+        chunk_entries = publish_entries[chunk_start:chunk_start + sns_publish_batch_max_entries]
+        
+        try:
+            response = sns_client.publish_batch(
+                TopicArn = sns_topic_arn,
+                PublishBatchRequestEntries = chunk_entries
+            )
+        except botocore.exceptions.ClientError as e:
+            if chunk_start == 0:
+                if e.response['Error']['Code'] in ['InvalidParameter', 'AuthorizationError']:
+                    raise APIGatewayException("Room \"{}\" either doesn't exist or you don't have access to it.".format(room_id), 400)
+                else:
+                    raise
+            
+            # Earlier chunks are already published (and recorded), so failing 
+            # the request would make the client retry all of them. Only this 
+            # chunk's messages are reported as failed.
+            print("Failed to publish batch entries {} to {}: {}".format(
+                chunk_entries[0]["Id"],
+                chunk_entries[-1]["Id"],
+                e.response['Error']['Code']
+            ))
+            
+            for each_entry in chunk_entries:
+                result_list[int(each_entry["Id"])]["error"] = "Unable to post message."
+            
+            continue
+        
+        chunk_message_id_map = {}
+        
+        for each_successful_entry in response.get("Successful", []):
+            each_index = int(each_successful_entry["Id"])
+            result_list[each_index]["message-id"] = each_successful_entry["MessageId"]
+            
+            each_client_message_id = request_items[each_index].get("client-message-id")
+            
+            if each_client_message_id is not None:
+                chunk_message_id_map[each_client_message_id] = each_successful_entry["MessageId"]
+        
+        for each_failed_entry in response.get("Failed", []):
+            print("Failed to publish batch entry {}: {} ({})".format(
+                each_failed_entry["Id"],
+                each_failed_entry.get("Message", ""),
+                each_failed_entry["Code"]
+            ))
+            result_list[int(each_failed_entry["Id"])]["error"] = "Unable to post message."
+        
+        # Recorded before the next chunk is published, so a retry after a 
+        # later failure doesn't publish these again.
+        record_published_message_ids(room_id, cognito_identity_id, chunk_message_id_map)
+    
+    for i in valid_item_indexes:
+        each_client_message_id = request_items[i].get("client-message-id")
+        
+        if each_client_message_id is None or "message-id" in result_list[i]:
+            continue
+        
+        first_result = result_list[client_message_id_index_map[each_client_message_id]]
+        
+        for each_key in ["message-id", "error"]:
+            if each_key in first_result:
+                result_list[i][each_key] = first_result[each_key]
+    
+    published_count = len(list(x for x in publish_entries if "message-id" in result_list[int(x["Id"])]))
+    
+    print("Published {} of {} message(s) in {} batch request(s). {} already posted.".format(
+        published_count,
+        len(result_list),
+        (len(publish_entries) + sns_publish_batch_max_entries - 1) // sns_publish_batch_max_entries,
+        len(existing_message_id_map)
+    ))
     
     return {
-        "message-id": response["MessageId"]
+        "messages": result_list
     }
 
+def lookup_existing_message_ids(room_id, cognito_identity_id, client_message_ids):
+    
+    existing_message_id_map = {}
+    shared_lookup_client_message_ids = []
+    
+    for each_client_message_id in client_message_ids:
+        each_message_id = message_dedupe_window.lookup(room_id, cognito_identity_id, each_client_message_id, check_shared_store = False)
+        
+        if each_message_id is not None:
+            existing_message_id_map[each_client_message_id] = each_message_id
+        else:
+            shared_lookup_client_message_ids.append(each_client_message_id)
+    
+    if len(shared_lookup_client_message_ids) == 0:
+        return existing_message_id_map
+    
+    message_ids = message_dedupe_pool.map(
+        lambda x: message_dedupe_window.lookup(room_id, cognito_identity_id, x),
+        shared_lookup_client_message_ids
+    )
+    
+    existing_message_id_map.update((k, v) for k, v in zip(shared_lookup_client_message_ids, message_ids) if v is not None)
+    
+    return existing_message_id_map
+
+def record_published_message_ids(room_id, cognito_identity_id, client_message_id_map):
+    
+    if len(client_message_id_map) == 0:
+        return
+    
+    message_dedupe_pool.map(
+        lambda x: message_dedupe_window.record(room_id, cognito_identity_id, x[0], x[1]),
+        list(client_message_id_map.items())
+    )
+
+def get_author_profile(user_pool_id, user_sub):
+    
+    user_directory = get_user_directory(user_pool_id)
+    
+    author_profile = user_directory.get_user_by_sub(user_sub)
+    
+    print("User directory: {}".format(json.dumps(user_directory.get_stats())))
+    
+    if author_profile is None:
+        raise Exception("Unable to find author in user pool.")
+    
+    return author_profile
+
+def get_user_directory(user_pool_id):
+    
+    if user_pool_id not in user_directories:
+        user_directories[user_pool_id] = UserDirectory(
+            cognito_idp_client,
+            user_pool_id,
+            profile_change_watcher = ProfileChangeWatcher(s3_client, os.environ["SHARED_BUCKET"])
+        )
+    
+    return user_directories[user_pool_id]
+
 def generate_room_sns_topic_name(room_id):
     return "{}-{}".format(
         os.environ["PROJECT_GLOBAL_PREFIX"],
@@ -14,26 +14,44 @@ On the back end, this:
    * The acknowledging function to delete messages from it.
    * The cleanup function to delete it.
 
+Session queues are named after the session alone, so they can be created 
+before anyone asks for them. If a session queue pool is configured, a queue 
+is claimed from the pool and only needs subscribing to the room's topic. The 
+subscription is what ties the queue to the room. The pool is kept filled by 
+session_queue_pool_filler_handler, which runs on a schedule.
+
 """
 
 from __future__ import print_function
 
 import os
+import sys
 import json
 import uuid
 import time
 import hashlib
 import base64
+from multiprocessing.pool import ThreadPool
 import boto3
 import botocore
+import six
 import zbase32
 from apigateway_helpers.exception import APIGatewayException
+from apigateway_helpers.validation import validate_zbase32_id_path_parameter
 from apigateway_helpers.headers import get_response_headers
 
 sqs_client = boto3.client("sqs")
 sns_client = boto3.client("sns")
 s3_client = boto3.client("s3")
 
+# Runs the SESSION_STARTED publish and the subscription at the same time.
+session_setup_pool = ThreadPool(processes=2)
+
+# Pooled queues older than this are deleted instead of being claimed. Must be
+# less than the pool queue's message retention period, and well under the 30 
+# days of inactivity after which SQS may delete a queue.
+max_pooled_queue_age_seconds = 604800 # 604800 seconds == One week
+
 def lambda_handler(event, context):
     print("Event: {}".format(json.dumps(event)))
     
@@ -42,39 +60,179 @@ def lambda_handler(event, context):
             "message": "Warmed!"
         }
     
-    session_id = generate_new_session_id()
+    # Checked before claiming or creating a queue, which a bad ID would 
+    # otherwise only be discovered after.
+    validate_zbase32_id_path_parameter(event, "room-id")
+    
+    pooled_queue = claim_pooled_queue()
     
-    sqs_queue_name = get_queue_name(event, session_id)
-    create_and_initialize_queue(event, context, sqs_queue_name, session_id)
+    if pooled_queue is not None:
+        session_id, queue_url = pooled_queue
+        print("Claimed pooled queue: {}".format(queue_url))
+    else:
+        session_id = generate_new_session_id()
+        queue_url = None
+    
+    sqs_queue_name = get_queue_name(session_id)
+    create_and_initialize_queue(event, context, sqs_queue_name, session_id, queue_url)
     
     return {
         "id": session_id
     }
 
-def generate_new_session_id():
-    return zbase32.b2a(uuid.uuid4().bytes)
-
-def create_and_initialize_queue(event, context, sqs_queue_name, session_id):
+def session_queue_pool_filler_handler(event, context):
+    print("Event: {}".format(json.dumps(event)))
     
-    sns_topic_arn = "arn:aws:sns:{aws_region}:{aws_account_id}:{topic_name}".format(
+    if "warming" in event and "{}".format(event["warming"]).lower() == "true":
+        return {
+            "message": "Warmed!"
+        }
+    
+    session_queue_pool_size = int(os.environ.get("SESSION_QUEUE_POOL_SIZE", "0") or "0")
+    session_queue_pool_queue_url = os.environ["SESSION_QUEUE_POOL_QUEUE_URL"]
+    
+    response = sqs_client.get_queue_attributes(
+        QueueUrl = session_queue_pool_queue_url,
+        AttributeNames = [
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible"
+        ]
+    )
+    
+    # Queues being claimed right now are counted as pooled, so this errs 
+    # toward filling slightly too few rather than too many.
+    pooled_queue_count = sum(int(x) for x in response["Attributes"].values())
+    
+    queues_needed = session_queue_pool_size - pooled_queue_count
+    
+    print("Session queue pool has {} of {} queue(s).".format(pooled_queue_count, session_queue_pool_size))
+    
+    if queues_needed <= 0:
+        return {
+            "created": 0
+        }
+    
+    # Any of the stack's room topics may send to a pooled queue, since it 
+    # isn't known yet which room it'll be used for.
+    sns_topic_arn_pattern = "arn:aws:sns:{aws_region}:{aws_account_id}:{topic_name}".format(
         aws_region = context.invoked_function_arn.split(":")[3],
         aws_account_id = context.invoked_function_arn.split(":")[4],
-        topic_name = generate_room_sns_topic_name(event["pathParameters"]["room-id"])
+        topic_name = generate_room_sns_topic_name("*")
     )
     
+    pool = ThreadPool(processes=min(queues_needed, 10))
+    
+    try:
+        pool.map(lambda x: add_queue_to_pool(session_queue_pool_queue_url, sns_topic_arn_pattern), range(queues_needed))
+    finally:
+        pool.close()
+        pool.join()
+    
+    print("Added {} queue(s) to the pool.".format(queues_needed))
+    
+    return {
+        "created": queues_needed
+    }
+
+def add_queue_to_pool(session_queue_pool_queue_url, sns_topic_arn_pattern):
+    session_id = generate_new_session_id()
+    
     response = sqs_client.create_queue(
-        QueueName = sqs_queue_name,
-        Attributes = get_default_queue_attributes(sns_topic_arn)
+        QueueName = get_queue_name(session_id),
+        Attributes = get_default_queue_attributes(sns_topic_arn_pattern)
     )
     
-    queue_url = response["QueueUrl"]
+    sqs_client.send_message(
+        QueueUrl = session_queue_pool_queue_url,
+        MessageBody = json.dumps({
+            "id": session_id,
+            "queue-url": response["QueueUrl"],
+            "created": int(time.time())
+        }),
+        # A group per queue lets queues be claimed concurrently while each one 
+        # can only be received by a single claimer.
+        MessageGroupId = session_id,
+        MessageDeduplicationId = session_id
+    )
+
+def claim_pooled_queue():
+    session_queue_pool_queue_url = os.environ.get("SESSION_QUEUE_POOL_QUEUE_URL", "")
     
-    response = sqs_client.get_queue_attributes(
-        QueueUrl = queue_url,
-        AttributeNames = ["QueueArn"]
+    if session_queue_pool_queue_url == "":
+        return None
+    
+    while True:
+        response = sqs_client.receive_message(
+            QueueUrl = session_queue_pool_queue_url,
+            MaxNumberOfMessages = 1,
+            WaitTimeSeconds = 0
+        )
+        
+        message_list = response.get("Messages", [])
+        
+        if len(message_list) == 0:
+            print("Session queue pool is empty.")
+            return None
+        
+        # The queue's name is the session's only credential, so it must be 
+        # removed from the pool for good before it's handed out.
+        sqs_client.delete_message(
+            QueueUrl = session_queue_pool_queue_url,
+            ReceiptHandle = message_list[0]["ReceiptHandle"]
+        )
+        
+        pooled_queue = json.loads(message_list[0]["Body"])
+        
+        if pooled_queue["created"] + max_pooled_queue_age_seconds > time.time():
+            return pooled_queue["id"], pooled_queue["queue-url"]
+        
+        print("Deleting stale pooled queue: {}".format(pooled_queue["queue-url"]))
+        
+        try:
+            sqs_client.delete_queue(
+                QueueUrl = pooled_queue["queue-url"]
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "AWS.SimpleQueueService.NonExistentQueue":
+                print("Queue already deleted.")
+            else:
+                raise
+
+def generate_new_session_id():
+    return zbase32.b2a(uuid.uuid4().bytes)
+
+def create_and_initialize_queue(event, context, sqs_queue_name, session_id, queue_url = None):
+    
+    setup_start_time = time.time()
+    
+    aws_region = context.invoked_function_arn.split(":")[3]
+    aws_account_id = context.invoked_function_arn.split(":")[4]
+    
+    sns_topic_arn = "arn:aws:sns:{aws_region}:{aws_account_id}:{topic_name}".format(
+        aws_region = aws_region,
+        aws_account_id = aws_account_id,
+        topic_name = generate_room_sns_topic_name(event["pathParameters"]["room-id"])
     )
     
-    queue_arn = response["Attributes"]["QueueArn"]
+    # Queues are always created in this function's own region and account, 
+    # so there's no need to ask SQS for the ARN.
+    queue_arn = "arn:aws:sqs:{aws_region}:{aws_account_id}:{queue_name}".format(
+        aws_region = aws_region,
+        aws_account_id = aws_account_id,
+        queue_name = sqs_queue_name
+    )
+    
+    step_timings = []
+    
+    if queue_url is None:
+        create_queue_seconds, response = call_timed(
+            sqs_client.create_queue,
+            QueueName = sqs_queue_name,
+            Attributes = get_default_queue_attributes(sns_topic_arn)
+        )
+        
+        queue_url = response["QueueUrl"]
+        step_timings.append(("create-queue", create_queue_seconds))
     
     message_object = {
         "identity-id": "SYSTEM",
@@ -84,44 +242,61 @@ def create_and_initialize_queue(event, context, sqs_queue_name, session_id):
         "timestamp": int(time.time())
     }
     
-    try:
-        sns_client.publish(
-            TopicArn = sns_topic_arn,
-            Message = json.dumps(message_object)
-        )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'AuthorizationError':
-            print("Unauthorized to publish to room's SNS topic ({}). Assuming it doesn't exist.".format(
-                sns_topic_arn
-            ))
-            
-            sqs_client.delete_queue(
-                QueueUrl = queue_url
-            )
-            
-            raise APIGatewayException("Room specified doesn't exist or is closed.", 400)
-        else:
-            raise
+    # The client only relies on finding SESSION_STARTED in the room's history 
+    # and then reading everything after it from its queue, so the publish and 
+    # subscribe don't need to be ordered. Either one failing authorization 
+    # means the room's topic doesn't exist.
+    pending_results = [
+        ("publish", session_setup_pool.apply_async(call_timed, (sns_client.publish, ), {
+            "TopicArn": sns_topic_arn,
+            "Message": json.dumps(message_object)
+        })),
+        ("subscribe", session_setup_pool.apply_async(call_timed, (sns_client.subscribe, ), {
+            "TopicArn": sns_topic_arn,
+            "Protocol": "sqs",
+            "Endpoint": queue_arn
+        }))
+    ]
     
-    try:
-        subscribe_response = boto3.client("sns").subscribe(
-            TopicArn = sns_topic_arn,
-            Protocol = "sqs",
-            Endpoint = queue_arn
+    room_topic_unauthorized = False
+    unexpected_exception_info = None
+    
+    for each_step_name, each_pending_result in pending_results:
+        try:
+            step_timings.append((each_step_name, each_pending_result.get()[0]))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'AuthorizationError':
+                print("Unauthorized to {} to room's SNS topic ({}). Assuming it doesn't exist.".format(
+                    each_step_name,
+                    sns_topic_arn
+                ))
+                room_topic_unauthorized = True
+            elif unexpected_exception_info is None:
+                unexpected_exception_info = sys.exc_info()
+        except Exception:
+            if unexpected_exception_info is None:
+                unexpected_exception_info = sys.exc_info()
+    
+    if room_topic_unauthorized:
+        sqs_client.delete_queue(
+            QueueUrl = queue_url
         )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'AuthorizationError':
-            print("Unauthorized to subscribe to room's SNS topic ({}). Assuming it doesn't exist.".format(
-                sns_topic_arn
-            ))
-            
-            sqs_client.delete_queue(
-                QueueUrl = queue_url
-            )
-            
-            raise APIGatewayException("Room specified doesn't exist or is closed.", 400)
-        else:
-            raise
+        
+        raise APIGatewayException("Room specified doesn't exist or is closed.", 400)
+    
+    if unexpected_exception_info is not None:
+        six.reraise(*unexpected_exception_info)
+    
+    step_timings.append(("total", time.time() - setup_start_time))
+    
+    print("Session setup timings: {}".format(
+        ", ".join("{}: {:.0f} ms".format(x, 1000 * y) for x, y in step_timings)
+    ))
+
+def call_timed(function, *args, **kwargs):
+    start_time = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start_time, result
 
 def generate_room_sns_topic_name(room_id):
     return "{}-{}".format(
@@ -129,11 +304,10 @@ def generate_room_sns_topic_name(room_id):
         room_id
     )
 
-def get_queue_name(event, session_id):
+def get_queue_name(session_id):
     
-    return "{}-{}-{}".format(
+    return "{}-{}".format(
         os.environ["PROJECT_GLOBAL_PREFIX"],
-        event["pathParameters"]["room-id"].replace("-", ""),
         session_id.replace("-", "")
     )
 
@@ -158,7 +332,8 @@ def get_default_queue_attributes(sns_topic_arn):
                 "Action": "sqs:SendMessage",
                 "Resource": "*",
                 "Condition": {
-                    "ArnEquals": {
+                    # Pooled queues are given a wildcard topic ARN.
+                    "ArnLike": {
                         "aws:SourceArn": sns_topic_arn
                     }
                 }
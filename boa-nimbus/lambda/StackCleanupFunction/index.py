@@ -11,21 +11,47 @@ This includes:
  * SQS queues
  * CloudWatch log groups
 
+Cleanup that would outlast the function's timeout saves where it got to and
+continues in a new invocation. CloudFormation is only sent a response once 
+everything's deleted.
+
 """
 
 from __future__ import print_function
 
 import os
 import json
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 import boto3
 import botocore
+import botocore.config
 import cfnresponse
 
-s3_client = boto3.client("s3")
-sns_client = boto3.client("sns")
-sqs_client = boto3.client("sqs")
-logs_client = boto3.client("logs")
-apig_client = boto3.client("apigateway")
+# Individual deletions across all resource families share this many workers.
+max_deletion_workers = 20
+
+# Deletions queued up ahead of the workers, to bound memory while listing.
+max_pending_deletions = 2 * max_deletion_workers
+
+max_keys_per_delete = 1000
+
+client_config = botocore.config.Config(max_pool_connections=max_deletion_workers)
+
+s3_client = boto3.client("s3", config=client_config)
+sns_client = boto3.client("sns", config=client_config)
+sqs_client = boto3.client("sqs", config=client_config)
+logs_client = boto3.client("logs", config=client_config)
+apig_client = boto3.client("apigateway", config=client_config)
+
+deletion_pool = ThreadPool(processes=max_deletion_workers)
+
+lambda_client = boto3.client("lambda")
+
+# Cleanup stops listing when this much time is left, which leaves time for 
+# queued deletions to finish before continuing in a new invocation.
+reserved_time_millis = 60000
 
 def lambda_handler(event, context):
     print("Event: {}".format(json.dumps(event)))
@@ -33,69 +59,211 @@ def lambda_handler(event, context):
     request_type = event.get("RequestType")
 
     if request_type == "Delete":
-        handle_cleanup_event(event, context)
+        cleanup_state = event.get("cleanup-state", {})
+        
+        if not handle_cleanup_event(event, context, cleanup_state):
+            continue_cleanup_in_new_invocation(event, context, cleanup_state)
+            
+            # CloudFormation is only told once everything's deleted.
+            return {}
 
     cfnresponse.send(event, context, cfnresponse.SUCCESS, {}, None)
 
     return {}
 
-def handle_cleanup_event(event, context):
+def continue_cleanup_in_new_invocation(event, context, cleanup_state):
+    print("Out of time. Continuing cleanup in a new invocation from: {}".format(json.dumps(cleanup_state)))
+    
+    lambda_client.invoke(
+        FunctionName = context.invoked_function_arn,
+        InvocationType = "Event",
+        Payload = json.dumps(dict(event, **{
+            "cleanup-state": cleanup_state
+        }))
+    )
+
+def handle_cleanup_event(event, context, cleanup_state):
+    """Cleans up the resources for the event, resuming from cleanup_state.
+    
+    Returns True once everything's deleted. Returns False if this invocation 
+    ran low on time first, in which case cleanup_state records where each 
+    resource family left off.
+    
+    """
     
     resource_props = event.get("ResourceProperties", {})
     
     bucket_content_type = resource_props.get("BucketContentType")
     
+    is_out_of_time = lambda: context.get_remaining_time_in_millis() < reserved_time_millis
+    
     if bucket_content_type == "Default":
         
         aws_region = context.invoked_function_arn.split(":")[3]
         aws_account_id = context.invoked_function_arn.split(":")[4]
         
-        cleanup_sns_topics()
+        # The resource families don't depend on each other, so they're 
+        # cleaned up at the same time. Their individual deletions share the 
+        # deletion pool.
+        return run_cleanups_concurrently([
+            ("sns-topics", "SNS topics", cleanup_sns_topics),
+            ("log-groups", "CloudWatch log groups", lambda x, y: cleanup_log_groups(aws_region, aws_account_id, x, y)),
+            ("sqs-queues", "SQS queues", cleanup_sqs_queues),
+            ("s3-objects", "S3 objects", lambda x, y: cleanup_s3_bucket(resource_props["Bucket"], x, y))
+        ], cleanup_state, is_out_of_time)
+    
+    elif bucket_content_type == "PrecreatedApiKey":
         
-        cleanup_log_groups(aws_region, aws_account_id)
+        # The API keys to delete are listed in the bucket, so it has to be 
+        # emptied afterward.
+        if not run_cleanups_concurrently([
+            ("api-keys", "API keys", lambda x, y: cleanup_precreated_api_keys(resource_props["Bucket"], x, y))
+        ], cleanup_state, is_out_of_time):
+            return False
         
-        cleanup_sqs_queues()
+        return run_cleanups_concurrently([
+            ("s3-objects", "S3 objects", lambda x, y: cleanup_s3_bucket(resource_props["Bucket"], x, y))
+        ], cleanup_state, is_out_of_time)
+    
+    else:
+        return run_cleanups_concurrently([
+            ("s3-objects", "S3 objects", lambda x, y: cleanup_s3_bucket(resource_props["Bucket"], x, y))
+        ], cleanup_state, is_out_of_time)
+
+def run_cleanups_concurrently(cleanup_list, cleanup_state, is_out_of_time):
+    """Runs the cleanup function of each (state key, description, function) 
+    at the same time, skipping those cleanup_state shows are already complete.
+    
+    Each function is given its own state dict (from cleanup_state, under its 
+    state key) and is_out_of_time. It returns the number of things it deleted 
+    and sets "complete" in its state once there's nothing left. Returns 
+    whether every function is complete.
+    
+    """
+    
+    def run_cleanup(cleanup_tuple):
+        state_key, description, cleanup_function = cleanup_tuple
+        
+        family_state = cleanup_state.setdefault(state_key, {})
+        
+        if family_state.get("complete", False):
+            return
+        
+        start_time = time.time()
+        deleted_count = cleanup_function(family_state, is_out_of_time)
+        elapsed_seconds = time.time() - start_time
         
-        cleanup_s3_bucket(resource_props["Bucket"])
+        family_state["deleted"] = family_state.get("deleted", 0) + deleted_count
+        
+        print("Deleted {} {} in {:.1f} second(s) ({:.1f} per second). {} deleted in total{}.".format(
+            deleted_count,
+            description,
+            elapsed_seconds,
+            deleted_count / max(elapsed_seconds, 0.001),
+            family_state["deleted"],
+            "" if family_state.get("complete", False) else " so far"
+        ))
     
-    elif bucket_content_type == "PrecreatedApiKey":
+    pool = ThreadPool(processes=len(cleanup_list))
+    
+    try:
+        pool.map(run_cleanup, cleanup_list)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return all(cleanup_state[x[0]].get("complete", False) for x in cleanup_list)
+
+def iterate_list_responses(list_function, list_kwargs, token_request_name, token_response_name, family_state, is_out_of_time):
+    """Yields list responses, starting from the token saved in family_state.
+    
+    Stops early if is_out_of_time returns True. The token in family_state
+    is that of the first response not yet yielded, so it advances while the
+    deletions for earlier responses may still be pending (delete_concurrently
+    pulls items lazily). That's safe because family_state is only persisted,
+    by handing it to a new invocation, after delete_concurrently has returned
+    and every deletion has finished. A failed deletion raises before that, so
+    the state is never saved past it.
+    
+    """
+    
+    while True:
+        if is_out_of_time():
+            return
+        
+        each_list_kwargs = dict(list_kwargs)
         
-        cleanup_precreated_api_keys(resource_props["Bucket"])
+        if family_state.get("next-token") is not None:
+            each_list_kwargs[token_request_name] = family_state["next-token"]
         
-        cleanup_s3_bucket(resource_props["Bucket"])
+        response = list_function(**each_list_kwargs)
+        
+        yield response
+        
+        family_state["next-token"] = response.get(token_response_name)
+        
+        if family_state["next-token"] is None:
+            family_state["complete"] = True
+            return
+
+def delete_concurrently(delete_function, items):
+    """Calls delete_function on each item on the deletion pool and returns the
+    sum of what it returns.
     
-    else:
-        cleanup_s3_bucket(resource_props["Bucket"])
+    Items are taken from the iterable as deletions finish rather than all at 
+    once, so a paginator can be passed in without every page being listed 
+    into memory first.
+    
+    """
+    
+    pending_semaphore = threading.BoundedSemaphore(max_pending_deletions)
+    
+    def run_delete_function(item):
+        try:
+            return delete_function(item)
+        finally:
+            pending_semaphore.release()
+    
+    async_results = []
+    
+    for each_item in items:
+        pending_semaphore.acquire()
+        async_results.append(deletion_pool.apply_async(run_delete_function, (each_item, )))
+    
+    return sum(x.get() for x in async_results)
 
-def cleanup_sns_topics():
+def cleanup_sns_topics(family_state, is_out_of_time):
     
     print("Listing SNS topics to clean up.")
     
     stack_topic_prefix = "{}-".format(os.environ["PROJECT_GLOBAL_PREFIX"])
     
-    for each_response in sns_client.get_paginator('list_topics').paginate():
-        topic_arns_list = list(x["TopicArn"] for x in each_response.get("Topics", []))
-        
-        topics_to_delete = []
-        for each_topic_arn in topic_arns_list:
-            each_topic_name = ":".join(each_topic_arn.split(":")[5:])
-            if each_topic_name.startswith(stack_topic_prefix):
-                topics_to_delete.append(each_topic_arn)
-        
-        for each_topic_arn in topics_to_delete:
-            print("Deleting SNS topic: {}".format(each_topic_arn))
-            
-            try:
-                sns_client.delete_topic(
-                    TopicArn = each_topic_arn
-                )
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == 'AuthorizationError':
-                    print("Unauthorized to delete room topic. Presumed already deleted.")
-                else:
-                    raise
-
-def cleanup_log_groups(aws_region, aws_account_id):
+    def get_topic_arns_to_delete():
+        for each_response in iterate_list_responses(sns_client.list_topics, {}, "NextToken", "NextToken", family_state, is_out_of_time):
+            for each_topic in each_response.get("Topics", []):
+                each_topic_name = ":".join(each_topic["TopicArn"].split(":")[5:])
+                
+                if each_topic_name.startswith(stack_topic_prefix):
+                    yield each_topic["TopicArn"]
+    
+    return delete_concurrently(delete_sns_topic, get_topic_arns_to_delete())
+
+def delete_sns_topic(topic_arn):
+    print("Deleting SNS topic: {}".format(topic_arn))
+    
+    try:
+        sns_client.delete_topic(
+            TopicArn = topic_arn
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'AuthorizationError':
+            print("Unauthorized to delete room topic. Presumed already deleted.")
+        else:
+            raise
+    
+    return 1
+
+def cleanup_log_groups(aws_region, aws_account_id, family_state, is_out_of_time):
     
     prefix_list = []
     
@@ -108,147 +276,212 @@ def cleanup_log_groups(aws_region, aws_account_id):
         )
     )
     
-    for each_prefix in prefix_list:
+    def get_log_group_names_to_delete(prefix_state, prefix):
         
-        print("Listing CloudWatch log groups to clean up starting with {}".format(each_prefix))
+        print("Listing CloudWatch log groups to clean up starting with {}".format(prefix))
         
-        response_iterator = logs_client.get_paginator("describe_log_groups").paginate(
-            logGroupNamePrefix = each_prefix
+        response_iterator = iterate_list_responses(
+            logs_client.describe_log_groups,
+            {
+                "logGroupNamePrefix": prefix
+            },
+            "nextToken",
+            "nextToken",
+            prefix_state,
+            is_out_of_time
         )
         
         for each_response in response_iterator:
-            log_group_names = list(x["logGroupName"] for x in each_response.get("logGroups", []))
-            
-            for each_log_group_name in log_group_names:
-                print("Deleting CloudWatch log group: {}".format(each_log_group_name))
-                
-                try:
-                    logs_client.delete_log_group(
-                        logGroupName = each_log_group_name
-                    )
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                        print("Log group already deleted.")
-                    else:
-                        raise
-
-def cleanup_sqs_queues():
+            for each_log_group in each_response.get("logGroups", []):
+                yield each_log_group["logGroupName"]
+    
+    deleted_count = 0
+    
+    for each_prefix in prefix_list:
+        prefix_state = family_state.setdefault("prefixes", {}).setdefault(each_prefix, {})
+        
+        if not prefix_state.get("complete", False):
+            deleted_count += delete_concurrently(delete_log_group, get_log_group_names_to_delete(prefix_state, each_prefix))
+    
+    family_state["complete"] = all(family_state["prefixes"][x].get("complete", False) for x in prefix_list)
+    
+    return deleted_count
+
+def delete_log_group(log_group_name):
+    print("Deleting CloudWatch log group: {}".format(log_group_name))
+    
+    try:
+        logs_client.delete_log_group(
+            logGroupName = log_group_name
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            print("Log group already deleted.")
+        else:
+            raise
+    
+    return 1
+
+def cleanup_sqs_queues(family_state, is_out_of_time):
     
     print("Listing SQS queues to clean up.")
     
     deleted_queue_url_map = {}
     
+    # ListQueues isn't paginated and returns at most 1,000 queues, and deleted
+    # queues can keep showing up for a while. So keep listing until only 
+    # deleted queues are returned. There's no token to save, so a resumed 
+    # cleanup just lists again.
     while True:
-    
+        
+        if is_out_of_time():
+            return len(deleted_queue_url_map)
+        
         response = sqs_client.list_queues(
             QueueNamePrefix = "{}-".format(
                 os.environ["PROJECT_GLOBAL_PREFIX"]
             )
         )
         
-        queue_urls = response.get("QueueUrls", [])
+        queue_urls = list(x for x in response.get("QueueUrls", []) if x not in deleted_queue_url_map)
         
         if len(queue_urls) == 0:
-            print("Request for stack's queues returned no results.")
+            print("Request for stack's queues returned no undeleted queues.")
+            family_state["complete"] = True
             break
         
-        deletions_attempted = 0
+        delete_concurrently(delete_sqs_queue, queue_urls)
         
         for each_queue_url in queue_urls:
-            if each_queue_url in deleted_queue_url_map:
-                continue
-            
-            print("Deleting queue: {}".format(each_queue_url))
-            
-            deletions_attempted += 1
-            
-            try:
-                sqs_client.delete_queue(
-                    QueueUrl = each_queue_url
-                )
-                
-                deleted_queue_url_map[each_queue_url] = True
-            except botocore.exceptions.ClientError as e:
-                if e.response["Error"]["Code"] == "AWS.SimpleQueueService.NonExistentQueue":
-                    print("Queue already deleted.")
-                else:
-                    raise
-        
-        if deletions_attempted == 0:
-            print("Last request for queues returned only queues we've already deleted.")
-            break
+            deleted_queue_url_map[each_queue_url] = True
+    
+    return len(deleted_queue_url_map)
 
-def cleanup_s3_bucket(s3_bucket_name):
+def delete_sqs_queue(queue_url):
+    print("Deleting queue: {}".format(queue_url))
+    
+    try:
+        sqs_client.delete_queue(
+            QueueUrl = queue_url
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "AWS.SimpleQueueService.NonExistentQueue":
+            print("Queue already deleted.")
+        else:
+            raise
+    
+    return 1
+
+def cleanup_s3_bucket(s3_bucket_name, family_state, is_out_of_time):
     
     print("Deleting objects in S3 bucket: {}".format(s3_bucket_name))
     
-    response_iterator = s3_client.get_paginator("list_objects_v2").paginate(
-        Bucket = s3_bucket_name
+    # Each listed page holds at most 1,000 keys, which is also the most a 
+    # single DeleteObjects request accepts.
+    def get_key_batches():
+        response_iterator = iterate_list_responses(
+            s3_client.list_objects_v2,
+            {
+                "Bucket": s3_bucket_name,
+                "MaxKeys": max_keys_per_delete
+            },
+            "ContinuationToken",
+            "NextContinuationToken",
+            family_state,
+            is_out_of_time
+        )
+        
+        for each_list_response in response_iterator:
+            keys_to_delete = list(x["Key"] for x in each_list_response.get("Contents", []))
+            
+            if len(keys_to_delete) > 0:
+                yield keys_to_delete
+    
+    deleted_count = delete_concurrently(
+        lambda x: delete_s3_objects(s3_bucket_name, x),
+        get_key_batches()
     )
+    
+    return deleted_count
 
-    for each_list_response in response_iterator:
-        keys_to_delete = []
-
-        for each_item in each_list_response.get("Contents", []):
-            keys_to_delete.append(each_item["Key"])
-
-        if len(keys_to_delete) == 0:
-            print("Last request for objects in {} returned none.".format(
-                s3_bucket_name
-            ))
-            break
+def delete_s3_objects(s3_bucket_name, keys_to_delete):
+    print("Deleting {} object(s) from {}.".format(
+        len(keys_to_delete),
+        s3_bucket_name
+    ))
     
-    if len(keys_to_delete) > 0:
-        print("Deleting {} object(s) from {}.".format(
-            len(keys_to_delete),
-            s3_bucket_name
+    response = s3_client.delete_objects(
+        Bucket = s3_bucket_name,
+        Delete = {
+            "Objects": list({"Key": x} for x in keys_to_delete),
+            "Quiet": True
+        }
+    )
+    
+    error_list = response.get("Errors", [])
+    
+    if len(error_list) > 0:
+        raise Exception("Unable to delete {} object(s) from {}. First error: {}".format(
+            len(error_list),
+            s3_bucket_name,
+            error_list[0]
         ))
     
-        s3_client.delete_objects(
-            Bucket = s3_bucket_name,
-            Delete = {
-                "Objects": list({"Key": x} for x in keys_to_delete)
-            }
-        )
+    return len(keys_to_delete)
 
-    print("Object(s) deleted.")
-
-def cleanup_precreated_api_keys(s3_bucket_name):
+def cleanup_precreated_api_keys(s3_bucket_name, family_state, is_out_of_time):
     
     print("Deleting precreated API keys in S3 bucket: {}".format(s3_bucket_name))
     
-    response_iterator = s3_client.get_paginator("list_objects_v2").paginate(
-        Bucket = s3_bucket_name,
-        Prefix = "generated-api-keys/"
+    def get_api_key_object_keys():
+        response_iterator = iterate_list_responses(
+            s3_client.list_objects_v2,
+            {
+                "Bucket": s3_bucket_name,
+                "Prefix": "generated-api-keys/"
+            },
+            "ContinuationToken",
+            "NextContinuationToken",
+            family_state,
+            is_out_of_time
+        )
+        
+        for each_list_response in response_iterator:
+            for each_item in each_list_response.get("Contents", []):
+                yield each_item["Key"]
+    
+    return delete_concurrently(
+        lambda x: delete_precreated_api_key(s3_bucket_name, x),
+        get_api_key_object_keys()
     )
 
-    for each_list_response in response_iterator:
-        for each_item in each_list_response.get("Contents", []):
-            each_key = each_item["Key"]
-            
-            try:
-                response = s3_client.get_object(
-                    Bucket = s3_bucket_name,
-                    Key = each_key
-                )
-            except botocore.exceptions.ClientError as e:
-                if e.response["Error"]["Code"] == "NoSuchKey":
-                    # Object is already deleted.
-                    continue
-                else:
-                    raise
-            
-            api_key_dict = json.loads(response["Body"].read())
-            api_key_id = api_key_dict["api-key-id"]
-            
-            print("Deleting API Key: {}".format(api_key_id))
-            
-            try:
-                apig_client.delete_api_key(
-                    apiKey = api_key_id
-                )
-            except botocore.exceptions.ClientError as e:
-                if e.response["Error"]["Code"] == "NotFoundException":
-                    print("API Key not found. Assumed already deleted.")
-                else:
-                    raise
\ No newline at end of file
+def delete_precreated_api_key(s3_bucket_name, object_key):
+    
+    try:
+        response = s3_client.get_object(
+            Bucket = s3_bucket_name,
+            Key = object_key
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            # Object is already deleted.
+            return 0
+        else:
+            raise
+    
+    api_key_dict = json.loads(response["Body"].read())
+    api_key_id = api_key_dict["api-key-id"]
+    
+    print("Deleting API Key: {}".format(api_key_id))
+    
+    try:
+        apig_client.delete_api_key(
+            apiKey = api_key_id
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NotFoundException":
+            print("API Key not found. Assumed already deleted.")
+        else:
+            raise
+    
+    return 1
@@ -6,6 +6,21 @@ Using this Lambda-backed API Gateway endpoint as a proxy, we avoid having to
 expose the plain MD5 hash of each user's e-mail address. This allows for more 
 realistic e-mail address privacy.
 
+Only one full-size master avatar is pulled from Gravatar and kept in S3 for 
+each user. Requested sizes are rounded up to the nearest size on a fixed 
+ladder and resized from the master here.
+
+Avatars are returned with ETag, Cache-Control and Expires headers based on 
+Gravatar's own expiration, and requests with a matching If-None-Match get an
+empty 304 response.
+
+Resizing uses Pillow, which is compiled. The build (boa-nimbus build 
+--no-use-docker, see buildspec.yml) installs whatever pip resolves on the 
+build host, so requirements.txt pins Pillow 6.2.2, the last release for 
+Python 2.7. Its cp27-cp27mu-manylinux1_x86_64 wheel is the one the build 
+must resolve to run on Lambda. The CI builder image only accepts Pillow as 
+a wheel, so the build fails rather than packaging a source build.
+
 """
 
 from __future__ import print_function
@@ -15,12 +30,18 @@ import json
 import time
 import base64
 import hashlib
+import calendar
+from io import BytesIO
 from datetime import datetime
 import requests
+from PIL import Image
 import boto3
 import botocore
 from apigateway_helpers.exception import APIGatewayException
-from apigateway_helpers.headers import get_response_headers as get_base_response_headers
+from apigateway_helpers.headers import get_response_headers
+from project_local.cache import ByteBoundedLRUCache
+from project_local.profile_changes import ProfileChangeWatcher
+from project_local.user_directory import UserDirectory
 
 cognito_identity_client = boto3.client("cognito-identity")
 cognito_idp_client = boto3.client("cognito-idp")
@@ -32,9 +53,32 @@ identity_pool_id = os.environ["COGNITO_IDENTITY_POOL_ID"]
 user_pool_id = os.environ["COGNITO_USER_POOL_ID"]
 user_profile_dataset_name = os.environ["COGNITO_USER_PROFILE_DATASET_NAME"]
 
+# Users' e-mail addresses and avatar hashes, so most avatar refreshes don't 
+# need Cognito.
+user_directory = UserDirectory(
+    cognito_idp_client,
+    user_pool_id,
+    cognito_sync_client = cognito_sync_client,
+    identity_pool_id = identity_pool_id,
+    user_profile_dataset_name = user_profile_dataset_name,
+    profile_change_watcher = ProfileChangeWatcher(s3_client, shared_bucket_name)
+)
+
 cached_gravatars_prefix = "cached-gravatars/"
 http_strftime_format = "%a, %d %b %Y %H:%M:%S %Z"
 
+# Size of the master avatar pulled from Gravatar. Larger requested sizes get 
+# the master itself.
+master_image_size = 512
+
+# Requested sizes are rounded up to one of these so only a handful of sizes 
+# are ever resized and cached.
+ladder_image_sizes = [16, 24, 32, 40, 48, 64, 80, 96, 128, 160, 192, 256, 320, 384, master_image_size]
+
+# Master and derived avatars served by this container, keyed by identity ID 
+# and size (or "master"). Lets most requests skip S3 and resizing entirely.
+avatar_cache = ByteBoundedLRUCache(16 * 1024 * 1024)
+
 def lambda_handler(event, context):
     
     print("Event: {}".format(json.dumps(event)))
@@ -49,14 +93,18 @@ def lambda_handler(event, context):
     if identity_id == "":
         raise APIGatewayException("Parameter \"user-id\" specified in path must be longer than zero characters.", 400)
     
-    user_specified_author_avatar_hash = event["queryStringParameters"].get("hash")
+    # Proxy integrations give null rather than an empty object when there's 
+    # no query string.
+    query_string_parameters = event.get("queryStringParameters") or {}
+    
+    user_specified_author_avatar_hash = query_string_parameters.get("hash")
     
     # Pixels
     image_size = 80
     
-    if "s" in event["queryStringParameters"]:
+    if "s" in query_string_parameters:
         try:
-            image_size = int(event["queryStringParameters"]["s"])
+            image_size = int(query_string_parameters["s"])
             if image_size < 1:
                 raise Exception
             if image_size > 2048:
@@ -64,92 +112,127 @@ def lambda_handler(event, context):
         except:
             raise APIGatewayException("Parameter \"s\" must be a positive integer up to 2048.", 400)
     
-    cached_avatar_available = False
-    cached_avatar_last_modified_string = None
-    force_fresh_gravatar_pull = False
+    ladder_image_size = get_ladder_image_size(image_size)
     
-    try:
-        response = s3_client.head_object(
-            Bucket = shared_bucket_name,
-            Key = get_cached_gravatar_s3_key(identity_id, image_size)
-        )
-        
-        expires_datetime = datetime.strptime(response["Metadata"]["expires"], http_strftime_format)
-        
-        current_datetime = datetime.utcnow().replace(tzinfo=expires_datetime.tzinfo)
-        
-        seconds_until_expiration = int((expires_datetime - current_datetime).total_seconds())
-        
-        if seconds_until_expiration > 0:
-            cached_avatar_available = True
-            print("Expires in {} second(s).".format(seconds_until_expiration))
-        else:
-            print("Cached avatar expired {} second(s) ago.".format(-1 * seconds_until_expiration))
-        
-        cached_avatar_last_modified_string = response["Metadata"].get("source-last-modified")
-        
-        if "author-avatar-hash" in response["Metadata"] and user_specified_author_avatar_hash is not None:
-            if user_specified_author_avatar_hash != response["Metadata"]["author-avatar-hash"]:
-                cached_avatar_available = False
-                force_fresh_gravatar_pull = True
-                print("Cached avatar is for a different e-mail address than user requested.")
-        
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            pass
-        else:
-            raise
+    if ladder_image_size != image_size:
+        print("Serving requested size {} from ladder size {}.".format(image_size, ladder_image_size))
     
-    if cached_avatar_available:
-        print("Cached avatar not yet expired. Returning it.")
-        
-        return return_cached_object(identity_id, image_size)
+    cache_key = "{}/{}".format(identity_id, ladder_image_size)
     
+    cached_avatar = avatar_cache.get(cache_key)
     
-    try:
-        response = cognito_sync_client.list_records(
-            IdentityPoolId = identity_pool_id,
-            IdentityId = identity_id,
-            DatasetName = user_profile_dataset_name
-        )
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'ValidationException':
-            raise APIGatewayException("Parameter \"user-id\" specified in path does not correspond to a valid user.", 400)
-        else:
-            raise
+    if cached_avatar is not None and is_avatar_current(cached_avatar, user_specified_author_avatar_hash):
+        print("Returning derived avatar from memory.")
+        return cached_avatar
     
-    user_pool_user_id = None
+    master_avatar = get_master_avatar(identity_id, user_specified_author_avatar_hash)
     
-    for each_record in response.get("Records", []):
-        if each_record["Key"] == "user-id":
-            user_pool_user_id = each_record["Value"]
-            break
+    if ladder_image_size == master_image_size:
+        return master_avatar
     
-    if user_pool_user_id is None:
-        raise APIGatewayException("Parameter \"user-id\" specified in path does not correspond to a valid user.", 400)
+    if cached_avatar is not None and cached_avatar["master-etag"] == master_avatar["etag"]:
+        # The master hasn't changed, so neither has this size. Only its 
+        # expiration needs to catch up.
+        avatar = dict(cached_avatar, **{
+            "expires": master_avatar["expires"]
+        })
+    else:
+        avatar = get_derived_avatar(master_avatar, ladder_image_size)
     
-    response = cognito_idp_client.admin_get_user(
-        UserPoolId = user_pool_id,
-        Username = user_pool_user_id
-    )
+    avatar_cache.put(cache_key, avatar, len(avatar["body"]))
     
-    user_email_address = None
-    user_email_address_verified = False
-    user_sub = None
+    return avatar
+
+def get_ladder_image_size(image_size):
+    """Returns the smallest ladder size at least as large as image_size."""
+    
+    for each_ladder_image_size in ladder_image_sizes:
+        if each_ladder_image_size >= image_size:
+            return each_ladder_image_size
+    
+    return master_image_size
+
+def is_avatar_current(avatar, user_specified_author_avatar_hash):
+    
+    seconds_until_expiration = avatar["expires"] - int(time.time())
+    
+    if seconds_until_expiration > 0:
+        print("Expires in {} second(s).".format(seconds_until_expiration))
+    else:
+        print("Cached avatar expired {} second(s) ago.".format(-1 * seconds_until_expiration))
+        return False
+    
+    if avatar["author-avatar-hash"] is not None and user_specified_author_avatar_hash is not None:
+        if user_specified_author_avatar_hash != avatar["author-avatar-hash"]:
+            print("Cached avatar is for a different e-mail address than user requested.")
+            return False
+    
+    return True
+
+def get_derived_avatar(master_avatar, image_size):
+    """Resizes the master avatar to image_size.
+    
+    The derived avatar's ETag comes from the master's, so it's the same in 
+    every container without having to hash the resized image.
+    
+    """
+    
+    print("Resizing master avatar to {}x{}.".format(image_size, image_size))
+    
+    image = Image.open(BytesIO(base64.b64decode(master_avatar["body"])))
+    
+    if image.mode not in ["RGB", "RGBA"]:
+        image = image.convert("RGBA")
+    
+    image = image.resize((image_size, image_size), Image.LANCZOS)
+    
+    image_buffer = BytesIO()
+    image.save(image_buffer, "PNG")
+    
+    return dict(master_avatar, **{
+        "body": base64.b64encode(image_buffer.getvalue()),
+        "etag": "{}-{}\"".format(master_avatar["etag"][:-1], image_size),
+        "master-etag": master_avatar["etag"]
+    })
+
+def get_master_avatar(identity_id, user_specified_author_avatar_hash):
+    """Returns the user's full-size avatar, pulling it from Gravatar only 
+    when neither memory nor S3 has a current copy."""
     
-    for each_attribute_set in response.get("UserAttributes", []):
-        if each_attribute_set["Name"] == "email":
-            user_email_address = each_attribute_set["Value"]
-        elif each_attribute_set["Name"] == "email_verified":
-            user_email_address_verified = each_attribute_set["Value"]
-        elif each_attribute_set["Name"] == "sub":
-            user_sub = each_attribute_set["Value"]
+    cache_key = "{}/master".format(identity_id)
     
-    author_avatar_hash = hashlib.md5("{}{}".format(user_sub, user_email_address)).hexdigest()
+    cached_avatar = avatar_cache.get(cache_key)
+    
+    if cached_avatar is None:
+        cached_avatar = get_s3_cached_avatar(identity_id)
+        
+        if cached_avatar is not None:
+            avatar_cache.put(cache_key, cached_avatar, len(cached_avatar["body"]))
+    
+    force_fresh_gravatar_pull = False
+    
+    if cached_avatar is not None:
+        if is_avatar_current(cached_avatar, user_specified_author_avatar_hash):
+            print("Cached master avatar not yet expired. Returning it.")
+            return cached_avatar
+        
+        if cached_avatar["author-avatar-hash"] is not None and user_specified_author_avatar_hash is not None:
+            force_fresh_gravatar_pull = user_specified_author_avatar_hash != cached_avatar["author-avatar-hash"]
+    
+    
+    user = user_directory.get_user(identity_id)
+    
+    print("User directory: {}".format(json.dumps(user_directory.get_stats())))
+    
+    if user is None:
+        raise APIGatewayException("Parameter \"user-id\" specified in path does not correspond to a valid user.", 400)
+    
+    user_email_address = user["email-address"]
+    author_avatar_hash = user["avatar-hash"]
     
     if user_email_address is None:
         raise Exception("Unable to find e-mail address in Cogito User Pool record.")
-    elif not user_email_address_verified:
+    elif not user["email-verified"]:
         raise Exception("User's e-mail address is not yet verified.")
     
     print("Request is for avatar of user with e-mail address: {}".format(user_email_address))
@@ -159,16 +242,16 @@ def lambda_handler(event, context):
     
     request_kwargs = {
         "params": {
-            "s": str(image_size),
+            "s": str(master_image_size),
             "r": "pg",
             "d": "identicon"
         },
         "headers": {}
     }
     
-    if cached_avatar_last_modified_string is not None and not force_fresh_gravatar_pull:
-        print("Last modified: {}".format(cached_avatar_last_modified_string))
-        request_kwargs["headers"]["If-Modified-Since"] = cached_avatar_last_modified_string
+    if cached_avatar is not None and not force_fresh_gravatar_pull:
+        print("Last modified: {}".format(cached_avatar["source-last-modified"]))
+        request_kwargs["headers"]["If-Modified-Since"] = cached_avatar["source-last-modified"]
     
     r = requests.get(
         "https://www.gravatar.com/avatar/{}".format(email_address_gravatar_hash),
@@ -177,27 +260,29 @@ def lambda_handler(event, context):
     
     r.raise_for_status()
     
+    s3_metadata = {
+        "Author-Avatar-Hash": author_avatar_hash,
+        "Expires": r.headers["Expires"],
+        "Source-Last-Modified": r.headers["Last-Modified"]
+    }
+    
     if r.status_code == 304:
         
         print("Gravatar not modified since cached version. Returning cached version.")
         
         response = s3_client.copy_object(
             Bucket = shared_bucket_name,
-            Key = get_cached_gravatar_s3_key(identity_id, image_size),
+            Key = get_cached_gravatar_s3_key(identity_id),
             CopySource = {
                 "Bucket": shared_bucket_name,
-                "Key": get_cached_gravatar_s3_key(identity_id, image_size)
+                "Key": get_cached_gravatar_s3_key(identity_id)
             },
             MetadataDirective = "REPLACE",
-            Metadata = {
-                "Author-Avatar-Hash": author_avatar_hash,
-                "Expires": r.headers["Expires"],
-                "Source-Last-Modified": r.headers["Last-Modified"]
-            }
+            Metadata = s3_metadata
         )
         
         # We can keep serving our cached version.
-        return return_cached_object(identity_id, image_size)
+        avatar = get_avatar(cached_avatar["body"], s3_metadata, cached_avatar["etag"])
         
     else:
         # Save this new version.
@@ -206,39 +291,86 @@ def lambda_handler(event, context):
         
         s3_client.put_object(
             Bucket = shared_bucket_name,
-            Key = get_cached_gravatar_s3_key(identity_id, image_size),
+            Key = get_cached_gravatar_s3_key(identity_id),
             Body = r.content,
-            Metadata = {
-                "Author-Avatar-Hash": author_avatar_hash,
-                "Expires": r.headers["Expires"],
-                "Source-Last-Modified": r.headers["Last-Modified"]
-            }
+            Metadata = s3_metadata
         )
+        
+        avatar = get_avatar(base64.b64encode(r.content), s3_metadata, get_etag(r.content))
+    
+    avatar_cache.put(cache_key, avatar, len(avatar["body"]))
     
-        return base64.b64encode(r.content)
+    return avatar
 
-def get_cached_gravatar_s3_key(identity_id, image_size):
-    return "{}{}/{}.png".format(
+def get_cached_gravatar_s3_key(identity_id):
+    return "{}{}/master.png".format(
         cached_gravatars_prefix,
-        identity_id,
-        image_size
+        identity_id
     )
 
-def return_cached_object(identity_id, image_size):
+def get_s3_cached_avatar(identity_id):
+    """Returns the avatar cached in S3 (even if expired) or None."""
     
-    response = s3_client.get_object(
-        Bucket = shared_bucket_name,
-        Key = get_cached_gravatar_s3_key(identity_id, image_size)
-    )
+    try:
+        response = s3_client.get_object(
+            Bucket = shared_bucket_name,
+            Key = get_cached_gravatar_s3_key(identity_id)
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return None
+        else:
+            raise
+    
+    image_bytes = response["Body"].read()
+    
+    # Metadata keys come back lowercased.
+    return get_avatar(base64.b64encode(image_bytes), response["Metadata"], get_etag(image_bytes))
+
+def get_avatar(base64_body, metadata, etag):
+    """Returns the avatar as held in the in-memory cache.
+    
+    Its body is kept base64-encoded, ready to return, and its expiration as 
+    seconds since the epoch.
+    
+    """
+    
+    metadata = dict((x.lower(), y) for x, y in metadata.items())
+    
+    return {
+        "body": base64_body,
+        "etag": etag,
+        "expires": calendar.timegm(datetime.strptime(metadata["expires"], http_strftime_format).timetuple()),
+        "source-last-modified": metadata.get("source-last-modified"),
+        "author-avatar-hash": metadata.get("author-avatar-hash")
+    }
+
+def get_etag(image_bytes):
+    return "\"{}\"".format(hashlib.md5(image_bytes).hexdigest())
+
+def get_avatar_response_headers(avatar):
+    seconds_until_expiration = max(0, avatar["expires"] - int(time.time()))
+    
+    return {
+        "Content-Type": "image/png",
+        "ETag": avatar["etag"],
+        "Cache-Control": "public, max-age={}".format(seconds_until_expiration),
+        "Expires": time.strftime(http_strftime_format.replace("%Z", "GMT"), time.gmtime(avatar["expires"]))
+    }
+
+def get_request_header(event, header_name):
+    for each_header_name, each_header_value in (event.get("headers") or {}).items():
+        if each_header_name.lower() == header_name.lower():
+            return each_header_value
     
-    return base64.b64encode(response["Body"].read())
+    return None
 
 def proxy_lambda_handler(event, context):
     
     response_headers = get_response_headers(event, context)
     
     try:
-        return_var = lambda_handler(event, context)
+        avatar = lambda_handler(event, context)
     except APIGatewayException as e:
         return {
             "statusCode": e.http_status_code,
@@ -248,8 +380,30 @@ def proxy_lambda_handler(event, context):
             })
         }
     
+    # Warming invocations don't return an avatar.
+    if "etag" not in avatar:
+        return {
+            "statusCode": 200,
+            "headers": response_headers,
+            "body": json.dumps(avatar)
+        }
+    
+    response_headers.update(get_avatar_response_headers(avatar))
+    
+    if_none_match = get_request_header(event, "If-None-Match")
+    
+    if if_none_match is not None and avatar["etag"] in (x.strip() for x in if_none_match.split(",")):
+        print("Client's copy of the avatar is current.")
+        
+        return {
+            "statusCode": 304,
+            "headers": response_headers,
+            "body": ""
+        }
+    
     return {
         "statusCode": 200,
         "headers": response_headers,
-        "body": return_var
-    }
\ No newline at end of file
+        "body": avatar["body"],
+        "isBase64Encoded": True
+    }
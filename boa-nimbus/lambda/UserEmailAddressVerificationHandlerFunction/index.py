@@ -19,6 +19,7 @@ import botocore
 from apigateway_helpers.exception import APIGatewayException
 from apigateway_helpers.headers import get_response_headers
 from cognito_helpers import generate_cognito_sign_up_secret_hash
+from project_local.profile_changes import record_profile_change
 
 s3_client = boto3.client("s3")
 apig_client = boto3.client("apigateway")
@@ -129,6 +130,10 @@ def lambda_handler(event, context):
                 raise APIGatewayException("Invalid token provided. Please request another.", 400)
             else:
                 raise
+        
+        # The e-mail address is verified now, so let other functions drop any 
+        # profile they've cached for this user.
+        record_profile_change(s3_client, os.environ["SHARED_BUCKET"], cognito_user_pool_sub_value)
     
     response = cognito_idp_client.admin_get_user(
         UserPoolId = user_pool_id,
@@ -7,30 +7,55 @@ successful.
 
 import os
 import json
-import copy
 import datetime
 import calendar
 import time
+from multiprocessing.pool import ThreadPool
 import boto3
 import botocore
 from apigateway_helpers.exception import APIGatewayException
 from apigateway_helpers.headers import get_response_headers
 from cognito_helpers import generate_cognito_sign_up_secret_hash
+from project_local.cache import TTLCache
+from project_local.step_graph import StepGraph
 
 cognito_idp_client = boto3.client("cognito-idp")
 cognito_identity_client = boto3.client("cognito-identity")
 cognito_sync_client = boto3.client("cognito-sync")
 apig_client = boto3.client("apigateway")
 
+# Stored identity provider credentials aren't rewritten for the same refresh 
+# token until they're this close to expiring. Functions using them on the 
+# user's behalf only need them to still be valid.
+idp_credentials_rewrite_margin_seconds = 900
+
+# Identities never change users, so refreshes can map the identity ID to the 
+# user pool username without reading the profile dataset.
+identity_username_cache = TTLCache(1024, 3600)
+
+# The refresh token and expiration of the idp-credentials record last read 
+# or written for each identity. While it's still current, refreshes skip 
+# reading and updating the profile dataset entirely.
+stored_idp_credentials_cache = TTLCache(1024, 3600)
+
+# Steps of the login after authentication run on this pool as soon as what 
+# they need is available.
+login_pool = ThreadPool(processes=4)
+
 
 def lambda_handler(event, context):
     
     event["request-body"] = json.loads(event.get("body", "{}"))
     
-    event_for_logging = copy.deepcopy(event)
+    # Only the request body is redacted, so the rest is shared with the event.
+    event_for_logging = event
     
-    if "request-body" in event_for_logging and "password" in event_for_logging["request-body"]:
-        event_for_logging["request-body"]["password"] = "********"
+    if "password" in event["request-body"]:
+        event_for_logging = dict(event, **{
+            "request-body": dict(event["request-body"], **{
+                "password": "********"
+            })
+        })
         event_for_logging["body"] = json.dumps(event_for_logging["request-body"])
     
     print("Event: {}".format(json.dumps(event_for_logging)))
@@ -55,6 +80,7 @@ def lambda_handler(event, context):
     
     auth_flow = None
     auth_parameters = {}
+    prefetched_records = None
     
     if event["resource"] == "/user/login":
         auth_flow = "ADMIN_NO_SRP_AUTH"
@@ -74,16 +100,24 @@ def lambda_handler(event, context):
         if identity_id == "":
             raise APIGatewayException("Value for \"user-id\" must be specified in request body.", 400)
         
-        response = cognito_sync_client.list_records(
-            IdentityPoolId = identity_pool_id,
-            IdentityId = identity_id,
-            DatasetName = user_profile_dataset_name
-        )
+        user_id = identity_username_cache.get(identity_id)
         
-        for each_record in response["Records"]:
-            if each_record["Key"] == "user-id":
-                user_id = each_record["Value"]
-                break
+        if user_id is None:
+            response = cognito_sync_client.list_records(
+                IdentityPoolId = identity_pool_id,
+                IdentityId = identity_id,
+                DatasetName = user_profile_dataset_name
+            )
+            
+            for each_record in response["Records"]:
+                if each_record["Key"] == "user-id":
+                    user_id = each_record["Value"]
+                    break
+            
+            # Saves reading the same records again after authentication.
+            prefetched_records = (identity_id, response)
+        else:
+            print("Found user pool username for identity in cache.")
         
         if submitted_refresh_token is None:
             raise APIGatewayException("Value for \"refresh-token\" must be specified in request body.", 400)
@@ -96,6 +130,8 @@ def lambda_handler(event, context):
     
     print("Initiating auth ({}).".format(auth_flow))
     
+    initiate_auth_start_time = time.time()
+    
     try:
         response = cognito_idp_client.admin_initiate_auth(
             UserPoolId = user_pool_id,
@@ -113,119 +149,236 @@ def lambda_handler(event, context):
                 raise APIGatewayException("Refresh token specified is invalid or expired.", 400)
         raise
     
-    cognito_id_token = response["AuthenticationResult"]["IdToken"]
-    cognito_refresh_token = response["AuthenticationResult"].get("RefreshToken", submitted_refresh_token)
-    cognito_access_token = response["AuthenticationResult"]["AccessToken"]
-    cognito_access_token_type = response["AuthenticationResult"]["TokenType"]
-    cognito_access_token_expires = response["AuthenticationResult"]["ExpiresIn"]
+    initiate_auth_elapsed_seconds = time.time() - initiate_auth_start_time
     
-    response = cognito_idp_client.get_user(
-        AccessToken = cognito_access_token
+    authentication_result = response["AuthenticationResult"]
+    
+    step_graph = get_login_step_graph(
+        authentication_result,
+        submitted_refresh_token,
+        user_pool_id,
+        identity_pool_id,
+        user_profile_dataset_name,
+        prefetched_records
     )
     
-    user_id = response["Username"]
+    try:
+        step_results = step_graph.run(login_pool)
+    finally:
+        print("Login stage timings: initiate-auth: {:.0f} ms, {}".format(
+            1000 * initiate_auth_elapsed_seconds,
+            step_graph.get_timings_summary()
+        ))
     
-    user_email = None
+    user_id, user_email = step_results["get-user"]
+    identity_id = step_results["get-id"]
     
-    for each_attribute_pair in response["UserAttributes"]:
-        if each_attribute_pair["Name"] == "email":
-            user_email = each_attribute_pair["Value"]
-            break
+    identity_username_cache.put(identity_id, user_id)
+    credentials = step_results["get-credentials"]
+    
+    return {
+        "user": {
+            "user-id": identity_id,
+            "email-address": user_email
+        },
+        "credentials": {
+            "access-key-id": credentials["AccessKeyId"],
+            "secret-access-key": credentials["SecretKey"],
+            "session-token": credentials["SessionToken"],
+            "expiration": calendar.timegm(credentials["Expiration"].timetuple()) - int(time.time()),
+            "refresh-token": authentication_result.get("RefreshToken", submitted_refresh_token)
+        }
+    }
+
+def get_login_step_graph(authentication_result, submitted_refresh_token, user_pool_id, identity_pool_id, user_profile_dataset_name, prefetched_records = None):
+    """Returns the steps of the login that follow authentication.
+    
+    Fetching the user and the identity ID only need the tokens from 
+    authentication, so they run concurrently. So do fetching credentials and 
+    storing the tokens, which only need the identity ID.
+    
+    prefetched_records is an (identity ID, list_records response) pair read 
+    earlier in the request, used instead of reading them again if it's for 
+    the same identity.
+    
+    """
+    
+    cognito_id_token = authentication_result["IdToken"]
+    cognito_refresh_token = authentication_result.get("RefreshToken", submitted_refresh_token)
+    cognito_access_token = authentication_result["AccessToken"]
+    cognito_access_token_expires = authentication_result["ExpiresIn"]
     
     cognito_user_pool_provider_name = "cognito-idp.{}.amazonaws.com/{}".format(
         os.environ["AWS_DEFAULT_REGION"],
         user_pool_id
     )
     
-    print("Fetching identity id.")
+    step_graph = StepGraph()
     
-    response = cognito_identity_client.get_id(
-        IdentityPoolId = identity_pool_id,
-        Logins = {
-            cognito_user_pool_provider_name: cognito_id_token
-        }
+    step_graph.add_step(
+        "get-user",
+        lambda x: get_user_id_and_email(cognito_access_token)
     )
     
-    identity_id = response["IdentityId"]
+    step_graph.add_step(
+        "get-id",
+        lambda x: cognito_identity_client.get_id(
+            IdentityPoolId = identity_pool_id,
+            Logins = {
+                cognito_user_pool_provider_name: cognito_id_token
+            }
+        )["IdentityId"]
+    )
     
-    key_sync_count_map = {}
+    def list_records(step_inputs):
+        identity_id = step_inputs["get-id"]
+        
+        if is_stored_idp_credentials_current(stored_idp_credentials_cache.get(identity_id), cognito_refresh_token):
+            print("Stored identity provider credentials still current. Skipping records.")
+            return None
+        
+        if prefetched_records is not None and prefetched_records[0] == identity_id:
+            return prefetched_records[1]
+        
+        return cognito_sync_client.list_records(
+            IdentityPoolId = identity_pool_id,
+            IdentityId = identity_id,
+            DatasetName = user_profile_dataset_name
+        )
     
-    response = cognito_sync_client.list_records(
-        IdentityPoolId = identity_pool_id,
-        IdentityId = identity_id,
-        DatasetName = user_profile_dataset_name
+    step_graph.add_step(
+        "list-records",
+        list_records,
+        depends_on = ["get-id"]
     )
     
-    for each_record in response.get("Records", []):
-        key_sync_count_map[each_record["Key"]] = each_record.get("SyncCount", 0)
-    
-    sync_session_token = response["SyncSessionToken"]
+    def update_records(step_inputs):
+        
+        if step_inputs["list-records"] is None:
+            return
         
-    records_to_replace = {
-        "user-id": user_id,
-        "idp-credentials": json.dumps({
+        user_id = step_inputs["get-user"][0]
+        
+        idp_credentials = {
             "id-token": cognito_id_token,
             "access-token": cognito_access_token,
             "refresh-token": cognito_refresh_token,
             "expires": calendar.timegm(datetime.datetime.utcnow().utctimetuple()) + cognito_access_token_expires
-        })
-    }
+        }
+        
+        update_user_profile_records(
+            identity_pool_id,
+            step_inputs["get-id"],
+            user_profile_dataset_name,
+            step_inputs["list-records"],
+            user_id,
+            idp_credentials
+        )
+    
+    step_graph.add_step(
+        "update-records",
+        update_records,
+        depends_on = ["get-user", "get-id", "list-records"]
+    )
+    
+    step_graph.add_step(
+        "get-credentials",
+        lambda x: cognito_identity_client.get_credentials_for_identity(
+            IdentityId = x["get-id"],
+            Logins = {
+                cognito_user_pool_provider_name: cognito_id_token
+            }
+        )["Credentials"],
+        depends_on = ["get-id"]
+    )
+    
+    return step_graph
+
+def get_user_id_and_email(cognito_access_token):
+    
+    response = cognito_idp_client.get_user(
+        AccessToken = cognito_access_token
+    )
+    
+    user_email = None
+    
+    for each_attribute_pair in response["UserAttributes"]:
+        if each_attribute_pair["Name"] == "email":
+            user_email = each_attribute_pair["Value"]
+            break
+    
+    return response["Username"], user_email
+
+def update_user_profile_records(identity_pool_id, identity_id, user_profile_dataset_name, list_records_response, user_id, idp_credentials):
+    """Stores the user ID and identity provider credentials in the identity's 
+    profile dataset, skipping the update entirely if neither changed."""
+    
+    stored_record_map = {}
+    
+    for each_record in list_records_response.get("Records", []):
+        stored_record_map[each_record["Key"]] = each_record
+    
+    records_to_replace = {}
     
-    for each_record in response.get("Records", []):
-        if each_record["Key"] in records_to_replace and each_record["Value"] == records_to_replace[each_record["Key"]]:
-            del records_to_replace[each_record["Key"]]
+    if stored_record_map.get("user-id", {}).get("Value") != user_id:
+        records_to_replace["user-id"] = user_id
+    
+    stored_idp_credentials = get_stored_idp_credentials(stored_record_map.get("idp-credentials"))
+    
+    if is_stored_idp_credentials_current(stored_idp_credentials, idp_credentials["refresh-token"]):
+        stored_idp_credentials_cache.put(identity_id, stored_idp_credentials)
+    else:
+        records_to_replace["idp-credentials"] = json.dumps(idp_credentials)
+    
+    if len(records_to_replace) == 0:
+        print("Identity {} records unchanged. Skipping update.".format(user_profile_dataset_name))
+        return
     
     record_patch_list = []
     
-    for each_key in records_to_replace.keys():
-        each_value = records_to_replace[each_key]
+    for each_key, each_value in records_to_replace.items():
         record_patch_list.append({
             "Op": "replace",
             "Key": each_key,
             "Value": each_value,
-            "SyncCount": key_sync_count_map.get(each_key, 0)
+            "SyncCount": stored_record_map.get(each_key, {}).get("SyncCount", 0)
         })
     
-    if len(record_patch_list) > 0:
-        print("Updating identity {} records: {}".format(
-            user_profile_dataset_name,
-            json.dumps(records_to_replace)
-        ))
-        response = cognito_sync_client.update_records(
-            IdentityPoolId = identity_pool_id,
-            IdentityId = identity_id,
-            DatasetName = user_profile_dataset_name,
-            RecordPatches = record_patch_list,
-            SyncSessionToken = sync_session_token
-        )
-    
-    print("Fetching credentials.")
+    print("Updating identity {} records: {}".format(
+        user_profile_dataset_name,
+        ", ".join(sorted(records_to_replace.keys()))
+    ))
     
-    response = cognito_identity_client.get_credentials_for_identity(
+    cognito_sync_client.update_records(
+        IdentityPoolId = identity_pool_id,
         IdentityId = identity_id,
-        Logins = {
-            cognito_user_pool_provider_name: cognito_id_token
-        }
+        DatasetName = user_profile_dataset_name,
+        RecordPatches = record_patch_list,
+        SyncSessionToken = list_records_response["SyncSessionToken"]
     )
     
-    aws_access_key_id = response["Credentials"]["AccessKeyId"]
-    aws_secret_access_key = response["Credentials"]["SecretKey"]
-    aws_session_token = response["Credentials"]["SessionToken"]
-    expiration_timestamp_seconds = calendar.timegm(response["Credentials"]["Expiration"].timetuple())
+    if "idp-credentials" in records_to_replace:
+        stored_idp_credentials_cache.put(identity_id, idp_credentials)
+
+def get_stored_idp_credentials(stored_record):
     
-    return {
-        "user": {
-            "user-id": identity_id,
-            "email-address": user_email
-        },
-        "credentials": {
-            "access-key-id": aws_access_key_id,
-            "secret-access-key": aws_secret_access_key,
-            "session-token": aws_session_token,
-            "expiration": expiration_timestamp_seconds - int(time.time()),
-            "refresh-token": cognito_refresh_token
-        }
-    }
+    if stored_record is None or stored_record.get("Value") is None:
+        return None
+    
+    try:
+        return json.loads(stored_record["Value"])
+    except ValueError:
+        return None
+
+def is_stored_idp_credentials_current(stored_idp_credentials, refresh_token):
+    
+    if stored_idp_credentials is None:
+        return False
+    
+    if stored_idp_credentials.get("refresh-token") != refresh_token:
+        return False
+    
+    return stored_idp_credentials.get("expires", 0) - int(time.time()) > idp_credentials_rewrite_margin_seconds
 
 def proxy_lambda_handler(event, context):
     
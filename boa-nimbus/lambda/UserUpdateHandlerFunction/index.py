@@ -10,10 +10,12 @@ import os
 import json
 import boto3
 import botocore
+from project_local.profile_changes import record_profile_change
 from apigateway_helpers.exception import APIGatewayException
 from apigateway_helpers.headers import get_response_headers
 
 cognito_idp_client = boto3.client("cognito-idp")
+s3_client = boto3.client("s3")
 
 def lambda_handler(event, context):
     print("Event: {}".format(json.dumps(event)))
@@ -55,6 +57,9 @@ def lambda_handler(event, context):
         ]
     )
     
+    # Let other functions drop any profile they've cached for this user.
+    record_profile_change(s3_client, os.environ["SHARED_BUCKET"], cognito_user_pool_sub_value)
+    
     return {
         "registration-id": cognito_user_pool_username,
         "message": "E-mail address verification message sent."
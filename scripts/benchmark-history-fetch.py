@@ -0,0 +1,163 @@
+"""Micro-benchmark for fetching a page of room history objects from S3.
+
+Compares the fetcher's former approach (a new thread pool per page and a new
+boto3 session and client per object) with a shared S3FetchExecutor.
+
+Runs against a local S3 stand-in that serves GetObject requests, so no AWS
+account is needed. The stand-in adds a fixed delay to each request and an
+extra delay to the first request on each new connection to approximate the
+cost of a TLS handshake.
+
+Run from the project root with boto3 installed:
+
+    python scripts/benchmark-history-fetch.py --pages 20
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "project-local"))
+
+from project_local.s3_fetch import S3FetchExecutor
+
+bucket_name = "benchmark-bucket"
+
+client_kwargs = {
+    "region_name": "us-east-1",
+    "aws_access_key_id": "benchmark",
+    "aws_secret_access_key": "benchmark"
+}
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def get_stand_in_handler_class(request_delay_seconds, connection_delay_seconds):
+
+    class S3StandInRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            time.sleep(connection_delay_seconds)
+
+        def do_GET(self):
+            time.sleep(request_delay_seconds)
+
+            body = json.dumps({
+                "identity-id": "us-east-1:00000000-0000-0000-0000-000000000000",
+                "author-name": "Benchmark",
+                "message": "Benchmark message for {}".format(self.path),
+                "timestamp": 1500000000
+            }).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", "\"benchmark\"")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return S3StandInRequestHandler
+
+def get_page_keys(page_number, page_size):
+    return list("room-event-logs/benchmark/reverse/{}-{}.json".format(page_number, i) for i in range(page_size))
+
+def fetch_page_with_clients_per_key(endpoint_url, key_list):
+
+    def get_object_body(key):
+        session = boto3.session.Session()
+
+        s3_client = session.client("s3", endpoint_url=endpoint_url, **client_kwargs)
+
+        return s3_client.get_object(Bucket = bucket_name, Key = key)["Body"].read()
+
+    pool = ThreadPool(processes=10)
+    results = pool.map(get_object_body, key_list)
+    pool.close()
+    pool.join()
+
+    return results
+
+def time_pages(fetch_page_function, page_count, page_size):
+
+    page_times = []
+
+    for page_number in range(page_count):
+        start_time = time.time()
+        fetch_page_function(get_page_keys(page_number, page_size))
+        page_times.append(time.time() - start_time)
+
+    return page_times
+
+def print_page_times(label, page_times):
+    sorted_times = sorted(page_times)
+
+    print("{:<24} mean {:8.2f} ms   p50 {:8.2f} ms   p99 {:8.2f} ms".format(
+        label,
+        1000 * sum(sorted_times) / len(sorted_times),
+        1000 * sorted_times[len(sorted_times) // 2],
+        1000 * sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * 0.99))]
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks fetching pages of room history objects against a local S3 stand-in."
+    )
+    parser.add_argument("--pages", type=int, default=20, help="Number of pages to fetch with each approach.")
+    parser.add_argument("--page-size", type=int, default=10, help="Number of objects per page.")
+    parser.add_argument("--request-delay-ms", type=float, default=5, help="Delay added to each request.")
+    parser.add_argument("--connection-delay-ms", type=float, default=30, help="Delay added to each new connection.")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), get_stand_in_handler_class(
+        args.request_delay_ms / 1000.0,
+        args.connection_delay_ms / 1000.0
+    ))
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    endpoint_url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    print("S3 stand-in listening at {}".format(endpoint_url))
+    print("{} page(s) of {} object(s) each.".format(args.pages, args.page_size))
+
+    print_page_times("Client per key:", time_pages(
+        lambda key_list: fetch_page_with_clients_per_key(endpoint_url, key_list),
+        args.pages,
+        args.page_size
+    ))
+
+    fetch_executor = S3FetchExecutor(max_workers = args.page_size + 1, endpoint_url = endpoint_url, **client_kwargs)
+
+    print_page_times("Shared executor:", time_pages(
+        lambda key_list: fetch_executor.get_object_bodies(bucket_name, key_list),
+        args.pages,
+        args.page_size
+    ))
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Micro-benchmark for generating Cognito secret hashes.
+
+Compares the former approach (a new HMAC keyed with the client secret for
+every hash) with a SecretHasher, which keys it once and copies it per hash.
+Both are checked to give the same hashes before being timed.
+
+Run from the project root:
+
+    python scripts/benchmark-secret-hash.py --hashes 100000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import hmac
+import time
+import base64
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "cognito-helpers"))
+
+from cognito_helpers import SecretHasher
+
+client_id = "1example23456789exampleabc"
+client_secret = "1example2abcdefghijklmnopqrstuvwxyz34567890abcdefghijk"
+
+def generate_secret_hash_with_new_hmac(username, client_id, client_secret):
+    # The former generate_cognito_sign_up_secret_hash. Its str() and
+    # decode() calls only work on Python 2, so the key and message are
+    # encoded the same way as SecretHasher's here.
+    return base64.b64encode(
+        hmac.new(
+            client_secret.encode("utf-8"),
+            msg = "{}{}".format(
+                username,
+                client_id
+            ).encode("utf-8"),
+            digestmod = hashlib.sha256
+        ).digest()
+    ).decode()
+
+def get_usernames(count):
+    return list("user{}@example.com".format(i) for i in range(count))
+
+def time_hashes(secret_hash_function, usernames, repeat):
+
+    run_times = []
+
+    for i in range(repeat):
+        start_time = time.time()
+
+        for each_username in usernames:
+            secret_hash_function(each_username)
+
+        run_times.append(time.time() - start_time)
+
+    return min(run_times)
+
+def print_hash_time(label, elapsed_seconds, hash_count):
+    print("{:<24} {:8.2f} ms total   {:8.3f} us per hash".format(
+        label,
+        1000 * elapsed_seconds,
+        1000000 * elapsed_seconds / hash_count
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks generating Cognito secret hashes."
+    )
+    parser.add_argument("--hashes", type=int, default=100000, help="Number of hashes to generate per run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each approach. The fastest is reported.")
+    args = parser.parse_args()
+
+    usernames = get_usernames(args.hashes)
+    secret_hasher = SecretHasher(client_id, client_secret)
+
+    for each_username in usernames[:1000]:
+        expected_secret_hash = generate_secret_hash_with_new_hmac(each_username, client_id, client_secret)
+
+        if secret_hasher.get_secret_hash(each_username) != expected_secret_hash:
+            raise Exception("Secret hashes differ for username: {}".format(each_username))
+
+        if secret_hasher.get_secret_hash(each_username.encode("utf-8")) != expected_secret_hash:
+            raise Exception("Secret hashes differ for username given as bytes: {}".format(each_username))
+
+    print("{} hash(es) per run, fastest of {} run(s).".format(args.hashes, args.repeat))
+
+    print_hash_time("New HMAC per hash:", time_hashes(
+        lambda username: generate_secret_hash_with_new_hmac(username, client_id, client_secret),
+        usernames,
+        args.repeat
+    ), args.hashes)
+
+    print_hash_time("SecretHasher:", time_hashes(
+        secret_hasher.get_secret_hash,
+        usernames,
+        args.repeat
+    ), args.hashes)
+
+if __name__ == "__main__":
+    main()
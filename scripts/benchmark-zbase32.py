@@ -0,0 +1,148 @@
+"""Micro-benchmark for zbase32 encoding and decoding of room and session IDs.
+
+Compares the former codec (a reduce over each 5-byte group, and a reverse
+alphabet rebuilt on every decode) with the table-driven zbase32 package.
+Before anything is timed, both are checked to give identical output for
+random inputs of every length up to --max-verify-length, and to reject
+the same invalid inputs.
+
+Run from the project root with Python 3:
+
+    python3 scripts/benchmark-zbase32.py --ids 100000
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import uuid
+import random
+import argparse
+import functools
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "zbase32-python3"))
+
+import zbase32
+
+def encode_with_reduce(bs):
+    # The former zbase32.encode.
+    result = bytearray()
+    for word in itertools.zip_longest(*([iter(bs)] * 5)):
+        padding_count = word.count(None)
+        n = functools.reduce(lambda x,y: (x<<8) + (y or 0), word, 0)
+        for i in range(0, (40 - 8 * padding_count), 5):
+            result.append(zbase32.ALPTHABET[(n >> (35 - i)) & 0x1F])
+    return result
+
+def decode_with_reduce(bs):
+    # The former zbase32.decode.
+    result = bytearray()
+    reversed_alphabet = dict(map(reversed, enumerate(zbase32.ALPTHABET)))
+    reversed_alphabet[None] = 0
+    bs = filter(lambda c: c not in b'\r\n', bs)
+    try:
+        for word in itertools.zip_longest(*([iter(bs)] * 8)):
+            padding_count = word.count(None)
+            n = functools.reduce(lambda x,y: (x<<5) + reversed_alphabet[y],
+                       word,
+                       0)
+            for i in range(32, 5 * padding_count - 1, -8):
+                result.append((n >> i) & 0xFF)
+    except KeyError:
+        raise ValueError("The input does not seem to be valid zbase32.")
+    return result
+
+def get_decode_result(decode_function, bs):
+    try:
+        return decode_function(bs)
+    except ValueError:
+        return ValueError
+
+def verify(max_length, samples_per_length):
+
+    random_source = random.Random(0)
+
+    for each_length in range(max_length + 1):
+        for i in range(samples_per_length):
+            each_bytes = bytes(random_source.getrandbits(8) for j in range(each_length))
+
+            if zbase32.encode(each_bytes) != encode_with_reduce(each_bytes):
+                raise Exception("Encodings differ for: {!r}".format(each_bytes))
+
+            each_encoded = bytes(random_source.choice(zbase32.ALPTHABET) for j in range(each_length))
+
+            # Includes encodings that don't come from whole bytes, and ones
+            # with line breaks or characters outside the alphabet.
+            for each_input in [each_encoded, each_encoded + b"\r\n", each_encoded + b"0"]:
+                if get_decode_result(zbase32.decode, each_input) != get_decode_result(decode_with_reduce, each_input):
+                    raise Exception("Decodings differ for: {!r}".format(each_input))
+
+    for i in range(samples_per_length * 100):
+        each_bytes = uuid.UUID(int = random_source.getrandbits(128)).bytes
+        each_encoded = encode_with_reduce(each_bytes).decode("ascii")
+
+        if zbase32.encode_uuid_bytes(each_bytes) != each_encoded:
+            raise Exception("UUID encodings differ for: {!r}".format(each_bytes))
+
+def time_function(function, inputs, repeat):
+
+    run_times = []
+
+    for i in range(repeat):
+        start_time = time.time()
+
+        for each_input in inputs:
+            function(each_input)
+
+        run_times.append(time.time() - start_time)
+
+    return min(run_times)
+
+def print_time(label, elapsed_seconds, id_count):
+    print("{:<32} {:8.2f} ms total   {:8.3f} us per ID".format(
+        label,
+        1000 * elapsed_seconds,
+        1000000 * elapsed_seconds / id_count
+    ))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Verifies and benchmarks zbase32 encoding and decoding."
+    )
+    parser.add_argument("--ids", type=int, default=100000, help="Number of IDs to encode and decode per run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each approach. The fastest is reported.")
+    parser.add_argument("--max-verify-length", type=int, default=64, help="Longest input verified.")
+    parser.add_argument("--verify-samples", type=int, default=50, help="Random inputs verified per length.")
+    args = parser.parse_args()
+
+    verify(args.max_verify_length, args.verify_samples)
+
+    print("Output identical for inputs of up to {} bytes.".format(args.max_verify_length))
+
+    id_bytes_list = list(uuid.uuid4().bytes for i in range(args.ids))
+    id_list = list(zbase32.encode_uuid_bytes(x) for x in id_bytes_list)
+
+    print("{} ID(s) per run, fastest of {} run(s).".format(args.ids, args.repeat))
+
+    print_time("Encode (former):", time_function(
+        lambda x: encode_with_reduce(x).decode("utf-8"),
+        id_bytes_list,
+        args.repeat
+    ), args.ids)
+
+    print_time("Encode (b2a):", time_function(zbase32.b2a, id_bytes_list, args.repeat), args.ids)
+    print_time("Encode (encode_uuid_bytes):", time_function(zbase32.encode_uuid_bytes, id_bytes_list, args.repeat), args.ids)
+
+    print_time("Decode (former):", time_function(
+        lambda x: decode_with_reduce(x.encode("utf-8")),
+        id_list,
+        args.repeat
+    ), args.ids)
+
+    print_time("Decode (a2b):", time_function(zbase32.a2b, id_list, args.repeat), args.ids)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "project-local"))
+
+from project_local.cache import TTLCache, ByteBoundedLRUCache
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2, 60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+
+        # Makes "b" the least recently used.
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.get_stats(), {"entries": 2, "hits": 3, "misses": 1, "evictions": 1})
+
+    def test_replacing_does_not_evict(self):
+        cache = TTLCache(2, 60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("a", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 3)
+        self.assertEqual(cache.get("b"), 2)
+
+    def test_expires_entries(self):
+        cache = TTLCache(2, 0)
+        cache.put("a", 1)
+
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        cache = TTLCache(2, 60)
+        cache.put("a", 1)
+
+        self.assertTrue(cache.invalidate("a"))
+        self.assertFalse(cache.invalidate("a"))
+        self.assertEqual(cache.get("a"), None)
+
+class ByteBoundedLRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used_until_under_limit(self):
+        cache = ByteBoundedLRUCache(10)
+        cache.put("a", "a-value", 4)
+        cache.put("b", "b-value", 4)
+
+        # Makes "b" the least recently used.
+        self.assertEqual(cache.get("a"), "a-value")
+
+        cache.put("c", "c-value", 4)
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "a-value")
+        self.assertEqual(cache.get_stats()["bytes"], 8)
+
+        # Needs both remaining entries removed.
+        cache.put("d", "d-value", 10)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get_stats()["evictions"], 3)
+
+    def test_replacing_updates_size(self):
+        cache = ByteBoundedLRUCache(10)
+        cache.put("a", "a-value", 4)
+        cache.put("a", "a-value", 6)
+
+        self.assertEqual(cache.get_stats()["bytes"], 6)
+
+    def test_ignores_oversized_values(self):
+        cache = ByteBoundedLRUCache(10)
+        cache.put("a", "a-value", 4)
+        cache.put("b", "b-value", 11)
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "a-value")
+        self.assertEqual(cache.get_stats()["evictions"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+from __future__ import print_function
+
+import os
+import re
+import sys
+import unittest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "project-local"))
+
+from project_local.dedupe import InMemoryDedupeStore, MessageDedupeWindow
+
+class InMemoryDedupeStoreTest(unittest.TestCase):
+
+    def test_get_and_put(self):
+        store = InMemoryDedupeStore(60)
+
+        self.assertEqual(store.get("a"), None)
+
+        store.put("a", "message-id")
+
+        self.assertEqual(store.get("a"), "message-id")
+
+    def test_expires_entries(self):
+        store = InMemoryDedupeStore(0)
+        store.put("a", "message-id")
+
+        self.assertEqual(store.get("a"), None)
+
+class MessageDedupeWindowTest(unittest.TestCase):
+
+    def test_lookup_after_record(self):
+        window = MessageDedupeWindow(None, 60)
+
+        self.assertEqual(window.lookup("room", "identity", "client-id"), None)
+
+        window.record("room", "identity", "client-id", "message-id")
+
+        self.assertEqual(window.lookup("room", "identity", "client-id"), "message-id")
+
+        # The same client message ID from someone else, or in another room, is
+        # a different message.
+        self.assertEqual(window.lookup("room", "other-identity", "client-id"), None)
+        self.assertEqual(window.lookup("other-room", "identity", "client-id"), None)
+
+    def test_dedupe_key_is_safe_for_s3(self):
+        window = MessageDedupeWindow(None, 60)
+
+        dedupe_key = window.get_dedupe_key("room", "identity", u"../\u00e9\n")
+
+        self.assertEqual(dedupe_key.split("/")[0], "room")
+        self.assertTrue(re.match("^[0-9a-f]{64}$", dedupe_key.split("/", 1)[1]))
+
+    def test_lookup_from_shared_store(self):
+        store = InMemoryDedupeStore(60)
+
+        # Stands in for two containers sharing one store.
+        first_window = MessageDedupeWindow(store, 60)
+        second_window = MessageDedupeWindow(store, 60)
+
+        first_window.record("room", "identity", "client-id", "message-id")
+
+        self.assertEqual(second_window.lookup("room", "identity", "client-id", check_shared_store=False), None)
+        self.assertEqual(second_window.lookup("room", "identity", "client-id"), "message-id")
+
+        # Found records are kept locally too.
+        self.assertEqual(second_window.lookup("room", "identity", "client-id", check_shared_store=False), "message-id")
+
+    def test_record_on_pool(self):
+        store = InMemoryDedupeStore(60)
+        window = MessageDedupeWindow(store, 60)
+        pool = ThreadPool(processes=1)
+
+        window.record("room", "identity", "client-id", "message-id", pool=pool)
+
+        pool.close()
+        pool.join()
+
+        self.assertEqual(store.get(window.get_dedupe_key("room", "identity", "client-id")), "message-id")
+
+    def test_shared_record_failure_is_not_raised(self):
+
+        class FailingStore(object):
+            def put(self, key, value):
+                raise Exception("failed")
+
+        window = MessageDedupeWindow(FailingStore(), 60)
+        pool = ThreadPool(processes=1)
+
+        window.record("room", "identity", "client-id", "message-id", pool=pool)
+
+        pool.close()
+        pool.join()
+
+        self.assertEqual(window.lookup("room", "identity", "client-id", check_shared_store=False), "message-id")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "project-local"))
+
+from project_local import room_event_log
+
+room_id = "ybndrfg8ejkmcpqxot1uwiszay"
+
+# SNS message IDs contain hyphens, like the separators in keys.
+message_id = "0c1d2e3f-4a5b-6c7d-8e9f-a0b1c2d3e4f5"
+
+class KeyTest(unittest.TestCase):
+
+    def test_reverse_lexi_string(self):
+        self.assertEqual(room_event_log.get_reverse_lexi_string_for_timestamp(1500000000), "8499999999")
+        self.assertEqual(room_event_log.get_reverse_lexi_string_for_timestamp(0), "9999999999")
+
+        # Newer timestamps sort first.
+        self.assertLess(
+            room_event_log.get_reverse_lexi_string_for_timestamp(1500000001),
+            room_event_log.get_reverse_lexi_string_for_timestamp(1500000000)
+        )
+
+    def test_message_id_from_reverse_key(self):
+        reverse_key = room_event_log.get_reverse_key(room_id, 1500000000, message_id)
+
+        self.assertEqual(reverse_key, "room-event-logs/{}/reverse/8499999999-1500000000-{}.json".format(room_id, message_id))
+        self.assertEqual(room_event_log.get_message_id_from_reverse_key(reverse_key), message_id)
+
+    def test_segment_key_for_forward_pointer(self):
+        segment_key = "room-event-logs/{}/segments/8499999939-1500000060-1500000061-2-01f255e8.ndjson".format(room_id)
+
+        pointer_key = room_event_log.get_segment_forward_pointer_key(room_id, 1500000119, segment_key)
+
+        self.assertEqual(pointer_key, "room-event-logs/{}/segments-forward/1500000119-8499999939-1500000060-1500000061-2-01f255e8.ndjson".format(room_id))
+        self.assertEqual(room_event_log.get_segment_key_for_forward_pointer(room_id, pointer_key), segment_key)
+
+    def test_event_sort_keys(self):
+        event_list = [
+            {"timestamp": 1500000000, "message-id": "b"},
+            {"timestamp": 1500000001, "message-id": "c"},
+            {"timestamp": 1500000000, "message-id": "a"}
+        ]
+
+        self.assertEqual(
+            list(x["message-id"] for x in sorted(event_list, key=room_event_log.get_event_sort_key)),
+            ["c", "a", "b"]
+        )
+        self.assertEqual(
+            list(x["message-id"] for x in sorted(event_list, key=room_event_log.get_forward_event_sort_key)),
+            ["a", "b", "c"]
+        )
+
+class BlockTest(unittest.TestCase):
+
+    def test_concatenated_blocks_decode_together(self):
+        first_events = [{"timestamp": 1500000001, "message-id": "a"}]
+        second_events = [{"timestamp": 1500000000, "message-id": "b"}, {"timestamp": 1500000000, "message-id": "c"}]
+
+        first_block = room_event_log.encode_block(first_events)
+        second_block = room_event_log.encode_block(second_events)
+
+        self.assertEqual(room_event_log.decode_block(second_block), second_events)
+        self.assertEqual(room_event_log.decode_block(first_block + second_block), first_events + second_events)
+
+class MergeTest(unittest.TestCase):
+
+    def test_merges_and_skips_copies(self):
+        def get_events(*timestamp_id_pairs):
+            return list({"timestamp": x[0], "message-id": x[1]} for x in timestamp_id_pairs)
+
+        merged_events = room_event_log.iter_merged_room_events([
+            iter(get_events((5, "e"), (3, "c"), (1, "a"))),
+            iter(get_events((4, "d"), (3, "c"), (2, "b"))),
+            iter(get_events((5, "e"), (2, "b")))
+        ])
+
+        self.assertEqual(list(x["message-id"] for x in merged_events), ["e", "d", "c", "b", "a"])
+
+if __name__ == "__main__":
+    unittest.main()
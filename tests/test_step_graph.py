@@ -0,0 +1,77 @@
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "project-local"))
+
+from project_local.step_graph import StepGraph, StepGraphError
+
+class StepGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(processes=4)
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def test_passes_dependency_results(self):
+        graph = StepGraph()
+        graph.add_step("a", lambda x: 1)
+        graph.add_step("b", lambda x: 2)
+        graph.add_step("c", lambda x: x["a"] + x["b"], depends_on=["a", "b"])
+
+        self.assertEqual(graph.run(self.pool), {"a": 1, "b": 2, "c": 3})
+        self.assertEqual(sorted(graph.step_timings.keys()), ["a", "b", "c"])
+
+    def test_unknown_dependency(self):
+        graph = StepGraph()
+
+        with self.assertRaises(ValueError):
+            graph.add_step("a", lambda x: 1, depends_on=["b"])
+
+    def test_rolls_back_finished_steps_in_reverse(self):
+        rolled_back = []
+        started = []
+
+        def fail(step_inputs):
+            raise Exception("failed")
+
+        graph = StepGraph()
+        graph.add_step("a", lambda x: "a-result", rollback=rolled_back.append)
+        graph.add_step("b", lambda x: "b-result", depends_on=["a"], rollback=rolled_back.append)
+        graph.add_step("c", fail, depends_on=["b"], rollback=rolled_back.append)
+        graph.add_step("d", lambda x: started.append("d"), depends_on=["c"])
+
+        with self.assertRaises(StepGraphError) as context:
+            graph.run(self.pool)
+
+        self.assertEqual(context.exception.step_name, "c")
+        self.assertEqual(str(context.exception.exception), "failed")
+        self.assertEqual(rolled_back, ["b-result", "a-result"])
+        self.assertEqual(started, [])
+
+    def test_keeps_rolling_back_after_rollback_failure(self):
+        rolled_back = []
+
+        def fail(step_inputs):
+            raise Exception("failed")
+
+        def fail_rollback(result):
+            raise Exception("rollback failed")
+
+        graph = StepGraph()
+        graph.add_step("a", lambda x: "a-result", rollback=rolled_back.append)
+        graph.add_step("b", lambda x: "b-result", depends_on=["a"], rollback=fail_rollback)
+        graph.add_step("c", fail, depends_on=["b"])
+
+        with self.assertRaises(StepGraphError):
+            graph.run(self.pool)
+
+        self.assertEqual(rolled_back, ["a-result"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "apigateway-helpers"))
+
+from apigateway_helpers.exception import APIGatewayException
+from apigateway_helpers.validation import is_valid_zbase32_id, validate_zbase32_id_path_parameter
+
+class IsValidZbase32IdTest(unittest.TestCase):
+
+    def test_valid_ids(self):
+        for each_id in [
+            "yyyyyyyyyyyyyyyyyyyyyyyyyy",
+            "9999999999999999999999999h",
+            "ybndrfg8ejkmcpqxot1uwiszay",
+            u"4t7yeybndrfg8ejkmcpqxot1ue"
+        ]:
+            self.assertTrue(is_valid_zbase32_id(each_id), each_id)
+
+    def test_invalid_ids(self):
+        for each_id in [
+            "",
+            "yyyyyyyyyyyyyyyyyyyyyyyyy",
+            "yyyyyyyyyyyyyyyyyyyyyyyyyyy",
+
+            # Last characters that would need nonzero padding bits.
+            "yyyyyyyyyyyyyyyyyyyyyyyyyb",
+            "yyyyyyyyyyyyyyyyyyyyyyyyy9",
+
+            # Characters outside the alphabet.
+            "0yyyyyyyyyyyyyyyyyyyyyyyyy",
+            "yyyyyyyyyyyyylyyyyyyyyyyyy",
+            "YYYYYYYYYYYYYYYYYYYYYYYYYY",
+            "yyyyyyyyyyyy/yyyyyyyyyyyyy",
+            u"yyyyyyyyyyyy\u00e9yyyyyyyyyyyyy"
+        ]:
+            self.assertFalse(is_valid_zbase32_id(each_id), each_id)
+
+    def test_non_strings(self):
+        for each_value in [None, 12345678901234567890123456, ["y"] * 26]:
+            self.assertFalse(is_valid_zbase32_id(each_value))
+
+class ValidateZbase32IdPathParameterTest(unittest.TestCase):
+
+    def test_returns_valid_id(self):
+        event = {"pathParameters": {"room-id": "yyyyyyyyyyyyyyyyyyyyyyyyyy"}}
+
+        self.assertEqual(validate_zbase32_id_path_parameter(event, "room-id"), "yyyyyyyyyyyyyyyyyyyyyyyyyy")
+
+    def test_raises_for_invalid_or_missing_id(self):
+        for each_event in [
+            {"pathParameters": {"room-id": "../yyyyyyyyyyyyyyyyyyyyyyy"}},
+            {"pathParameters": {}},
+            {"pathParameters": None},
+            {}
+        ]:
+            with self.assertRaises(APIGatewayException) as context:
+                validate_zbase32_id_path_parameter(each_event, "room-id")
+
+            self.assertEqual(context.exception.http_status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Checks the table-driven zbase32 codec against the former one, which is
+kept here as a reference.
+
+The package is Python 3 only, so these are skipped under Python 2.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import uuid
+import random
+import unittest
+import functools
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "zbase32-python3"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "boa-nimbus", "lambda-pip-modules", "apigateway-helpers"))
+
+from apigateway_helpers.validation import is_valid_zbase32_id
+
+if sys.version_info[0] >= 3:
+    import zbase32
+
+def encode_with_reduce(bs):
+    # The former zbase32.encode.
+    result = bytearray()
+    for word in itertools.zip_longest(*([iter(bs)] * 5)):
+        padding_count = word.count(None)
+        n = functools.reduce(lambda x,y: (x<<8) + (y or 0), word, 0)
+        for i in range(0, (40 - 8 * padding_count), 5):
+            result.append(zbase32.ALPTHABET[(n >> (35 - i)) & 0x1F])
+    return result
+
+def decode_with_reduce(bs):
+    # The former zbase32.decode.
+    result = bytearray()
+    reversed_alphabet = dict(map(reversed, enumerate(zbase32.ALPTHABET)))
+    reversed_alphabet[None] = 0
+    bs = filter(lambda c: c not in b'\r\n', bs)
+    try:
+        for word in itertools.zip_longest(*([iter(bs)] * 8)):
+            padding_count = word.count(None)
+            n = functools.reduce(lambda x,y: (x<<5) + reversed_alphabet[y],
+                       word,
+                       0)
+            for i in range(32, 5 * padding_count - 1, -8):
+                result.append((n >> i) & 0xFF)
+    except KeyError:
+        raise ValueError("The input does not seem to be valid zbase32.")
+    return result
+
+def get_decode_result(decode_function, bs):
+    try:
+        return decode_function(bs)
+    except ValueError:
+        return ValueError
+
+@unittest.skipIf(sys.version_info[0] < 3, "zbase32-python3 requires Python 3.")
+class Zbase32Test(unittest.TestCase):
+
+    def setUp(self):
+        self.random_source = random.Random(0)
+
+    def get_random_bytes(self, length):
+        return bytes(self.random_source.getrandbits(8) for i in range(length))
+
+    def test_encode_matches_former_codec(self):
+        for each_length in range(41):
+            for i in range(10):
+                each_bytes = self.get_random_bytes(each_length)
+
+                self.assertEqual(zbase32.encode(each_bytes), encode_with_reduce(each_bytes))
+                self.assertEqual(zbase32.b2a(each_bytes), encode_with_reduce(each_bytes).decode("ascii"))
+
+    def test_decode_matches_former_codec(self):
+        for each_length in range(41):
+            for i in range(10):
+                each_encoded = bytes(self.random_source.choice(zbase32.ALPTHABET) for j in range(each_length))
+
+                # Includes encodings that don't come from whole bytes, and ones
+                # with line breaks or characters outside the alphabet.
+                for each_input in [each_encoded, each_encoded + b"\r\n", each_encoded + b"0"]:
+                    self.assertEqual(
+                        get_decode_result(zbase32.decode, each_input),
+                        get_decode_result(decode_with_reduce, each_input)
+                    )
+
+    def test_round_trip(self):
+        for each_length in range(41):
+            each_bytes = self.get_random_bytes(each_length)
+
+            self.assertEqual(zbase32.a2b(zbase32.b2a(each_bytes)), each_bytes)
+
+    def test_encode_uuid_bytes(self):
+        for i in range(1000):
+            each_bytes = uuid.UUID(int = self.random_source.getrandbits(128)).bytes
+            each_id = zbase32.encode_uuid_bytes(each_bytes)
+
+            self.assertEqual(each_id, zbase32.b2a(each_bytes))
+            self.assertTrue(is_valid_zbase32_id(each_id), each_id)
+
+        with self.assertRaises(ValueError):
+            zbase32.encode_uuid_bytes(bytes(15))
+
+if __name__ == "__main__":
+    unittest.main()